@@ -0,0 +1,402 @@
+"""Нагрузочный тест бота без сети
+
+Синтетические водители проходят диалоги отказа, претензии и информации
+через обработчики из bot.build_application(), задачи создаются в локальном
+поддельном Bitrix24 с настраиваемыми задержкой и долей ошибок. Сообщения
+Telegram перехватываются на уровне Bot, поэтому токен и доступ в интернет
+не нужны.
+
+Пример:
+    python benchmark.py --users 100 --conversations 5 --bitrix-latency 0.3 --bitrix-error-rate 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import parse_qsl
+from aiohttp import web
+from telegram import Update
+from telegram.ext import ExtBot
+from config import Config
+
+logger = logging.getLogger('benchmark')
+
+NOTIFICATION_PREFIXES = ('✅ Задача по заявке', '❌ Не удалось создать задачу', '✅ Заявка #')
+TICKET_RE = re.compile(r'#(\d+)')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class FakeBitrix:
+    """Локальный сервер, отвечающий как REST API Bitrix24"""
+
+    def __init__(self, latency, jitter, error_rate, rng, latencies=None):
+        self.latency = latency
+        # Задержки, записанные на реальном трафике; если заданы, берутся из них
+        self.latencies = latencies
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = rng
+        self.requests = 0
+        self.commands = 0
+        self.errors = 0
+        self._task_ids = itertools.count(1)
+        # Задачи по тегу заявки для tasks.task.list и комментарии для task.commentitem.getlist
+        self.tagged = {}
+        self.comments = {}
+
+    def _command(self, method, params):
+        self.commands += 1
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            return None
+        if method == 'tasks.task.list':
+            task_id = self.tagged.get(params.get('filter[TAG]'))
+            return {'tasks': [{'id': task_id}] if task_id else []}
+        if method == 'task.commentitem.getlist':
+            return self.comments.get(params.get('TASKID'), [])
+        if method == 'task.commentitem.add':
+            comment_id = next(self._task_ids)
+            self.comments.setdefault(params.get('TASKID'), []).append(
+                {'ID': str(comment_id), 'POST_MESSAGE': params.get('FIELDS[POST_MESSAGE]')}
+            )
+            return comment_id
+        if method == 'tasks.task.add':
+            task_id = str(next(self._task_ids))
+            if 'fields[TAGS][0]' in params:
+                self.tagged[params['fields[TAGS][0]']] = task_id
+            return {'task': {'id': task_id}}
+        return next(self._task_ids)
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.latencies:
+            await asyncio.sleep(self.rng.choice(self.latencies))
+        else:
+            await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)))
+        method = request.match_info['method']
+        form = await request.post()
+
+        if method != 'batch':
+            result = self._command(method, form)
+            if result is None:
+                return web.json_response({'error': 'INTERNAL_SERVER_ERROR'}, status=500)
+            return web.json_response({'result': result})
+
+        results, errors = {}, {}
+        for key, command in form.items():
+            if not key.startswith('cmd['):
+                continue
+            name = key[len('cmd['):-1]
+            method, _, query = command.partition('?')
+            result = self._command(method, dict(parse_qsl(query)))
+            if result is None:
+                errors[name] = {'error': 'INTERNAL_SERVER_ERROR', 'error_description': 'fake error'}
+            else:
+                results[name] = result
+        return web.json_response({'result': {'result': results, 'result_error': errors}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/rest/1/bench/{method}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/rest/1/bench/"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class BenchBot(ExtBot):
+    """Bot, который вместо запросов к Telegram отдаёт ответы водителям в очереди"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Объекты telegram неизменяемы после создания
+        with self._unfrozen():
+            self.replies = {}
+            self.notifications = {}
+            self._message_ids = itertools.count(1)
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        if endpoint != 'sendMessage':
+            return True
+
+        chat_id = int(data['chat_id'])
+        text = data['text']
+        if text.startswith(NOTIFICATION_PREFIXES):
+            match = TICKET_RE.search(text)
+            if match:
+                self.notifications[int(match.group(1))] = (time.perf_counter(), text.startswith('✅'))
+        else:
+            self.replies.setdefault(chat_id, asyncio.Queue()).put_nowait(text)
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text
+        }
+
+
+def conversation(kind, user_id, number, rng, bulk_articles=False):
+    """Сообщения водителя для одного диалога; bulk_articles - все товары одним списком"""
+    code = str(rng.randint(10000, 99999))
+    route = f"Маршрут {rng.randint(1, 50)}"
+    if kind == 'info':
+        return ['ℹ️ Информация', code, route, f"Информация {user_id}-{number}"]
+
+    messages = ['🚫 Отказ'] if kind == 'refusal' else ['⚠️ Претензия', rng.choice(['Недовоз', 'Брак', 'Пересорт'])]
+    messages += [code, route]
+    if bulk_articles:
+        messages.append('\n'.join(
+            f"ART{rng.randint(1, 99999):05d} x{rng.randint(1, 20)}" for _ in range(rng.randint(1, 10))
+        ))
+    else:
+        for index in range(rng.randint(1, 3)):
+            if index:
+                messages.append('➕ Добавить артикул')
+            messages += [f"ART{rng.randint(1, 99999):05d}", str(rng.randint(1, 20))]
+    messages += ['➡ Продолжить', f"УПД-{user_id}-{number}", 'Нагрузочный тест']
+    return messages
+
+
+class Driver:
+    def __init__(self, application, user_id, stats):
+        self.application = application
+        self.user_id = user_id
+        self.stats = stats
+
+    async def send(self, text, update_id):
+        update = Update.de_json({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': self.user_id, 'type': 'private'},
+                'from': {'id': self.user_id, 'is_bot': False, 'first_name': f"Driver{self.user_id}"},
+                'text': text
+            }
+        }, self.application.bot)
+        replies = self.application.bot.replies.setdefault(self.user_id, asyncio.Queue())
+        start = time.perf_counter()
+        await self.application.update_queue.put(update)
+        reply = await replies.get()
+        self.stats['message_latency'].append(time.perf_counter() - start)
+        return start, reply
+
+
+async def run_driver(driver, conversations, think_time, update_ids, rng, stats, bulk_articles=False):
+    for number in range(conversations):
+        kind = rng.choice(['refusal', 'claim', 'info'])
+        start = time.perf_counter()
+        for text in conversation(kind, driver.user_id, number, rng, bulk_articles):
+            sent_at, reply = await driver.send(text, next(update_ids))
+            if think_time:
+                await asyncio.sleep(rng.uniform(0, 2 * think_time))
+        stats['conversation_latency'].append(time.perf_counter() - start)
+        stats['conversations'] += 1
+        if reply.startswith('✅ Заявка принята'):
+            stats['submitted'][int(TICKET_RE.search(reply).group(1))] = sent_at
+        elif reply.startswith('✅ Задача создана'):
+            stats['direct_tasks'] += 1
+        else:
+            stats['rejected'].append(reply)
+
+
+def configure_stand_in(bitrix_url, retry_delay, bitrix_rate=None):
+    """Направляет бота на поддельный Bitrix24; вызывать до импорта bot"""
+    Config.BITRIX_WEBHOOK = bitrix_url
+    Config.BOT_TOKEN = '123456:benchmark'
+    Config.RESPONSIBLE_ID = '1'
+    Config.PROJECT_IDS = {'refusal': '1', 'claim': '2', 'info': '3'}
+    Config.DIRECTORY_PATH = None
+    Config.CATALOG_PATH = None
+    Config.CAPTURE_PATH = None
+    Config.OUTBOX_RETRY_DELAY = retry_delay
+    if bitrix_rate:
+        Config.BITRIX_RATE_LIMIT = bitrix_rate
+        Config.BITRIX_RATE_BURST = max(Config.BITRIX_RATE_BURST, int(bitrix_rate))
+
+
+def max_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В Linux ru_maxrss в килобайтах, в macOS - в байтах
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    return round(maxrss / 1024 / 1024, 1)
+
+
+async def benchmark(args):
+    rng = random.Random(args.seed)
+    fake_bitrix = FakeBitrix(args.bitrix_latency, args.bitrix_jitter, args.bitrix_error_rate, rng)
+    configure_stand_in(await fake_bitrix.start(), args.retry_delay, args.bitrix_rate)
+
+    # bot.py создаёт bot.db в текущем каталоге при импорте
+    import bot
+
+    stats = {
+        'message_latency': [],
+        'conversation_latency': [],
+        'conversations': 0,
+        'direct_tasks': 0,
+        'submitted': {},
+        'rejected': []
+    }
+
+    await bot.start_services()
+    application = bot.build_application(BenchBot(Config.BOT_TOKEN))
+    await application.initialize()
+    await application.start()
+    bot.outbox_worker.bot = application.bot
+
+    update_ids = itertools.count(1)
+    drivers = [Driver(application, 100000 + index, stats) for index in range(args.users)]
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        run_driver(
+            driver, args.conversations, args.think_time, update_ids, random.Random(rng.random()), stats,
+            args.bulk_articles
+        )
+        for driver in drivers
+    ))
+    dialog_time = time.perf_counter() - started
+
+    # Ждём доставки всех заявок в поддельный Bitrix24
+    deadline = time.perf_counter() + args.timeout
+    notifications = application.bot.notifications
+    while time.perf_counter() < deadline and not set(stats['submitted']) <= set(notifications):
+        await asyncio.sleep(0.05)
+    total_time = time.perf_counter() - started
+
+    bot.outbox_worker.bot = None
+    await application.stop()
+    await application.shutdown()
+    await bot.stop_services()
+    await fake_bitrix.stop()
+
+    task_latency = [
+        notifications[ticket][0] - sent_at
+        for ticket, sent_at in stats['submitted'].items() if ticket in notifications
+    ]
+    messages = stats['message_latency']
+
+    return {
+        'users': args.users,
+        'conversations': stats['conversations'],
+        'messages': len(messages),
+        'dialog_seconds': round(dialog_time, 3),
+        'total_seconds': round(total_time, 3),
+        'messages_per_second': round(len(messages) / dialog_time, 1) if dialog_time else 0.0,
+        'tasks_per_second': round(len(task_latency) / total_time, 1) if total_time else 0.0,
+        'message_latency_ms': {
+            f"p{p}": round(percentile(messages, p) * 1000, 2) for p in (50, 95, 99)
+        },
+        'conversation_latency_ms': {
+            f"p{p}": round(percentile(stats['conversation_latency'], p) * 1000, 2) for p in (50, 95, 99)
+        },
+        'task_latency_ms': {
+            f"p{p}": round(percentile(task_latency, p) * 1000, 2) for p in (50, 95, 99)
+        },
+        'tasks_submitted': len(stats['submitted']),
+        'tasks_delivered': sum(1 for ticket in stats['submitted'] if notifications.get(ticket, (0, False))[1]),
+        'tasks_failed': sum(1 for ticket in stats['submitted'] if ticket in notifications and not notifications[ticket][1]),
+        'tasks_undelivered': len(set(stats['submitted']) - set(notifications)),
+        'rejected_submissions': len(stats['rejected']),
+        'bitrix_requests': fake_bitrix.requests,
+        'bitrix_commands': fake_bitrix.commands,
+        'bitrix_injected_errors': fake_bitrix.errors,
+        'max_rss_mb': max_rss_mb(),
+        'python_peak_mb': round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1) if tracemalloc.is_tracing() else None
+    }
+
+
+def print_report(report):
+    print(f"Водителей: {report['users']}, диалогов: {report['conversations']}, сообщений: {report['messages']}")
+    print(f"Время диалогов: {report['dialog_seconds']} с, всего с доставкой: {report['total_seconds']} с")
+    print(f"Пропускная способность: {report['messages_per_second']} сообщ./с, {report['tasks_per_second']} задач/с")
+    for name, title in (
+        ('message_latency_ms', 'Ответ на сообщение'),
+        ('conversation_latency_ms', 'Диалог целиком'),
+        ('task_latency_ms', 'Заявка до задачи')
+    ):
+        latency = report[name]
+        print(f"{title}, мс: p50 {latency['p50']}, p95 {latency['p95']}, p99 {latency['p99']}")
+    print(
+        f"Заявок: {report['tasks_submitted']}, доставлено: {report['tasks_delivered']}, "
+        f"ошибок: {report['tasks_failed']}, не доставлено: {report['tasks_undelivered']}, "
+        f"отклонено как дубли: {report['rejected_submissions']}"
+    )
+    print(
+        f"Bitrix24: запросов {report['bitrix_requests']}, команд {report['bitrix_commands']}, "
+        f"внесённых ошибок {report['bitrix_injected_errors']}"
+    )
+    memory = f"Память: пик RSS {report['max_rss_mb']} МБ"
+    if report['python_peak_mb'] is not None:
+        memory += f", пик Python {report['python_peak_mb']} МБ"
+    print(memory)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с поддельными Telegram и Bitrix24")
+    parser.add_argument('--users', type=int, default=50, help="число одновременных водителей")
+    parser.add_argument('--conversations', type=int, default=3, help="диалогов на водителя")
+    parser.add_argument('--think-time', type=float, default=0.0, help="средняя пауза водителя между сообщениями, с")
+    parser.add_argument('--bitrix-latency', type=float, default=0.2, help="средняя задержка ответа Bitrix24, с")
+    parser.add_argument('--bitrix-jitter', type=float, default=0.05, help="разброс задержки Bitrix24, с")
+    parser.add_argument('--bitrix-error-rate', type=float, default=0.0, help="доля команд, завершающихся ошибкой 5xx")
+    parser.add_argument('--bitrix-rate', type=float, default=None, help="лимит запросов к Bitrix24 в секунду")
+    parser.add_argument('--retry-delay', type=float, default=0.5, help="базовая задержка повтора outbox, с")
+    parser.add_argument('--timeout', type=float, default=120, help="ожидание доставки заявок, с")
+    parser.add_argument('--bulk-articles', action='store_true', help="отправлять товары одним сообщением-списком")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tracemalloc', action='store_true', help="замерять пик памяти Python (замедляет тест)")
+    parser.add_argument('--json', action='store_true', help="вывести отчёт в JSON")
+    parser.add_argument('--max-p95-ms', type=float, default=None, help="порог p95 ответа на сообщение для CI")
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    workdir = tempfile.mkdtemp(prefix='motexbot-bench-')
+    os.chdir(workdir)
+    report = asyncio.run(benchmark(args))
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    failed = report['tasks_undelivered'] > 0
+    if args.max_p95_ms is not None and report['message_latency_ms']['p95'] > args.max_p95_ms:
+        logger.error(f"p95 ответа {report['message_latency_ms']['p95']} мс превышает порог {args.max_p95_ms} мс")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
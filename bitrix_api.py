@@ -1,30 +1,353 @@
-import requests
+import httpx
 import logging
 from config import Config
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+import asyncio
 import time
 from datetime import datetime, timedelta
+from urllib.parse import urlencode
+from logging_config import PAYLOAD, sample_payloads
+from metrics import BITRIX_LATENCY, BITRIX_REQUESTS
+from resilience import CircuitBreaker, CircuitOpenError, RetryableError, RetryPolicy, ThrottledError, TokenBucket
 
 logger = logging.getLogger(__name__)
 
 
+class BitrixServerError(RetryableError):
+    """Bitrix24 ответил 5xx"""
+
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.body = body
+
+
+class BitrixThrottledError(ThrottledError):
+    """Bitrix24 ответил QUERY_LIMIT_EXCEEDED"""
+
+    def __init__(self, status, body):
+        super().__init__("QUERY_LIMIT_EXCEEDED")
+        self.status = status
+        self.body = body
+
+
+class BitrixBatcher:
+    """Объединяет одновременные вызовы REST API в запросы batch"""
+
+    # Bitrix24 принимает не более 50 команд в одном batch
+    MAX_COMMANDS = 50
+
+    def __init__(self, post, window=0.2):
+        self._post = post
+        self.window = window
+        self._pending = []
+        self._flush_handle = None
+        self._sending = set()
+
+    async def submit(self, method, params):
+        """Ставит вызов в очередь и ждёт его результат
+
+        Возвращает словарь с ключом 'result' или 'error'/'error_description'
+        и HTTP-статусом в 'status'. Сетевые ошибки пробрасываются вызывающему.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((method, params, future))
+
+        if len(self._pending) >= self.MAX_COMMANDS:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        while self._pending:
+            commands = self._pending[:self.MAX_COMMANDS]
+            del self._pending[:self.MAX_COMMANDS]
+            task = asyncio.create_task(self._send(commands))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, commands):
+        try:
+            if len(commands) == 1:
+                method, params, future = commands[0]
+                status, result = await self._post(method, params)
+                if not future.done():
+                    future.set_result({'status': status, **result})
+                return
+
+            data = {'halt': 0}
+            for idx, (method, params, _) in enumerate(commands):
+                data[f'cmd[c{idx}]'] = f"{method}?{urlencode(params)}"
+
+            logger.info(f"Отправка batch из {len(commands)} команд")
+            status, result = await self._post('batch', data)
+        except Exception as e:
+            for _, _, future in commands:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if status != 200 or 'result' not in result:
+            # Ошибка всего запроса относится к каждой команде
+            for _, _, future in commands:
+                if not future.done():
+                    future.set_result({'status': status, **result})
+            return
+
+        results = result['result'].get('result') or {}
+        errors = result['result'].get('result_error') or {}
+        for idx, (_, _, future) in enumerate(commands):
+            key = f'c{idx}'
+            if future.done():
+                continue
+            if key in errors:
+                error = errors[key]
+                future.set_result({
+                    'status': status,
+                    'error': error.get('error', 'BATCH_ERROR'),
+                    'error_description': error.get('error_description', '')
+                })
+            elif key in results:
+                future.set_result({'status': status, 'result': results[key]})
+            else:
+                future.set_result({
+                    'status': status,
+                    'error': 'BATCH_ERROR',
+                    'error_description': 'Missing command result in batch response'
+                })
+
+
 class BitrixAPI:
-    @staticmethod
-    def _create_session():
-        session = requests.Session()
-        retry_strategy = Retry(
-            total=3,  # количество попыток
-            backoff_factor=1,  # время ожидания между попытками
-            status_forcelist=[500, 502, 503, 504]  # коды ошибок для повторных попыток
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        session.mount("http://", adapter)
-        session.mount("https://", adapter)
-        return session
-
-    @staticmethod
-    def create_task(task_type, data):
+    # Коды ошибок Bitrix24, после которых запрос имеет смысл повторить
+    RETRYABLE_ERRORS = {'QUERY_LIMIT_EXCEEDED', 'INTERNAL_SERVER_ERROR', 'OPERATION_TIME_LIMIT'}
+    # Тег задачи с номером заявки: по нему повторная доставка находит уже созданную задачу
+    TICKET_TAG = 'motbot-{}'
+
+    # Общий HTTP-клиент с пулом keep-alive соединений на весь процесс
+    _client = None
+    _batcher = None
+    _retry_policy = None
+    _breaker = None
+    _rate_limiter = None
+    # TrafficCapture для записи запросов, если запись трафика включена
+    capture = None
+
+    @classmethod
+    def _get_client(cls):
+        if cls._client is None or cls._client.is_closed:
+            cls._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(15, connect=5),
+                limits=httpx.Limits(
+                    max_connections=20,
+                    max_keepalive_connections=10,
+                    keepalive_expiry=60
+                )
+            )
+        return cls._client
+
+    @classmethod
+    def _get_retry_policy(cls):
+        if cls._retry_policy is None:
+            cls._retry_policy = RetryPolicy(
+                attempts=Config.BITRIX_RETRY_ATTEMPTS,
+                base_delay=Config.BITRIX_RETRY_BASE_DELAY,
+                max_delay=Config.BITRIX_RETRY_MAX_DELAY,
+                # Повторяем только запросы, которые не дошли до Bitrix24: после таймаута
+                # ответа или 5xx задача могла быть создана, такие повторы решает outbox
+                retry_on=(ThrottledError, httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout),
+                failure_on=(RetryableError, httpx.TransportError)
+            )
+        return cls._retry_policy
+
+    @classmethod
+    def _get_rate_limiter(cls):
+        if cls._rate_limiter is None:
+            cls._rate_limiter = TokenBucket(
+                rate=Config.BITRIX_RATE_LIMIT,
+                burst=Config.BITRIX_RATE_BURST
+            )
+        return cls._rate_limiter
+
+    @classmethod
+    def _get_breaker(cls):
+        if cls._breaker is None:
+            cls._breaker = CircuitBreaker(
+                'Bitrix24',
+                failure_threshold=Config.BITRIX_BREAKER_FAILURE_THRESHOLD,
+                reset_timeout=Config.BITRIX_BREAKER_RESET_TIMEOUT
+            )
+        return cls._breaker
+
+    @classmethod
+    def _get_batcher(cls):
+        if cls._batcher is None:
+            cls._batcher = BitrixBatcher(cls._post, window=Config.BITRIX_BATCH_WINDOW)
+        return cls._batcher
+
+    @classmethod
+    async def _post(cls, method, data):
+        """Единая точка отправки запросов в Bitrix24: возвращает (статус, JSON)
+
+        Запрос проходит через автомат размыкателя и повторяется с задержкой,
+        только если он не был отправлен (ошибка соединения) или Bitrix24
+        ответил QUERY_LIMIT_EXCEEDED. Пока автомат открыт, вызов сразу
+        завершается CircuitOpenError.
+        """
+        try:
+            return await cls._get_retry_policy().call(
+                cls._send, method, data, breaker=cls._get_breaker()
+            )
+        except (BitrixServerError, BitrixThrottledError) as e:
+            return e.status, e.body
+
+    @classmethod
+    def _observe_request(cls, method, status, duration):
+        BITRIX_LATENCY.labels(method).observe(duration)
+        BITRIX_REQUESTS.labels(method, status).inc()
+        if cls.capture is not None:
+            cls.capture.record_bitrix(method, status, duration)
+
+    @classmethod
+    async def _send(cls, method, data, limited=True):
+        """POST к порталу; limited=False - без токена TokenBucket (проверки состояния)"""
+        limiter = cls._get_rate_limiter()
+        if limited:
+            await limiter.acquire()
+
+        start_time = time.monotonic()
+        try:
+            response = await cls._get_client().post(f"{Config.BITRIX_WEBHOOK}{method}", data=data)
+        except httpx.HTTPError:
+            cls._observe_request(method, 'error', time.monotonic() - start_time)
+            raise
+        cls._observe_request(method, response.status_code, time.monotonic() - start_time)
+        logger.info(f"{method}: статус ответа {response.status_code}")
+
+        if response.status_code >= 400:
+            try:
+                body = response.json()
+            except ValueError:
+                body = {'error_description': response.text[:200]}
+            if body.get('error') == 'QUERY_LIMIT_EXCEEDED':
+                limiter.throttled()
+                raise BitrixThrottledError(response.status_code, body)
+            if response.status_code >= 500:
+                raise BitrixServerError(response.status_code, body)
+            return response.status_code, body
+
+        return response.status_code, response.json()
+
+    @classmethod
+    async def ping(cls):
+        """Лёгкий запрос к порталу без повторов; ошибка, если Bitrix24 недоступен
+
+        Проверка не занимает токены TokenBucket, иначе при очереди заявок она
+        ждала бы своей очереди и отнимала у них лимит. Ответ о превышении
+        лимита означает, что портал доступен.
+        """
+        if cls._get_breaker().state == CircuitBreaker.OPEN:
+            raise CircuitOpenError("Bitrix24: автомат размыкателя открыт")
+        try:
+            status, body = await cls._send('server.time', {}, limited=False)
+        except BitrixThrottledError:
+            return
+        if status >= 400:
+            raise BitrixServerError(status, body)
+
+    @classmethod
+    async def close(cls):
+        """Закрытие пула соединений"""
+        if cls._client is not None and not cls._client.is_closed:
+            await cls._client.aclose()
+            logger.info("Пул соединений Bitrix24 закрыт")
+        cls._client = None
+
+    @classmethod
+    def _build_task_params(cls, task_type, data, project_id, ticket_id=None):
+        # Формируем описание задачи
+        description = ""
+        if ticket_id is not None:
+            description += f"Заявка: #{ticket_id}\n"
+        description += f"Клиент: {data['client_code']}\n"
+        description += f"Маршрут: {data['route']}\n"
+
+        if task_type != 'info':
+            description += "\nТовары:\n"
+            for idx, item in enumerate(data['articles'], 1):
+                description += f"{idx}. Артикул: {item['article']}\n   Количество: {item['quantity']}\n"
+            description += f"\nДокумент: {data['document_number']}\n"
+
+        description += f"Комментарий: {data['comment']}"
+
+        # Формируем название задачи
+        title = data.get('title', Config.TASK_TITLES[task_type])
+        if task_type == 'claim':
+            title = f"Претензия {data.get('claim_type', '')}"
+
+        # Устанавливаем крайний срок в зависимости от типа задачи
+        now = datetime.now()
+
+        # По умолчанию 1 день для информационных задач, 3 дня для претензий и отказов
+        deadline = now + timedelta(days=Config.TASK_DEADLINE_DAYS.get(task_type, 3))
+
+        # Форматируем дату в формате, который ожидает Bitrix24
+        deadline_str = deadline.strftime('%Y-%m-%d %H:%M:%S')
+
+        logger.info(f"Название задачи: {title}")
+        logger.info("Описание задачи: %s", description, extra=PAYLOAD)
+        logger.info(f"Крайний срок: {deadline_str}")
+        logger.info(f"Ответственный: {Config.RESPONSIBLE_ID}")
+
+        params = {
+            "fields[TITLE]": title,
+            "fields[DESCRIPTION]": description,
+            "fields[RESPONSIBLE_ID]": int(Config.RESPONSIBLE_ID),
+            "fields[DEADLINE]": deadline_str,  # Крайний срок
+            "fields[GROUP_ID]": int(project_id)  # ID проекта
+        }
+        if ticket_id is not None:
+            params["fields[TAGS][0]"] = cls.TICKET_TAG.format(ticket_id)
+        return params
+
+    @classmethod
+    async def find_task(cls, ticket_id):
+        """Ищет задачу, созданную по заявке ticket_id
+
+        Возвращает {'success': True, 'task_id': ID или None} или
+        {'error': ..., 'retryable': True}, если проверить не удалось.
+        """
+        try:
+            reply = await cls._get_batcher().submit('tasks.task.list', {
+                'filter[TAG]': cls.TICKET_TAG.format(ticket_id),
+                'select[0]': 'ID'
+            })
+        except CircuitOpenError:
+            return {'error': 'Bitrix24 temporarily unavailable', 'retryable': True}
+        except httpx.HTTPError as e:
+            logger.error(f"Ошибка поиска задачи по заявке #{ticket_id}: {e!r}")
+            return {'error': 'Connection error', 'retryable': True}
+        except ValueError as e:
+            logger.error(f"Ошибка парсинга JSON при поиске задачи по заявке #{ticket_id}: {e}")
+            return {'error': 'Invalid response from server', 'retryable': True}
+
+        if reply.get('status', 200) != 200 or 'result' not in reply:
+            error_msg = reply.get('error_description') or reply.get('error', 'Unknown error')
+            logger.error(f"Ошибка поиска задачи по заявке #{ticket_id}: {error_msg}")
+            return {'error': f'Failed to find task: {error_msg}', 'retryable': True}
+
+        tasks = reply['result'].get('tasks') or []
+        return {'success': True, 'task_id': tasks[0]['id'] if tasks else None}
+
+    @classmethod
+    @sample_payloads
+    async def create_task(cls, task_type, data, ticket_id=None):
+        """Создаёт задачу; с ticket_id задача помечается тегом заявки для find_task"""
         try:
             # Получаем ID проекта для данного типа задачи
             project_id = Config.PROJECT_IDS.get(task_type)
@@ -35,107 +358,135 @@ class BitrixAPI:
             logger.info(f"=== Начало создания задачи ===")
             logger.info(f"Тип задачи: {task_type}")
             logger.info(f"ID проекта: {project_id}")
-            logger.info(f"Входные данные: {data}")
-
-            # Формируем описание задачи
-            description = ""
-            description += f"Клиент: {data['client_code']}\n"
-            description += f"Маршрут: {data['route']}\n"
-
-            if task_type != 'info':
-                description += "\nТовары:\n"
-                for idx, item in enumerate(data['articles'], 1):
-                    description += f"{idx}. Артикул: {item['article']}\n   Количество: {item['quantity']}\n"
-                description += f"\nДокумент: {data['document_number']}\n"
-
-            description += f"Комментарий: {data['comment']}"
-
-            # Формируем название задачи
-            title = data.get('title', Config.TASK_TITLES[task_type])
-            if task_type == 'claim':
-                title = f"Претензия {data.get('claim_type', '')}"
-
-            # Устанавливаем крайний срок в зависимости от типа задачи
-            now = datetime.now()
-            
-            if task_type == 'info':
-                deadline = now + timedelta(days=1)  # 1 день для информационных задач
-            else:
-                deadline = now + timedelta(days=3)   # 3 дня для претензий и отказов
-            
-            # Форматируем дату в формате, который ожидает Bitrix24
-            deadline_str = deadline.strftime('%Y-%m-%d %H:%M:%S')
-
-            logger.info(f"Название задачи: {title}")
-            logger.info(f"Описание задачи: {description}")
-            logger.info(f"Крайний срок: {deadline_str}")
-            logger.info(f"Ответственный: {Config.RESPONSIBLE_ID}")
-
-            # Создаем задачу
-            session = BitrixAPI._create_session()
-            start_time = time.time()
-            
+            logger.info("Входные данные: %s", data, extra=PAYLOAD)
+
+            params = cls._build_task_params(task_type, data, project_id, ticket_id)
+            logger.info("Параметры создания задачи: %s", params, extra=PAYLOAD)
+
+            start_time = time.monotonic()
+
             try:
-                # Создаем задачу
-                params = {
-                    "fields[TITLE]": title,
-                    "fields[DESCRIPTION]": description,
-                    "fields[RESPONSIBLE_ID]": int(Config.RESPONSIBLE_ID),
-                    "fields[DEADLINE]": deadline_str,  # Крайний срок
-                    "fields[GROUP_ID]": int(project_id)  # ID проекта
-                }
-
-                logger.info(f"Параметры создания задачи: {params}")
-
-                # Используем метод tasks.task.add для создания задачи
-                response = session.post(
-                    f"{Config.BITRIX_WEBHOOK}tasks.task.add",
-                    data=params,
-                    headers={'Content-Type': 'application/x-www-form-urlencoded'},
-                    timeout=15
-                )
-                
-                logger.info(f"Статус ответа: {response.status_code}")
-                logger.info(f"Ответ API: {response.text}")
-                
-                result = response.json()
-                
+                # Используем метод tasks.task.add; одновременные вызовы объединяются в batch
+                reply = await cls._get_batcher().submit('tasks.task.add', params)
+
                 # Логируем время выполнения запроса
-                execution_time = time.time() - start_time
+                execution_time = time.monotonic() - start_time
                 logger.info(f"Время создания задачи: {execution_time:.2f} секунд")
-                
-                if response.status_code == 200:
-                    if 'result' in result:
-                        task_id = result['result']['task']['id']
+                logger.info("Ответ API: %s", reply, extra=PAYLOAD)
+
+                status = reply.get('status', 200)
+                if status == 200:
+                    if 'result' in reply:
+                        task_id = reply['result']['task']['id']
                         logger.info(f"=== Задача успешно создана ===")
                         logger.info(f"ID задачи: {task_id}")
                         logger.info(f"Тип задачи: {task_type}")
                         logger.info(f"Проект: {project_id}")
                         return {'success': True, 'task_id': task_id}
-                    elif 'error' in result:
-                        error_msg = result['error']
+                    elif 'error' in reply:
+                        error_msg = reply['error']
                         logger.error(f"Ошибка API Битрикс24: {error_msg}")
-                        return {'error': f'Bitrix API error: {error_msg}'}
+                        return {
+                            'error': f'Bitrix API error: {error_msg}',
+                            'retryable': error_msg in BitrixAPI.RETRYABLE_ERRORS
+                        }
                     else:
-                        logger.error(f"Неожиданный формат ответа: {result}")
+                        logger.error(f"Неожиданный формат ответа: {reply}")
                         return {'error': 'Unexpected response format from Bitrix API'}
                 else:
-                    error_msg = result.get('error_description', 'Unknown error')
-                    logger.error(f"Ошибка создания задачи. Статус: {response.status_code}, Ошибка: {error_msg}")
-                    return {'error': f'Failed to create task: {error_msg}'}
+                    error_msg = reply.get('error_description', 'Unknown error')
+                    logger.error(f"Ошибка создания задачи. Статус: {status}, Ошибка: {error_msg}")
+                    return {
+                        'error': f'Failed to create task: {error_msg}',
+                        'retryable': status >= 500 or reply.get('error') in BitrixAPI.RETRYABLE_ERRORS
+                    }
 
-            except requests.exceptions.Timeout:
+            except CircuitOpenError:
+                logger.error("Bitrix24 недоступен, запрос отклонён без ожидания")
+                return {'error': 'Bitrix24 temporarily unavailable', 'retryable': True}
+            except httpx.TimeoutException:
                 logger.error("Таймаут запроса при создании задачи")
-                return {'error': 'Request timeout'}
-            except requests.exceptions.RequestException as e:
+                return {'error': 'Request timeout', 'retryable': True}
+            except httpx.HTTPError as e:
                 logger.error(f"Ошибка запроса: {str(e)}")
-                return {'error': 'Connection error'}
+                return {'error': 'Connection error', 'retryable': True}
             except ValueError as e:
                 logger.error(f"Ошибка парсинга JSON: {str(e)}")
-                return {'error': 'Invalid response from server'}
-            finally:
-                session.close()
+                return {'error': 'Invalid response from server', 'retryable': True}
 
         except Exception as e:
             logger.error(f"Непредвиденная ошибка при создании задачи: {str(e)}")
-            return {'error': 'Internal server error'}
\ No newline at end of file
+            return {'error': 'Internal server error'}
+
+    @classmethod
+    def _comment_mark(cls, ticket_id):
+        return f"({cls.TICKET_TAG.format(ticket_id)})"
+
+    @classmethod
+    async def find_comment(cls, task_id, ticket_id):
+        """Ищет комментарий к задаче task_id, добавленный по заявке ticket_id
+
+        Возвращает {'success': True, 'comment_id': ID или None} или
+        {'error': ..., 'retryable': True}, если проверить не удалось.
+        """
+        try:
+            reply = await cls._get_batcher().submit('task.commentitem.getlist', {'TASKID': int(task_id)})
+        except CircuitOpenError:
+            return {'error': 'Bitrix24 temporarily unavailable', 'retryable': True}
+        except httpx.HTTPError as e:
+            logger.error(f"Ошибка поиска комментария по заявке #{ticket_id}: {e!r}")
+            return {'error': 'Connection error', 'retryable': True}
+        except ValueError as e:
+            logger.error(f"Ошибка парсинга JSON при поиске комментария по заявке #{ticket_id}: {e}")
+            return {'error': 'Invalid response from server', 'retryable': True}
+
+        if reply.get('status', 200) != 200 or 'result' not in reply:
+            error_msg = reply.get('error_description') or reply.get('error', 'Unknown error')
+            logger.error(f"Ошибка поиска комментария по заявке #{ticket_id}: {error_msg}")
+            return {'error': f'Failed to find comment: {error_msg}', 'retryable': True}
+
+        mark = cls._comment_mark(ticket_id)
+        for comment in reply['result'] or []:
+            if mark in (comment.get('POST_MESSAGE') or ''):
+                return {'success': True, 'comment_id': comment.get('ID')}
+        return {'success': True, 'comment_id': None}
+
+    @classmethod
+    @sample_payloads
+    async def add_comment(cls, task_id, text, ticket_id=None):
+        """Добавляет комментарий к существующей задаче Bitrix24
+
+        С ticket_id в конец комментария добавляется метка заявки для find_comment.
+        """
+        if ticket_id is not None:
+            text = f"{text}\n{cls._comment_mark(ticket_id)}"
+        try:
+            reply = await cls._get_batcher().submit('task.commentitem.add', {
+                'TASKID': int(task_id),
+                'FIELDS[POST_MESSAGE]': text
+            })
+            logger.info("Ответ API на комментарий к задаче %s: %s", task_id, reply, extra=PAYLOAD)
+
+            status = reply.get('status', 200)
+            if status == 200 and 'result' in reply:
+                return {'success': True, 'comment_id': reply['result']}
+
+            error_msg = reply.get('error_description') or reply.get('error', 'Unknown error')
+            logger.error(f"Ошибка добавления комментария к задаче {task_id}. Статус: {status}, Ошибка: {error_msg}")
+            return {
+                'error': f'Failed to add comment: {error_msg}',
+                'retryable': status >= 500 or reply.get('error') in BitrixAPI.RETRYABLE_ERRORS
+            }
+
+        except CircuitOpenError:
+            logger.error("Bitrix24 недоступен, запрос отклонён без ожидания")
+            return {'error': 'Bitrix24 temporarily unavailable', 'retryable': True}
+        except httpx.TimeoutException:
+            logger.error(f"Таймаут запроса при добавлении комментария к задаче {task_id}")
+            return {'error': 'Request timeout', 'retryable': True}
+        except httpx.HTTPError as e:
+            logger.error(f"Ошибка запроса: {str(e)}")
+            return {'error': 'Connection error', 'retryable': True}
+        except Exception as e:
+            logger.error(f"Непредвиденная ошибка при добавлении комментария: {str(e)}")
+            return {'error': 'Internal server error'}
@@ -1,64 +1,101 @@
 import logging
 import json
-from telegram import Update, ReplyKeyboardMarkup
+import signal
+import sys
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
-    MessageHandler,
-    filters,
+    CallbackQueryHandler,
+    TypeHandler,
     ConversationHandler,
     ContextTypes
 )
-from config import Config
+from telegram.request import HTTPXRequest
+from config import Config, apply_config, load_reloadable_config
 from bitrix_api import BitrixAPI
 from database import Database
-from flask import Flask
-from threading import Thread, Lock
-import os
-import asyncio
-import sys
-from datetime import datetime
-import tempfile
-import signal
-import httpx
-
-# Создаем Flask приложение
-app = Flask(__name__)
-
-# Настройка логирования
-log_dir = os.path.join(tempfile.gettempdir(), 'bot_logs')
-os.makedirs(log_dir, exist_ok=True)
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(os.path.join(log_dir, f'bot_{datetime.now().strftime("%Y%m%d")}.log'), encoding='utf-8')
-    ]
+from outbox import COMMENT_TASK_TYPE, OutboxWorker
+from persistence import SqlitePersistence
+from checkpoint import CheckpointBot, UpdateCheckpoint
+from recorder import ActivityRecorder
+from directory import Directory
+from catalog import ArticleCatalog, parse_article_list
+from dedup import submission_fingerprint
+from scheduler import PerChatUpdateProcessor
+from flows import compile_flows
+from health import HealthMonitor, PollingRequest, Probe
+from capture import TrafficCapture
+from cluster import WorkerPool
+from metrics import (
+    add_collector, ACTIVE_CONVERSATIONS, BOT_RESTARTS, OUTBOX_PENDING, UPDATE_QUEUE_SIZE,
+    UPDATES_IN_PROGRESS, WORKER_PENDING, observe_update_lag, track_handler
 )
+import asyncio
 
 logger = logging.getLogger(__name__)
 
 # Глобальные переменные для контроля состояния бота
-bot_lock = Lock()
+bot_lock = asyncio.Lock()
 bot_instance = None
 stop_event = asyncio.Event()
+# Запрос перезапуска экземпляра бота от проверок состояния
+restart_event = asyncio.Event()
+# Запрос getUpdates текущего экземпляра: по нему считается отставание polling
+polling_request = None
 
 db = Database()
+outbox_worker = OutboxWorker(db)
+persistence = SqlitePersistence(db, update_interval=Config.PERSISTENCE_UPDATE_INTERVAL)
+update_checkpoint = UpdateCheckpoint(db, flush_interval=Config.PERSISTENCE_UPDATE_INTERVAL)
+recorder = ActivityRecorder(db, flush_interval=Config.RECORDER_FLUSH_INTERVAL)
+directory = Directory(
+    Config.DIRECTORY_PATH,
+    ttl=Config.DIRECTORY_TTL,
+    code_column=Config.DIRECTORY_CODE_COLUMN,
+    route_column=Config.DIRECTORY_ROUTE_COLUMN
+)
+capture = TrafficCapture(Config.CAPTURE_PATH, Config.CAPTURE_SALT) if Config.CAPTURE_PATH else None
+catalog = ArticleCatalog(
+    Config.CATALOG_PATH,
+    ttl=Config.CATALOG_TTL,
+    article_column=Config.CATALOG_ARTICLE_COLUMN
+)
 STATES = Config.STATES
+# Процессы-обработчики, если бот запущен с WORKERS > 0
+worker_pool = None
+
+
+def get_application():
+    """Текущий экземпляр Application или None, пока бот перезапускается"""
+    return bot_instance
+
+
+async def collect_metrics():
+    """Обновляет метрики, которые вычисляются в момент запроса"""
+    pending = await db.count_pending_outbox()
+    if pending is not None:
+        OUTBOX_PENDING.set(pending)
+    # Диалоги ведут и процессы-обработчики, поэтому счёт идёт по bot.db, а не по persistence
+    conversations = await db.count_conversations()
+    if conversations is not None:
+        ACTIVE_CONVERSATIONS.clear()
+        for name, count in conversations.items():
+            ACTIVE_CONVERSATIONS.labels(name).set(count)
+    application = bot_instance
+    UPDATE_QUEUE_SIZE.set(application.update_queue.qsize() if application is not None else 0)
+    UPDATES_IN_PROGRESS.set(
+        getattr(application.update_processor, 'chats_in_progress', 0) if application is not None else 0
+    )
+    if worker_pool is not None:
+        for shard, pending in worker_pool.pending_counts().items():
+            WORKER_PENDING.labels(str(shard)).set(pending)
 
-@app.route('/')
-def home():
-    return "Bot is running!"
 
-def run_flask():
-    try:
-        port = int(os.environ.get('PORT', 8080))
-        logger.info(f"Запуск Flask на порту {port}")
-        app.run(host='0.0.0.0', port=port)
-    except Exception as e:
-        logger.error(f"Ошибка Flask: {e}", exc_info=True)
+add_collector(collect_metrics)
+
 
 def main_menu():
     return ReplyKeyboardMarkup([
@@ -71,6 +108,21 @@ def cancel_button():
     return ReplyKeyboardMarkup([['❌ Отмена']], resize_keyboard=True)
 
 
+def articles_keyboard(articles):
+    return ReplyKeyboardMarkup(
+        [[article] for article in articles] + [['❌ Отмена']],
+        resize_keyboard=True
+    )
+
+
+ARTICLES_PROMPT = (
+    "📦 Введите артикул товара.\n"
+    "Можно прислать сразу список, по товару на строку: ART123 x5 или ART123;5"
+)
+# Сколько ошибок списка товаров показывать в одном ответе
+BULK_ARTICLES_MAX_ERRORS = 20
+
+
 def add_more_button():
     return ReplyKeyboardMarkup([
         ['➕ Добавить артикул', '➡ Продолжить'],
@@ -79,12 +131,50 @@ def add_more_button():
 
 
 def claim_type_keyboard():
-    return ReplyKeyboardMarkup([
-        ['Недовоз', 'Брак'],
-        ['Пересорт', '❌ Отмена']
-    ], resize_keyboard=True)
+    buttons = Config.CLAIM_TYPES + ['❌ Отмена']
+    return ReplyKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)], resize_keyboard=True)
 
 
+def suggestion_keyboard(suggestion):
+    return ReplyKeyboardMarkup([[suggestion], ['❌ Отмена']], resize_keyboard=True)
+
+
+async def check_client_code(update: Update, code):
+    """Проверяет код по справочнику клиентов и подсказывает ближайший"""
+    await directory.refresh()
+    if directory.is_valid_client_code(code):
+        return True
+
+    suggestion = directory.suggest_client_code(code)
+    if suggestion:
+        await update.message.reply_text(
+            f"❌ Клиент с кодом {code} не найден. Возможно, вы имели в виду {suggestion}?",
+            reply_markup=suggestion_keyboard(suggestion)
+        )
+    else:
+        await update.message.reply_text(f"❌ Клиент с кодом {code} не найден. Проверьте код.")
+    return False
+
+
+async def check_route(update: Update, route):
+    """Возвращает маршрут в написании справочника или None с подсказкой водителю"""
+    await directory.refresh()
+    found = directory.find_route(route)
+    if found is not None:
+        return found
+
+    suggestion = directory.suggest_route(route)
+    if suggestion:
+        await update.message.reply_text(
+            f"❌ Маршрут «{route}» не найден. Возможно, вы имели в виду «{suggestion}»?",
+            reply_markup=suggestion_keyboard(suggestion)
+        )
+    else:
+        await update.message.reply_text(f"❌ Маршрут «{route}» не найден. Проверьте название.")
+    return None
+
+
+@track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Добрый день! Выберите тип обращения:",
@@ -93,18 +183,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return STATES['START']
 
 
+@track_handler
 async def handle_refusal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     await update.message.reply_text("📋 Введите код клиента:", reply_markup=cancel_button())
     return STATES['CLIENT_CODE']
 
 
+@track_handler
 async def handle_claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     await update.message.reply_text("📋 Выберите тип претензии:", reply_markup=claim_type_keyboard())
     return STATES['CLAIM_TYPE']
 
 
+@track_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     await update.message.reply_text(
@@ -114,17 +207,8 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-async def check_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == '❌ Отмена':
-        return await cancel(update, context)
-    return None
-
-
+@track_handler
 async def process_client_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
-
     user = update.message.from_user
     code = update.message.text
 
@@ -132,36 +216,86 @@ async def process_client_code(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ Код должен содержать только цифры!")
         return STATES['CLIENT_CODE']
 
+    if not await check_client_code(update, code):
+        return STATES['CLIENT_CODE']
+
     context.user_data['client_code'] = code
-    await update.message.reply_text("📍 Введите маршрут:")
+    await update.message.reply_text("📍 Введите маршрут:", reply_markup=cancel_button())
     return STATES['ROUTE']
 
 
+@track_handler
 async def process_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
+    route = await check_route(update, update.message.text)
+    if route is None:
+        return STATES['ROUTE']
+
+    context.user_data['route'] = route
+    await update.message.reply_text(ARTICLES_PROMPT, reply_markup=cancel_button())
+    return STATES['ARTICLES']
 
-    context.user_data['route'] = update.message.text
-    await update.message.reply_text("📦 Введите артикул товара:")
+
+async def add_article_list(update: Update, context: ContextTypes.DEFAULT_TYPE, items, errors):
+    """Добавляет разобранный список товаров; строки с ошибками перечисляются в ответе"""
+    errors = list(errors)
+    added = []
+    for number, article, quantity in items:
+        found = catalog.find(article)
+        if found is None:
+            matches = catalog.search(article, limit=1)
+            hint = f", возможно {matches[0]}" if matches else ""
+            errors.append((number, article, f"нет в каталоге{hint}"))
+            continue
+        added.append({'article': found, 'quantity': str(quantity)})
+
+    context.user_data.setdefault('articles', []).extend(added)
+
+    lines = [f"✅ Добавлено товаров: {len(added)}"]
+    if errors:
+        errors.sort()
+        lines.append(f"❌ Не добавлены строки ({len(errors)}):")
+        lines.extend(
+            f"строка {number} «{line[:40]}»: {reason}" if line else f"строка {number}: {reason}"
+            for number, line, reason in errors[:BULK_ARTICLES_MAX_ERRORS]
+        )
+        if len(errors) > BULK_ARTICLES_MAX_ERRORS:
+            lines.append(f"...и ещё {len(errors) - BULK_ARTICLES_MAX_ERRORS}")
+        lines.append("Исправленные строки можно отправить следующим сообщением.")
+    lines.append("Добавить ещё артикул?")
+    await update.message.reply_text("\n".join(lines), reply_markup=add_more_button())
     return STATES['ARTICLES']
 
 
+@track_handler
 async def process_articles(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
+    text = update.message.text
+    await catalog.refresh()
+    # Артикул из каталога (и кнопка подсказки) списком не считается, даже если в нём есть « x» или «*»
+    if not catalog.contains(text):
+        parsed = parse_article_list(text, max_lines=Config.BULK_ARTICLES_MAX_LINES)
+        if parsed is not None:
+            return await add_article_list(update, context, *parsed)
+
+    article = catalog.find(text)
+    if article is None:
+        # Точного совпадения нет - предлагаем артикулы, начинающиеся с введённого
+        matches = catalog.search(text, limit=Config.CATALOG_SUGGESTIONS)
+        if matches:
+            await update.message.reply_text(
+                "🔎 Выберите артикул из каталога или уточните ввод:",
+                reply_markup=articles_keyboard(matches)
+            )
+        else:
+            await update.message.reply_text(f"❌ Артикул {text} не найден в каталоге. Проверьте ввод.")
+        return STATES['ARTICLES']
 
-    context.user_data['current_article'] = update.message.text
-    await update.message.reply_text("🔢 Введите количество:")
+    context.user_data['current_article'] = article
+    await update.message.reply_text("🔢 Введите количество:", reply_markup=cancel_button())
     return STATES['QUANTITY']
 
 
+@track_handler
 async def process_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
-
     quantity = update.message.text
 
     if not quantity.isdigit():
@@ -190,15 +324,12 @@ async def process_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return STATES['ARTICLES']
 
 
+@track_handler
 async def process_articles_or_continue(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
-
     choice = update.message.text
 
     if choice == '➕ Добавить артикул':
-        await update.message.reply_text("📦 Введите артикул товара:")
+        await update.message.reply_text(ARTICLES_PROMPT)
         return STATES['ARTICLES']
     elif choice == '➡ Продолжить':
         await update.message.reply_text("📄 Введите номер документа/УПД:")
@@ -209,21 +340,97 @@ async def process_articles_or_continue(update: Update, context: ContextTypes.DEF
         return STATES['QUANTITY']
 
 
+@track_handler
 async def process_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
-
     context.user_data['document_number'] = update.message.text
     await update.message.reply_text("📝 Введите комментарий:")
     return STATES['COMMENT']
 
 
-async def process_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
+async def submit_duplicate(update: Update, task_type, data, original_ticket_id, original_user_id):
+    """Повторная заявка: комментарий к задаче исходной или предупреждение водителю"""
+    user = update.effective_user
+    if original_user_id == user.id or Config.DEDUP_ACTION != 'comment':
+        await update.message.reply_text(
+            f"⚠️ Такая заявка уже зарегистрирована под номером #{original_ticket_id}. "
+            f"Повторная задача не создана.",
+            reply_markup=main_menu()
+        )
+        return
+
+    text = (
+        f"Повторное сообщение от водителя {user.full_name} (ID {user.id}).\n"
+        f"Комментарий: {data['comment']}"
+    )
+    ticket_id, created = await outbox_worker.enqueue(
+        user.id, update.effective_chat.id, COMMENT_TASK_TYPE,
+        {'ticket_id': original_ticket_id, 'text': text},
+        source_update_id=update.update_id
+    )
+    if ticket_id is None:
+        await update.message.reply_text(
+            f"⚠️ Такая заявка уже зарегистрирована другим водителем под номером #{original_ticket_id}.",
+            reply_markup=main_menu()
+        )
+        return
+
+    if created:
+        recorder.record_task(user.id, task_type, data, ticket_id=ticket_id)
+    await update.message.reply_text(
+        f"ℹ️ Такая заявка уже зарегистрирована другим водителем под номером #{original_ticket_id}.\n"
+        f"Ваше сообщение будет добавлено к ней комментарием, номер заявки: #{ticket_id}",
+        reply_markup=main_menu()
+    )
+
+
+async def submit_task(update: Update, context: ContextTypes.DEFAULT_TYPE, task_type, data):
+    """Ставит заявку в outbox и сразу отвечает водителю номером тикета"""
+    user_id = update.effective_user.id
+    fingerprint = submission_fingerprint(task_type, data)
+
+    if fingerprint is None:
+        ticket_id, created = await outbox_worker.enqueue(
+            user_id, update.effective_chat.id, task_type, data,
+            source_update_id=update.update_id
+        )
+    else:
+        # Повтор того же обновления Telegram дублем не считается: enqueue_unique вернёт его тикет
+        ticket_id, created, original = await outbox_worker.enqueue_unique(
+            user_id, update.effective_chat.id, task_type, data, fingerprint,
+            source_update_id=update.update_id
+        )
+        if original is not None:
+            await submit_duplicate(update, task_type, data, *original)
+            return
+
+    if ticket_id is not None:
+        if created:
+            recorder.record_task(user_id, task_type, data, ticket_id=ticket_id)
+        await update.message.reply_text(
+            f"✅ Заявка принята! Номер заявки: #{ticket_id}\n"
+            f"ID задачи в Битрикс24 придёт отдельным сообщением.",
+            reply_markup=main_menu()
+        )
+        return
+
+    # Не удалось сохранить заявку локально - создаём задачу напрямую
+    result = await BitrixAPI.create_task(task_type, data)
+
+    if result.get('success'):
+        recorder.record_task(user_id, task_type, data, bitrix_task_id=result['task_id'])
+        await update.message.reply_text(
+            f"✅ Задача создана! ID: {result['task_id']}",
+            reply_markup=main_menu()
+        )
+    else:
+        await update.message.reply_text(
+            f"❌ Ошибка: {result.get('error', 'Неизвестная ошибка')}",
+            reply_markup=main_menu()
+        )
+
 
+@track_handler
+async def process_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data = context.user_data
     user_data['comment'] = update.message.text
 
@@ -234,7 +441,7 @@ async def process_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if task_type == 'claim':
         task_title = f"Претензия {user_data['claim_type']}"
 
-    result = BitrixAPI.create_task(task_type, {
+    await submit_task(update, context, task_type, {
         'client_code': user_data['client_code'],
         'route': user_data['route'],
         'articles': user_data.get('articles', []),
@@ -244,24 +451,14 @@ async def process_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'title': task_title
     })
 
-    if result.get('success'):
-        await update.message.reply_text(
-            f"✅ Задача создана! ID: {result['task_id']}",
-            reply_markup=main_menu()
-        )
-    else:
-        await update.message.reply_text(
-            f"❌ Ошибка: {result.get('error', 'Неизвестная ошибка')}",
-            reply_markup=main_menu()
-        )
-
     context.user_data.clear()
     return ConversationHandler.END
 
 
+@track_handler
 async def process_claim_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     claim_type = update.message.text
-    if claim_type not in ['Недовоз', 'Брак', 'Пересорт']:
+    if claim_type not in Config.CLAIM_TYPES:
         await update.message.reply_text("❌ Выберите тип претензии из списка!", reply_markup=claim_type_keyboard())
         return STATES['CLAIM_TYPE']
     
@@ -270,104 +467,331 @@ async def process_claim_type(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return STATES['CLIENT_CODE']
 
 
+@track_handler
 async def handle_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     await update.message.reply_text("📋 Введите код клиента:", reply_markup=cancel_button())
     return STATES['INFO_CLIENT_CODE']
 
 
+@track_handler
 async def process_info_client_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
-
     code = update.message.text
     if not code.isdigit():
         await update.message.reply_text("❌ Код должен содержать только цифры!")
         return STATES['INFO_CLIENT_CODE']
 
+    if not await check_client_code(update, code):
+        return STATES['INFO_CLIENT_CODE']
+
     context.user_data['client_code'] = code
-    await update.message.reply_text("📍 Введите маршрут:")
+    await update.message.reply_text("📍 Введите маршрут:", reply_markup=cancel_button())
     return STATES['INFO_ROUTE']
 
 
+@track_handler
 async def process_info_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
+    route = await check_route(update, update.message.text)
+    if route is None:
+        return STATES['INFO_ROUTE']
 
-    context.user_data['route'] = update.message.text
-    await update.message.reply_text("📝 Введите комментарий:")
+    context.user_data['route'] = route
+    await update.message.reply_text("📝 Введите комментарий:", reply_markup=cancel_button())
     return STATES['INFO_COMMENT']
 
 
+@track_handler
 async def process_info_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cancel_result = await check_cancel(update, context)
-    if cancel_result is not None:
-        return cancel_result
-
     user_data = context.user_data
     user_data['comment'] = update.message.text
 
-    result = BitrixAPI.create_task('info', {
+    await submit_task(update, context, 'info', {
         'client_code': user_data['client_code'],
         'route': user_data['route'],
         'comment': user_data['comment'],
         'title': 'Информация от водителя'
     })
 
-    if result.get('success'):
-        await update.message.reply_text(
-            f"✅ Задача создана! ID: {result['task_id']}",
-            reply_markup=main_menu()
-        )
-    else:
-        await update.message.reply_text(
-            f"❌ Ошибка: {result.get('error', 'Неизвестная ошибка')}",
-            reply_markup=main_menu()
-        )
-
     context.user_data.clear()
     return ConversationHandler.END
 
 
-async def check_bot_health():
-    """Проверка состояния бота"""
-    global bot_instance
-    while not stop_event.is_set():
-        try:
-            if bot_instance is not None:
-                # Проверяем соединение с Telegram API
-                try:
-                    await bot_instance.bot.get_me()
-                    logger.info("Проверка состояния бота: OK")
-                except Exception as e:
-                    logger.error(f"Ошибка при проверке состояния бота: {e}")
-                    # Перезапускаем бота при ошибке
-                    with bot_lock:
-                        try:
-                            await bot_instance.stop()
-                            await bot_instance.shutdown()
-                        except Exception as stop_error:
-                            logger.error(f"Ошибка при остановке бота: {stop_error}")
-                        bot_instance = None
-            await asyncio.sleep(60)  # Проверка каждую минуту
-        except Exception as e:
-            logger.error(f"Ошибка в проверке состояния бота: {e}")
-            await asyncio.sleep(60)
+HISTORY_PAGE_SIZE = 10
+# None - часовой пояс сервера
+HISTORY_TIMEZONE = ZoneInfo(Config.TIMEZONE) if Config.TIMEZONE else None
+
+
+def format_created_at(created_at):
+    """Время из tasks.created_at (UTC, как CURRENT_TIMESTAMP) в часовом поясе TIMEZONE"""
+    try:
+        moment = datetime.fromisoformat(created_at).replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return created_at
+    return moment.astimezone(HISTORY_TIMEZONE).strftime('%Y-%m-%d %H:%M')
+
+
+async def render_history_page(user_id, before=None):
+    """Текст и клавиатура страницы истории обращений пользователя"""
+    rows = await db.get_user_tasks(user_id, limit=HISTORY_PAGE_SIZE + 1, before=before)
+    has_more = len(rows) > HISTORY_PAGE_SIZE
+    rows = rows[:HISTORY_PAGE_SIZE]
+
+    if not rows:
+        return "📭 Обращений пока нет." if before is None else "📭 Более ранних обращений нет.", None
+
+    lines = ["📜 История обращений:\n"]
+    for task_id, ticket_id, bitrix_task_id, task_type, title, claim_type, client_code, route, document_number, created_at in rows:
+        line = f"• {format_created_at(created_at)} — {title or Config.TASK_TITLES.get(task_type, task_type)}"
+        line += f"\n   Клиент: {client_code}, маршрут: {route}"
+        if document_number:
+            line += f", документ: {document_number}"
+        if ticket_id:
+            line += f"\n   Заявка #{ticket_id}"
+        line += f", задача Bitrix24: {bitrix_task_id}" if bitrix_task_id else ", задача Bitrix24 ещё создаётся"
+        lines.append(line)
+
+    keyboard = None
+    if has_more:
+        last_created_at, last_task_id = rows[-1][9], rows[-1][0]
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("⬅️ Ранее", callback_data=f"history:{last_created_at}|{last_task_id}")
+        ]])
+    return "\n".join(lines), keyboard
+
+
+@track_handler
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text, keyboard = await render_history_page(update.effective_user.id)
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+
+@track_handler
+async def history_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    created_at, task_id = query.data[len('history:'):].rsplit('|', 1)
+    text, keyboard = await render_history_page(update.effective_user.id, before=(created_at, int(task_id)))
+    await query.edit_message_text(text, reply_markup=keyboard)
+
+
+# Диалоги: кнопка главного меню -> (обработчик входа, шаги диалога из config.py)
+FLOWS = {
+    '🚫 Отказ': (handle_refusal, Config.REFUSAL_STATES),
+    '⚠️ Претензия': (handle_claim, Config.CLAIM_STATES),
+    'ℹ️ Информация': (handle_info, Config.INFO_STATES),
+}
+
+# Шаги: ({точный текст кнопки: обработчик}, обработчик остального текста)
+STEPS = {
+    'CLAIM_TYPE': ({}, process_claim_type),
+    'CLIENT_CODE': ({}, process_client_code),
+    'ROUTE': ({}, process_route),
+    'ARTICLES': ({
+        '➕ Добавить артикул': process_articles_or_continue,
+        '➡ Продолжить': process_articles_or_continue
+    }, process_articles),
+    'QUANTITY': ({}, process_quantity),
+    'DOCUMENT_NUMBER': ({}, process_document),
+    'COMMENT': ({}, process_comment),
+    'INFO_CLIENT_CODE': ({}, process_info_client_code),
+    'INFO_ROUTE': ({}, process_info_route),
+    'INFO_COMMENT': ({}, process_info_comment),
+}
+
+# Собирается один раз и переиспользуется всеми экземплярами Application
+driver_conversation = compile_flows(
+    'driver_conversation',
+    FLOWS,
+    STEPS,
+    common_buttons={'❌ Отмена': cancel},
+    fallbacks=[CommandHandler('cancel', cancel)]
+)
 
-async def main():
+
+def register_handlers(application):
+    """Регистрирует диалоги и служебные обработчики в приложении"""
+    if capture is not None:
+        application.add_handler(TypeHandler(Update, capture.record_update), group=-3)
+    application.add_handler(TypeHandler(Update, observe_update_lag), group=-2)
+    # Повторно доставленные обновления отбрасываются до обработки
+    application.add_handler(TypeHandler(Update, update_checkpoint.skip_processed), group=-1)
+    application.add_handler(driver_conversation)
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('history', history))
+    application.add_handler(CallbackQueryHandler(history_page, pattern=r'^history:'))
+    application.add_handler(TypeHandler(Update, recorder.record_first_contact), group=2)
+    application.add_error_handler(error_handler)
+
+
+def new_polling_request():
+    global polling_request
+    polling_request = PollingRequest(http_version="1.1")
+    return polling_request
+
+
+def new_polling_bot():
+    """Бот для long polling: Telegram подтверждаются только обработанные обновления"""
+    return CheckpointBot(
+        update_checkpoint,
+        Config.BOT_TOKEN,
+        request=HTTPXRequest(connection_pool_size=256, http_version="1.1"),
+        get_updates_request=new_polling_request()
+    )
+
+
+async def save_state(application):
+    """Записывает в bot.db состояния диалогов и user_data приложения; False при ошибке"""
+    await application.update_persistence()
+    return await persistence.flush()
+
+
+def build_application(bot=None, updater=True, on_processed=None):
+    """Создаёт приложение с persistence, планировщиком чатов и всеми обработчиками
+
+    bot - готовый экземпляр Bot вместо подключения по BOT_TOKEN (для нагрузочных тестов).
+    updater=False - обновления кладутся в update_queue извне (процесс-обработчик).
+    """
+    def update_processed(update):
+        update_checkpoint.record_processed(update)
+        if on_processed is not None:
+            on_processed(update)
+
+    builder = (
+        ApplicationBuilder()
+        .persistence(persistence)
+        .concurrent_updates(PerChatUpdateProcessor(Config.MAX_CONCURRENT_UPDATES, on_processed=update_processed))
+    )
+    if bot is None:
+        if updater:
+            builder = builder.bot(new_polling_bot())
+        else:
+            builder = builder.token(Config.BOT_TOKEN).http_version("1.1").updater(None)
+    else:
+        builder = builder.bot(bot).updater(None)
+    application = builder.build()
+    register_handlers(application)
+    # Обработанные обновления записываются только после состояний их диалогов
+    update_checkpoint.before_flush = lambda: save_state(application)
+    return application
+
+
+def build_ingress_application(pool):
+    """Приложение процесса-приёмника: получает обновления и передаёт их обработчикам pool"""
+    application = ApplicationBuilder().bot(new_polling_bot()).build()
+    if capture is not None:
+        application.add_handler(TypeHandler(Update, capture.record_update), group=-3)
+    application.add_handler(TypeHandler(Update, observe_update_lag), group=-2)
+    application.add_handler(TypeHandler(Update, pool.route))
+    application.add_error_handler(error_handler)
+    return application
+
+
+async def start_services(deliver_outbox=True):
+    """Запускает фоновые службы, не зависящие от экземпляра бота
+
+    deliver_outbox=False - заявки доставляет другой процесс (процесс-обработчик).
+    """
+    # Запускаем доставку заявок из outbox в Bitrix24
+    if deliver_outbox:
+        outbox_worker.start()
+    update_checkpoint.start()
+    recorder.start()
+    if capture is not None:
+        BitrixAPI.capture = capture
+        capture.start()
+
+    # Загружаем справочник клиентов и маршрутов
+    await directory.refresh()
+    await catalog.refresh()
+
+
+async def stop_services():
+    # Останавливаем доставку заявок и закрываем пул соединений с Bitrix24
+    await outbox_worker.stop()
+    await update_checkpoint.stop()
+    await recorder.stop()
+    if capture is not None:
+        await capture.stop()
+    await BitrixAPI.close()
+
+    # Дожидаемся записи очереди базы данных
+    await asyncio.to_thread(db.close)
+
+
+def request_restart(reason):
+    """Просит основной цикл корректно перезапустить экземпляр бота"""
+    logger.warning(f"Запрошен перезапуск бота: {reason}")
+    restart_event.set()
+
+
+async def probe_telegram():
+    application = bot_instance
+    if application is None:
+        raise RuntimeError("Бот не запущен")
+    await application.bot.get_me()
+
+
+async def probe_polling():
+    if polling_request is not None and polling_request.lag > Config.HEALTH_MAX_POLLING_LAG:
+        raise RuntimeError(f"getUpdates не отвечает {polling_request.lag:.0f} с")
+
+
+def bot_ready():
+    return bot_instance is not None and bot_instance.running
+
+
+async def health_details():
+    details = {
+        'polling_lag': round(polling_request.lag, 1)
+        if polling_request is not None and Config.BOT_MODE != 'webhook' else None,
+        'outbox_pending': await db.count_pending_outbox(),
+    }
+    if worker_pool is not None:
+        details['worker_pending'] = sum(worker_pool.pending_counts().values())
+    return details
+
+
+def create_health_monitor():
+    """Проверки Telegram, Bitrix24 и базы данных с общими порогами из Config"""
+    monitor = HealthMonitor(ready=bot_ready, details=health_details, on_restart=request_restart)
+    thresholds = {
+        'interval': Config.HEALTH_CHECK_INTERVAL,
+        'timeout': Config.HEALTH_PROBE_TIMEOUT,
+        'failure_threshold': Config.HEALTH_FAILURE_THRESHOLD,
+        'recovery_threshold': Config.HEALTH_RECOVERY_THRESHOLD,
+    }
+    monitor.add_probe(Probe('telegram', probe_telegram, **thresholds))
+    monitor.add_probe(Probe('database', db.ping, **thresholds))
+    # Пока Bitrix24 недоступен, заявки копятся в outbox - бот продолжает работать
+    monitor.add_probe(Probe('bitrix', BitrixAPI.ping, critical=False, **thresholds))
+    if Config.BOT_MODE != 'webhook':
+        # Перезапуск нужен, только если polling остановился надолго, а не при сбое get_me
+        monitor.add_probe(Probe('polling', probe_polling, restart_after=Config.HEALTH_RESTART_AFTER, **thresholds))
+        if Config.KEEP_ALIVE_URL:
+            monitor.add_probe(Probe(
+                'keep_alive', monitor.url_check(Config.KEEP_ALIVE_URL), critical=False,
+                **{**thresholds, 'interval': Config.KEEP_ALIVE_INTERVAL}
+            ))
+    return monitor
+
+
+health_monitor = create_health_monitor()
+
+
+async def main(application_factory=build_application):
     global bot_instance, stop_event
-    
-    # Запускаем проверку состояния бота
-    health_check_task = asyncio.create_task(check_bot_health())
+
+    # Запускаем проверки состояния бота и зависимостей
+    health_monitor.start()
+
+    await start_services()
     
     retry_count = 0
     max_retries = 5
     
     while not stop_event.is_set():
         try:
-            with bot_lock:
+            async with bot_lock:
                 if bot_instance is not None:
                     logger.info("Останавливаем предыдущий экземпляр бота...")
                     try:
@@ -379,109 +803,71 @@ async def main():
                     await asyncio.sleep(2)  # Даем время на завершение
 
                 logger.info("Инициализация нового экземпляра бота...")
-                # Создаем HTTP-клиент перед инициализацией бота
-                async with httpx.AsyncClient() as client:
-                    application = (
-                        ApplicationBuilder()
-                        .token(Config.BOT_TOKEN)
-                        .http_version("1.1")
-                        .get_updates_http_version("1.1")
-                        .build()
-                    )
-
-                    # Настройка обработчиков
-                    refusal_conv = ConversationHandler(
-                        entry_points=[MessageHandler(filters.Regex(r'^🚫 Отказ$'), handle_refusal)],
-                        states={
-                            STATES['CLIENT_CODE']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_client_code)],
-                            STATES['ROUTE']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_route)],
-                            STATES['ARTICLES']: [
-                                MessageHandler(filters.Regex(r'^(➕ Добавить артикул|➡ Продолжить)$'), process_articles_or_continue),
-                                MessageHandler(filters.TEXT & ~filters.COMMAND, process_articles)
-                            ],
-                            STATES['QUANTITY']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_quantity)],
-                            STATES['DOCUMENT_NUMBER']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_document)],
-                            STATES['COMMENT']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_comment)]
-                        },
-                        fallbacks=[CommandHandler('cancel', cancel)],
-                        name='refusal_conversation',
-                        persistent=False
-                    )
-
-                    claim_conv = ConversationHandler(
-                        entry_points=[MessageHandler(filters.Regex(r'^⚠️ Претензия$'), handle_claim)],
-                        states={
-                            STATES['CLAIM_TYPE']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_claim_type)],
-                            STATES['CLIENT_CODE']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_client_code)],
-                            STATES['ROUTE']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_route)],
-                            STATES['ARTICLES']: [
-                                MessageHandler(filters.Regex(r'^(➕ Добавить артикул|➡ Продолжить)$'), process_articles_or_continue),
-                                MessageHandler(filters.TEXT & ~filters.COMMAND, process_articles)
-                            ],
-                            STATES['QUANTITY']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_quantity)],
-                            STATES['DOCUMENT_NUMBER']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_document)],
-                            STATES['COMMENT']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_comment)]
-                        },
-                        fallbacks=[CommandHandler('cancel', cancel)],
-                        name='claim_conversation',
-                        persistent=False
-                    )
-
-                    info_conv = ConversationHandler(
-                        entry_points=[MessageHandler(filters.Regex(r'^ℹ️ Информация$'), handle_info)],
-                        states={
-                            STATES['INFO_CLIENT_CODE']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_info_client_code)],
-                            STATES['INFO_ROUTE']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_info_route)],
-                            STATES['INFO_COMMENT']: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_info_comment)]
-                        },
-                        fallbacks=[CommandHandler('cancel', cancel)],
-                        name='info_conversation',
-                        persistent=False
-                    )
-
-                    application.add_handler(refusal_conv)
-                    application.add_handler(claim_conv)
-                    application.add_handler(info_conv)
-                    application.add_handler(CommandHandler('start', start))
-                    application.add_error_handler(error_handler)
-
-                    bot_instance = application
-                    logger.info("Бот успешно инициализирован")
+                application = application_factory()
+                bot_instance = application
+                # Новый экземпляр выполняет и ранее запрошенный перезапуск
+                restart_event.clear()
+                logger.info("Бот успешно инициализирован")
 
                 # Запускаем бота
                 try:
                     await application.initialize()
                     await application.start()
-                    await application.updater.start_polling(
-                        drop_pending_updates=True,
-                        allowed_updates=Update.ALL_TYPES,
-                        pool_timeout=30,
-                        read_timeout=30,
-                        write_timeout=30,
-                        connect_timeout=30
-                    )
+                    if Config.BOT_MODE == 'webhook':
+                        if not Config.WEBHOOK_URL:
+                            raise ValueError("Для режима webhook необходимо задать WEBHOOK_URL")
+                        webhook_url = f"{Config.WEBHOOK_URL.rstrip('/')}{Config.WEBHOOK_PATH}"
+                        await application.bot.set_webhook(
+                            url=webhook_url,
+                            secret_token=Config.WEBHOOK_SECRET,
+                            allowed_updates=Update.ALL_TYPES,
+                            drop_pending_updates=False
+                        )
+                        logger.info(f"Вебхук установлен: {webhook_url}")
+                    else:
+                        await application.updater.start_polling(
+                            drop_pending_updates=False,
+                            allowed_updates=Update.ALL_TYPES,
+                            pool_timeout=30,
+                            read_timeout=30,
+                            write_timeout=30,
+                            connect_timeout=30
+                        )
                 
+                    # Бот запущен - outbox может уведомлять водителей
+                    outbox_worker.bot = application.bot
+
                     # Сбрасываем счетчик попыток при успешном запуске
                     retry_count = 0
                     
-                    # Ждем сигнала остановки
-                    while not stop_event.is_set():
+                    # Ждем сигнала остановки или запроса перезапуска
+                    while not stop_event.is_set() and not restart_event.is_set():
                         try:
                             await asyncio.sleep(1)
                         except asyncio.CancelledError:
                             logger.info("Получен сигнал отмены, начинаем корректное завершение работы...")
                             break
 
+                    if restart_event.is_set() and not stop_event.is_set():
+                        # Перезапуск после обработки уже полученных обновлений: диалоги не теряются
+                        logger.info("Перезапускаем экземпляр бота по результатам проверки состояния")
+                        BOT_RESTARTS.labels('health_check').inc()
+
                     # Корректное завершение работы
+                    outbox_worker.bot = None
                     try:
-                        await application.updater.stop()
+                        if application.updater is not None and application.updater.running:
+                            await application.updater.stop()
                         await application.stop()
                         await application.shutdown()
                         logger.info("Бот успешно остановлен")
                     except Exception as e:
                         logger.error(f"Ошибка при остановке бота: {e}", exc_info=True)
+                    bot_instance = None
                 except Exception as e:
                     logger.error(f"Ошибка при запуске бота: {e}", exc_info=True)
+                    BOT_RESTARTS.labels('start_error').inc()
+                    outbox_worker.bot = None
                     if bot_instance is not None:
                         try:
                             await bot_instance.stop()
@@ -507,20 +893,126 @@ async def main():
             break
         except Exception as e:
             logger.error(f"Критическая ошибка в работе бота: {e}", exc_info=True)
+            BOT_RESTARTS.labels('crash').inc()
             logger.info("Попытка переподключения через 5 секунд...")
             await asyncio.sleep(5)
     
-    # Отменяем задачу проверки состояния
-    health_check_task.cancel()
+    # Останавливаем проверки состояния
+    await health_monitor.stop()
+
+    await stop_services()
+
+async def reload_config():
+    """Перечитывает изменяемые параметры и подменяет их, не останавливая бота
+
+    ValueError, если новые значения не прошли проверку: тогда действуют
+    прежние. Процессам-обработчикам передаётся SIGHUP, чтобы они
+    перечитали конфигурацию сами.
+    """
+    values = await asyncio.to_thread(load_reloadable_config)
+    changed = apply_config(values)
+    if changed:
+        logger.info(f"Конфигурация обновлена: {', '.join(changed)}")
+    else:
+        logger.info("Конфигурация перечитана, изменений нет")
+    if worker_pool is not None and hasattr(signal, 'SIGHUP'):
+        worker_pool.send_signal(signal.SIGHUP)
+    return changed
+
+
+async def reload_config_on_signal():
     try:
-        await health_check_task
-    except asyncio.CancelledError:
-        pass
+        await reload_config()
+    except ValueError as e:
+        logger.error(f"Новая конфигурация отклонена: {e}")
+
+
+async def run_ingress():
+    """Процесс-приёмник: получает обновления и распределяет их по WORKERS процессам
+
+    Сам приёмник только маршрутизирует обновления и доставляет заявки из
+    outbox, диалоги ведут процессы-обработчики (worker.py).
+    """
+    global worker_pool
+    worker_pool = WorkerPool(
+        Config.WORKERS,
+        on_wakeup=outbox_worker.wakeup,
+        on_ack=update_checkpoint.release,
+        stop_timeout=Config.WORKER_STOP_TIMEOUT
+    )
+    await worker_pool.start()
+    logger.info(f"Запущено процессов-обработчиков: {Config.WORKERS}")
+    try:
+        await main(lambda: build_ingress_application(worker_pool))
+    finally:
+        await worker_pool.stop()
+
+
+async def run_worker(shard):
+    """Процесс-обработчик шарда shard: обновления приходят строками JSON в stdin
+
+    Обработанные обновления подтверждаются в stdout, только когда состояния
+    диалогов и контрольная точка записаны в bot.db. Закрытие stdin
+    приёмником - сигнал дообработать очередь и завершиться.
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    def send(message):
+        sys.stdout.write(json.dumps(message) + '\n')
+        sys.stdout.flush()
+
+    processed = []
+
+    async def acknowledge():
+        if not processed:
+            return
+        update_ids = processed[:]
+        del processed[:]
+        if not await save_state(application):
+            processed[:0] = update_ids
+            return
+        await update_checkpoint.flush()
+        send({'ack': update_ids})
+
+    async def acknowledge_periodically():
+        while True:
+            await asyncio.sleep(Config.WORKER_ACK_INTERVAL)
+            try:
+                await acknowledge()
+            except Exception as e:
+                logger.error(f"Ошибка при подтверждении обновлений: {e}", exc_info=True)
+
+    # Доставкой заявок занимается приёмник, его нужно только разбудить
+    outbox_worker.on_enqueue = lambda: send({'wakeup': 'outbox'})
+    await start_services(deliver_outbox=False)
+    application = build_application(updater=False, on_processed=lambda update: processed.append(update.update_id))
+    await application.initialize()
+    await application.start()
+    ack_task = asyncio.create_task(acknowledge_periodically())
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(reload_config_on_signal()))
+    logger.info(f"Обработчик {shard} готов")
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            await application.update_queue.put(Update.de_json(json.loads(line), application.bot))
+        logger.info(f"Обработчик {shard}: приёмник закрыл канал, завершаем работу")
+    finally:
+        await application.stop()
+        ack_task.cancel()
+        try:
+            await ack_task
+        except asyncio.CancelledError:
+            pass
+        await acknowledge()
+        await application.shutdown()
+        await stop_services()
 
-def handle_signal(signum, frame):
-    """Обработчик сигналов завершения"""
-    logger.info(f"Получен сигнал завершения {signum}")
-    stop_event.set()
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ошибок бота"""
@@ -532,17 +1024,3 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             )
     except Exception as e:
         logger.error(f"Ошибка при отправке сообщения об ошибке: {e}", exc_info=True)
-
-if __name__ == '__main__':
-    # Регистрируем обработчики сигналов
-    signal.signal(signal.SIGTERM, handle_signal)
-    signal.signal(signal.SIGINT, handle_signal)
-    
-    try:
-        logger.info("Запуск бота...")
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        logger.info("Бот остановлен пользователем")
-    except Exception as e:
-        logger.error(f"Критическая ошибка при запуске бота: {e}", exc_info=True)
-        sys.exit(1)
\ No newline at end of file
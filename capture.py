@@ -0,0 +1,125 @@
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Поля с персональными данными, которые в запись не попадают; first_name обязателен
+# для User, поэтому заменяется
+PERSONAL_FIELDS = {'last_name', 'username', 'phone_number', 'language_code'}
+# Объекты Telegram, поле id которых - идентификатор пользователя или чата
+ID_OBJECTS = {'from', 'chat', 'user', 'sender_chat', 'forward_from', 'forward_from_chat'}
+
+
+class TrafficCapture:
+    """Запись входящих обновлений и запросов к Bitrix24 для последующего воспроизведения
+
+    Записи - строки JSON с временем получения. Они копятся в памяти и раз
+    в flush_interval секунд сжимаются и дописываются в файл отдельным
+    членом gzip, поэтому файл только растёт и читается gzip.open целиком.
+    Идентификаторы пользователей и чатов заменяются HMAC с солью, имена
+    заменяются, фамилии, логины и телефоны удаляются. От запросов к Bitrix24 сохраняются только метод,
+    статус и длительность.
+    """
+
+    def __init__(self, path, salt, flush_interval=2, max_buffer=1000):
+        self.path = path
+        self._salt = salt.encode('utf-8')
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._records = []
+        self._task = None
+        self._flush_requested = None
+
+    def anonymize_id(self, value):
+        digest = hmac.new(self._salt, str(value).encode('utf-8'), hashlib.sha256).hexdigest()
+        # Положительное число в пределах int64, как настоящие id Telegram
+        return int(digest[:12], 16)
+
+    def _anonymize(self, value, key=None):
+        if isinstance(value, dict):
+            result = {}
+            for field, item in value.items():
+                if field in PERSONAL_FIELDS:
+                    continue
+                if field == 'first_name':
+                    result[field] = 'Driver'
+                elif field == 'id' and key in ID_OBJECTS:
+                    result[field] = self.anonymize_id(item)
+                else:
+                    result[field] = self._anonymize(item, field)
+            return result
+        if isinstance(value, list):
+            return [self._anonymize(item, key) for item in value]
+        return value
+
+    async def record_update(self, update, context):
+        """Обработчик первой группы: записывает входящее обновление"""
+        self._append({'t': time.time(), 'type': 'update', 'update': self._anonymize(update.to_dict())})
+
+    def record_bitrix(self, method, status, duration):
+        self._append({'t': time.time(), 'type': 'bitrix', 'method': method, 'status': status, 'duration': duration})
+
+    def _append(self, record):
+        self._records.append(record)
+        if len(self._records) >= self.max_buffer and self._flush_requested is not None:
+            self._flush_requested.set()
+
+    def _write(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(gzip.compress(data))
+
+    async def flush(self):
+        if not self._records:
+            return
+        records, self._records = self._records, []
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+        try:
+            await asyncio.to_thread(self._write, data)
+        except OSError as e:
+            logger.error(f"Ошибка записи трафика в {self.path}: {e}")
+            self._records = records + self._records
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._flush_requested = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Запись трафика в {self.path} включена")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при записи трафика: {e}", exc_info=True)
+
+
+def read_capture(path):
+    """Записи файла трафика по порядку; обрезанный хвост после сбоя пропускается"""
+    records = []
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                records.append(json.loads(line))
+    except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+        logger.warning(f"Файл {path} прочитан не полностью: {e}")
+    return records
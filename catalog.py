@@ -0,0 +1,174 @@
+import asyncio
+import csv
+import logging
+import os
+import re
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Разделители строки списка «артикул - количество»: «;», табуляция (копирование из
+# таблицы), «x»/«х»/«×» после пробела или «*»
+EXPLICIT_SEPARATOR_RE = re.compile(r'^(?P<article>.*?\S)\s*(?:[;\t]|\s[xXхХ×]|\*)\s*(?P<quantity>\S*)$')
+# В многострочном списке количество может идти через пробел
+SPACE_SEPARATOR_RE = re.compile(r'^(?P<article>.*?\S)\s+(?P<quantity>\S+)$')
+QUANTITY_UNIT_RE = re.compile(r'(?<=\d)\s*(?:шт|pcs)\.?$', re.IGNORECASE)
+
+
+def normalize_article(article):
+    return ''.join(article.upper().split())
+
+
+def _split_article_line(line, allow_space):
+    line = QUANTITY_UNIT_RE.sub('', line.strip())
+    match = EXPLICIT_SEPARATOR_RE.match(line)
+    if match is None and allow_space:
+        match = SPACE_SEPARATOR_RE.match(line)
+    if match is None:
+        return None
+    return match.group('article').strip(), match.group('quantity')
+
+
+def parse_article_list(text, max_lines=200):
+    """Разбор списка товаров из одного сообщения
+
+    Каждая строка - артикул и количество: «ART123 x5», «ART123;5»,
+    «ART123<Tab>5», в многострочном списке также «ART123 5». Одна строка
+    считается списком, только если после разделителя стоит число, иначе
+    возвращается None - это обычный ввод одного артикула. Для списка
+    возвращает (товары [(номер строки, артикул, количество)], ошибки
+    [(номер строки, строка, причина)]). Пустые строки пропускаются.
+    """
+    lines = text.strip().splitlines()
+    multiline = len(lines) > 1
+    if not multiline:
+        parsed = _split_article_line(text, allow_space=False)
+        if parsed is None or not parsed[1].isdigit():
+            return None
+    if len(lines) > max_lines:
+        return [], [(max_lines + 1, '', f"в одном сообщении не больше {max_lines} строк")]
+
+    items = []
+    errors = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        parsed = _split_article_line(line, allow_space=multiline)
+        if parsed is None:
+            errors.append((number, line.strip(), "не указано количество"))
+            continue
+        article, quantity = parsed
+        if not quantity.isdigit() or int(quantity) == 0:
+            errors.append((number, line.strip(), "количество должно быть целым числом больше нуля"))
+            continue
+        items.append((number, article, int(quantity)))
+    return items, errors
+
+
+class ArticleCatalog:
+    """Каталог артикулов с поиском по префиксу
+
+    Артикулы хранятся отсортированным массивом нормализованных ключей, поиск
+    по префиксу - двоичный поиск и проход по соседним элементам, поэтому
+    занимает микросекунды и на сотнях тысяч позиций. Файл каталога
+    перечитывается, если изменился, не чаще раза в ttl секунд. Пока каталог
+    не загружен, проверка пропускает любые артикулы.
+    """
+
+    def __init__(self, path=None, ttl=300, article_column='article'):
+        self.path = path
+        self.ttl = ttl
+        self.article_column = article_column
+        self._keys = []
+        self._articles = []
+        self._loaded_mtime = None
+        self._checked_at = 0.0
+        self._reloading = False
+
+    @property
+    def loaded(self):
+        return self._loaded_mtime is not None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _read_file(self):
+        for encoding in ('utf-8-sig', 'cp1251'):
+            try:
+                with open(self.path, newline='', encoding=encoding) as f:
+                    sample = f.read(4096)
+                    f.seek(0)
+                    try:
+                        dialect = csv.Sniffer().sniff(sample, delimiters=';,\t')
+                    except csv.Error:
+                        dialect = csv.excel
+                    articles = {}
+                    for row in csv.DictReader(f, dialect=dialect):
+                        article = (row.get(self.article_column) or '').strip()
+                        if article:
+                            articles.setdefault(normalize_article(article), article)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            raise ValueError(f"Не удалось определить кодировку файла {self.path}")
+
+        keys = sorted(articles)
+        return keys, [articles[key] for key in keys]
+
+    async def refresh(self):
+        """Перечитывает файл каталога, если истёк ttl и файл изменился"""
+        now = time.monotonic()
+        if not self.path or self._reloading or now - self._checked_at < self.ttl:
+            return
+        self._checked_at = now
+
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            logger.error(f"Файл каталога недоступен: {e}")
+            return
+        if mtime == self._loaded_mtime:
+            return
+
+        self._reloading = True
+        try:
+            keys, articles = await asyncio.to_thread(self._read_file)
+            # Оба массива подменяются одним присваиванием
+            self._keys, self._articles = keys, articles
+            self._loaded_mtime = mtime
+            logger.info(f"Каталог загружен: артикулов {len(keys)}")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки каталога {self.path}: {e}", exc_info=True)
+        finally:
+            self._reloading = False
+
+    def contains(self, article):
+        """Есть ли артикул в каталоге; при пустом каталоге - False"""
+        return bool(self._keys) and self.find(article) is not None
+
+    def find(self, article):
+        """Артикул в написании каталога или None, если такого нет"""
+        keys, articles = self._keys, self._articles
+        if not keys:
+            return article
+        key = normalize_article(article)
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return articles[i]
+        return None
+
+    def search(self, prefix, limit=8):
+        """Первые limit артикулов каталога, начинающихся с prefix"""
+        keys, articles = self._keys, self._articles
+        prefix = normalize_article(prefix)
+        if not prefix:
+            return []
+
+        result = []
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and len(result) < limit and keys[i].startswith(prefix):
+            result.append(articles[i])
+            i += 1
+        return result
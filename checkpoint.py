@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from telegram.ext import ApplicationHandlerStop, ExtBot
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateCheckpoint:
+    """Контрольная точка long polling и учёт обработанных обновлений Telegram
+
+    Watermark - наибольший update_id, все полученные обновления до которого
+    обработаны. Обработанные update_id копятся в памяти и вместе с watermark
+    пакетом записываются в bot.db. getUpdates запрашивается с offset,
+    равным записанному watermark + 1 (см. poll), поэтому Telegram не удаляет
+    обновления, результат которых ещё не сохранён, и после падения
+    доставляет их заново; уже обработанные из них отбрасывает
+    skip_processed.
+
+    before_flush - корутина, записывающая состояния диалогов; она
+    вызывается перед записью пакета и должна вернуть True, иначе пакет
+    остаётся в памяти. Так обновление не считается обработанным, пока его
+    результат не сохранён. Telegram хранит неподтверждённые обновления до
+    24 часов, поэтому записи старше retention удаляются.
+    """
+
+    def __init__(self, db, flush_interval=5, retention=48 * 3600, before_flush=None, poll_backoff=1):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.before_flush = before_flush
+        self.poll_backoff = poll_backoff
+        self._seen = None
+        self._pending = []
+        self._task = None
+        # None - этот процесс не получает обновления long polling
+        self._watermark = None
+        self._stored_watermark = None
+        self._in_flight = set()
+        self._done = set()
+        self._progress = asyncio.Event()
+        self._flush_requested = asyncio.Event()
+
+    async def _load(self):
+        if self._seen is None:
+            self._seen = set(await self.db.load_processed_updates(time.time() - self.retention))
+
+    async def is_processed(self, update_id):
+        await self._load()
+        return update_id in self._seen
+
+    def mark_processed(self, update_id):
+        self.release(update_id)
+        if self._seen is not None:
+            if update_id in self._seen:
+                return
+            self._seen.add(update_id)
+        self._pending.append((update_id, time.time()))
+
+    def release(self, update_id):
+        """Обновление, полученное poll, обработано: сдвигает watermark
+
+        Приёмник вызывает его напрямую по подтверждению процесса-обработчика,
+        который сам записывает обновление в processed_updates.
+        """
+        if update_id not in self._in_flight:
+            return
+        self._in_flight.remove(update_id)
+        self._done.add(update_id)
+        lowest = min(self._in_flight, default=None)
+        passed = {done for done in self._done if lowest is None or done < lowest}
+        if passed:
+            self._done -= passed
+            self._watermark = max(self._watermark, max(passed))
+            self._progress.set()
+
+    @property
+    def watermark(self):
+        return self._watermark
+
+    async def poll(self, get_updates, offset=None, **kwargs):
+        """getUpdates с offset = записанный watermark + 1; возвращает только новые обновления
+
+        Telegram снова присылает обновления выше записанного watermark,
+        которые ещё обрабатываются или уже обработаны, - они отбрасываются,
+        а запись контрольной точки запрашивается досрочно, чтобы они не
+        занимали место в ответе. Если новых нет, ответ откладывается до
+        сдвига watermark (не дольше poll_backoff), чтобы не опрашивать
+        Telegram впустую. offset=0 передаёт только что запущенный Updater:
+        обновления, полученные прежним, Telegram доставит заново.
+        """
+        if not offset:
+            self._in_flight.clear()
+            self._done.clear()
+            if self._watermark is None:
+                self._watermark = await self.db.load_update_watermark(time.time() - self.retention)
+                self._stored_watermark = self._watermark
+        if self._stored_watermark is not None:
+            offset = self._stored_watermark + 1
+        self._progress.clear()
+        updates = await get_updates(offset=offset, **kwargs)
+        if self._watermark is None and updates:
+            self._watermark = self._stored_watermark = updates[0].update_id - 1
+        if updates and updates[0].update_id <= self._watermark:
+            self._flush_requested.set()
+        new = [
+            update for update in updates
+            if update.update_id > self._watermark
+            and update.update_id not in self._in_flight
+            and update.update_id not in self._done
+        ]
+        if updates and not new:
+            try:
+                await asyncio.wait_for(self._progress.wait(), self.poll_backoff)
+            except asyncio.TimeoutError:
+                pass
+        self._in_flight.update(update.update_id for update in new)
+        return new
+
+    async def skip_processed(self, update, context):
+        """Обработчик группы -1: отбрасывает уже обработанные обновления"""
+        if await self.is_processed(update.update_id):
+            logger.info(f"Обновление {update.update_id} уже обработано, пропускаем")
+            raise ApplicationHandlerStop
+
+    def record_processed(self, update):
+        """on_processed планировщика: обновление обработано, его изменения отмечены для persistence"""
+        self.mark_processed(update.update_id)
+
+    async def flush(self):
+        watermark = self._watermark if self._watermark != self._stored_watermark else None
+        if not self._pending and watermark is None:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            saved = self.before_flush is None or await self.before_flush()
+            if saved:
+                saved = await self.db.save_processed_updates(rows, time.time() - self.retention, watermark)
+        except BaseException:
+            self._pending = rows + self._pending
+            raise
+        if not saved:
+            self._pending = rows + self._pending
+        elif watermark is not None:
+            self._stored_watermark = watermark
+            self._progress.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении контрольной точки обновлений: {e}", exc_info=True)
+
+
+class CheckpointBot(ExtBot):
+    """ExtBot, который подтверждает Telegram только обработанные обновления (UpdateCheckpoint.poll)"""
+
+    __slots__ = ('_checkpoint',)
+
+    def __init__(self, checkpoint, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkpoint = checkpoint
+
+    async def get_updates(self, offset=None, **kwargs):
+        return await self._checkpoint.poll(super().get_updates, offset, **kwargs)
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import zlib
+from collections import OrderedDict
+from metrics import BOT_RESTARTS
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+
+def shard_for(update, shards):
+    """Номер обработчика для обновления: все обновления пользователя попадают в один шард"""
+    user = update.effective_user
+    chat = update.effective_chat
+    key = user.id if user is not None else chat.id if chat is not None else update.update_id
+    return zlib.crc32(str(key).encode('utf-8')) % shards
+
+
+class ShardWorker:
+    """Процесс-обработчик одного шарда
+
+    Обновления передаются в stdin процесса строками JSON, в stdout процесс
+    возвращает подтверждения {"ack": [update_id, ...]} после записи
+    состояния диалогов в bot.db. Неподтверждённые обновления хранятся здесь
+    и при перезапуске упавшего процесса отправляются заново; уже
+    обработанные отбрасывает UpdateCheckpoint обработчика. on_ack
+    вызывается для каждого подтверждённого update_id.
+    """
+
+    def __init__(self, shard, on_wakeup=None, on_ack=None, stop_timeout=30):
+        self.shard = shard
+        self.on_wakeup = on_wakeup
+        self.on_ack = on_ack
+        self.stop_timeout = stop_timeout
+        self.pending = OrderedDict()
+        self.process = None
+        self._task = None
+        self._started = None
+        self._stopping = False
+        # Повторная отправка при перезапуске не должна перемешаться с новыми обновлениями
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def submit(self, update):
+        line = (json.dumps(update.to_dict(), ensure_ascii=False) + '\n').encode('utf-8')
+        async with self._write_lock:
+            self.pending[update.update_id] = line
+            if self.alive:
+                await self._write(line)
+
+    async def _write(self, data):
+        try:
+            self.process.stdin.write(data)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            # Обновление останется в pending и уйдёт перезапущенному процессу
+            logger.warning(f"Обработчик {self.shard} недоступен: {e}")
+
+    async def _spawn(self):
+        async with self._write_lock:
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, WORKER_SCRIPT, str(self.shard),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE
+            )
+            logger.info(f"Обработчик {self.shard} запущен, pid {self.process.pid}")
+            if self.pending:
+                logger.info(f"Обработчику {self.shard} повторно отправлено {len(self.pending)} обновлений")
+                await self._write(b''.join(self.pending.values()))
+
+    async def _read_messages(self):
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                return
+            try:
+                message = json.loads(line)
+            except ValueError:
+                logger.warning(f"Обработчик {self.shard}: неожиданный вывод {line[:200]!r}")
+                continue
+            for update_id in message.get('ack', ()):
+                self.pending.pop(update_id, None)
+                if self.on_ack is not None:
+                    self.on_ack(update_id)
+            if message.get('wakeup') == 'outbox' and self.on_wakeup is not None:
+                self.on_wakeup()
+
+    async def start(self):
+        self._stopping = False
+        self._started = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        await self._started.wait()
+
+    async def _run(self):
+        delay = 1
+        while True:
+            try:
+                await self._spawn()
+            except OSError as e:
+                logger.error(f"Не удалось запустить обработчик {self.shard}: {e}")
+                self._started.set()
+            else:
+                self._started.set()
+                started_at = time.monotonic()
+                await self._read_messages()
+                code = await self.process.wait()
+                if self._stopping:
+                    return
+                logger.error(f"Обработчик {self.shard} завершился с кодом {code}, перезапускаем")
+                BOT_RESTARTS.labels('worker').inc()
+                # Процесс, проработавший больше минуты, перезапускаем сразу
+                if time.monotonic() - started_at > 60:
+                    delay = 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    async def stop(self):
+        """Закрывает stdin: процесс дообрабатывает полученные обновления и завершается"""
+        self._stopping = True
+        if self.alive:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), self.stop_timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Обработчик {self.shard} не завершился за {self.stop_timeout} с, останавливаем")
+                self.process.kill()
+                await self.process.wait()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.pending:
+            logger.warning(f"Обработчик {self.shard} остановлен, не подтверждено {len(self.pending)} обновлений")
+
+
+class WorkerPool:
+    """Распределение обновлений по процессам-обработчикам по хэшу user_id
+
+    Состояния диалогов хранятся в общей bot.db, поэтому процесс,
+    перезапущенный после падения, продолжает диалоги своего шарда.
+    """
+
+    def __init__(self, size, on_wakeup=None, on_ack=None, stop_timeout=30):
+        if size < 1:
+            raise ValueError("`size` must be a positive integer!")
+        self.workers = [ShardWorker(shard, on_wakeup, on_ack, stop_timeout) for shard in range(size)]
+
+    async def start(self):
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+
+    async def stop(self):
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+    async def route(self, update, context):
+        """Единственный обработчик приложения-приёмника"""
+        await self.workers[shard_for(update, len(self.workers))].submit(update)
+
+    def send_signal(self, signum):
+        for worker in self.workers:
+            if worker.alive:
+                worker.process.send_signal(signum)
+
+    def pending_counts(self):
+        return {worker.shard: len(worker.pending) for worker in self.workers}
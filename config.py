@@ -1,19 +1,164 @@
 import os
-from dotenv import load_dotenv
+import secrets
+import tempfile
+from dotenv import dotenv_values, load_dotenv
 
 load_dotenv()
 
+# Переменные окружения процесса: основа, поверх которой читается CONFIG_PATH
+_ENVIRONMENT = dict(os.environ)
+
+# Файл в формате .env с параметрами, которые меняются без перезапуска (см. read_reloadable).
+# Его значения важнее переменных окружения; перечитывается по SIGHUP и POST /admin/reload-config
+CONFIG_PATH = os.getenv('CONFIG_PATH')
+# Токен служебных HTTP-запросов (заголовок Authorization: Bearer ...); без него они отключены
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+
+def read_config_source():
+    source = dict(_ENVIRONMENT)
+    if CONFIG_PATH:
+        if not os.path.exists(CONFIG_PATH):
+            raise ValueError(f"Файл конфигурации {CONFIG_PATH} не найден")
+        source.update({name: value for name, value in dotenv_values(CONFIG_PATH).items() if value is not None})
+    return source
+
+
+def _read_days(source, name, default):
+    """Срок в днях; None, если значение не число (ошибку сообщает validate_reloadable)"""
+    try:
+        return float(source.get(name, default))
+    except ValueError:
+        return None
+
+
+def read_reloadable(source):
+    """Параметры, которые можно поменять без перезапуска бота
+
+    Значения не проверяются: это делают validate_reloadable при запуске
+    (check_config) и load_reloadable_config при перечитывании.
+    """
+    return {
+        'RESPONSIBLE_ID': source.get('RESPONSIBLE_ID'),
+        'PROJECT_IDS': {
+            'refusal': source.get('REFUSAL_PROJECT_ID'),
+            'claim': source.get('CLAIM_PROJECT_ID'),
+            'info': source.get('INFO_PROJECT_ID')
+        },
+        'TASK_DEADLINE_DAYS': {
+            'refusal': _read_days(source, 'REFUSAL_DEADLINE_DAYS', 3),
+            'claim': _read_days(source, 'CLAIM_DEADLINE_DAYS', 3),
+            'info': _read_days(source, 'INFO_DEADLINE_DAYS', 1)
+        },
+        'CLAIM_TYPES': [
+            claim_type.strip()
+            for claim_type in source.get('CLAIM_TYPES', 'Недовоз,Брак,Пересорт').split(',')
+            if claim_type.strip()
+        ],
+        'DEDUP_ACTION': source.get('DEDUP_ACTION', 'comment')
+    }
+
+
+_reloadable = read_reloadable(read_config_source())
+
 # Конфигурация бота
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 BITRIX_WEBHOOK = os.getenv('BITRIX_WEBHOOK')
-RESPONSIBLE_ID = os.getenv('RESPONSIBLE_ID')
+RESPONSIBLE_ID = _reloadable['RESPONSIBLE_ID']
+
+# Способ получения обновлений Telegram: 'polling' или 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес сервиса, например https://motexbot.onrender.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Если секрет не задан, генерируем его при запуске - вебхук регистрирует сам бот
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
 
 # ID проектов для разных типов задач
-PROJECT_IDS = {
-    'refusal': os.getenv('REFUSAL_PROJECT_ID'),
-    'claim': os.getenv('CLAIM_PROJECT_ID'),
-    'info': os.getenv('INFO_PROJECT_ID')
-}
+PROJECT_IDS = _reloadable['PROJECT_IDS']
+
+# Крайний срок задачи в днях по типу
+TASK_DEADLINE_DAYS = _reloadable['TASK_DEADLINE_DAYS']
+
+# Окно накопления вызовов Bitrix24 для объединения в batch (секунды)
+BITRIX_BATCH_WINDOW = float(os.getenv('BITRIX_BATCH_WINDOW', 0.2))
+
+# Ограничение частоты запросов к Bitrix24 (token bucket)
+BITRIX_RATE_LIMIT = float(os.getenv('BITRIX_RATE_LIMIT', 2))  # запросов в секунду
+BITRIX_RATE_BURST = int(os.getenv('BITRIX_RATE_BURST', 10))
+
+# Повторы запросов к Bitrix24 и автомат размыкателя
+BITRIX_RETRY_ATTEMPTS = int(os.getenv('BITRIX_RETRY_ATTEMPTS', 3))
+BITRIX_RETRY_BASE_DELAY = float(os.getenv('BITRIX_RETRY_BASE_DELAY', 0.5))  # секунды
+BITRIX_RETRY_MAX_DELAY = float(os.getenv('BITRIX_RETRY_MAX_DELAY', 10))  # секунды
+BITRIX_BREAKER_FAILURE_THRESHOLD = int(os.getenv('BITRIX_BREAKER_FAILURE_THRESHOLD', 5))
+BITRIX_BREAKER_RESET_TIMEOUT = float(os.getenv('BITRIX_BREAKER_RESET_TIMEOUT', 30))  # секунды
+
+# Параметры доставки заявок из outbox в Bitrix24
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+OUTBOX_RETRY_DELAY = float(os.getenv('OUTBOX_RETRY_DELAY', 5))  # секунды
+OUTBOX_MAX_RETRY_DELAY = float(os.getenv('OUTBOX_MAX_RETRY_DELAY', 600))  # секунды
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 5))  # секунды
+
+# Максимум одновременно обрабатываемых обновлений (сообщения одного чата всегда по очереди)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 32))
+
+# Интервал пакетной записи состояний диалогов в bot.db (секунды)
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', 5))
+
+# Число процессов-обработчиков; 0 - бот работает в одном процессе
+WORKERS = int(os.getenv('WORKERS', 0))
+# Интервал записи состояний и подтверждения обновлений процессом-обработчиком (секунды)
+WORKER_ACK_INTERVAL = float(os.getenv('WORKER_ACK_INTERVAL', 1))
+# Ожидание завершения обработчика при остановке (секунды)
+WORKER_STOP_TIMEOUT = float(os.getenv('WORKER_STOP_TIMEOUT', 30))
+
+# Проверки состояния Telegram, Bitrix24 и базы данных
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', 30))  # секунды
+HEALTH_PROBE_TIMEOUT = float(os.getenv('HEALTH_PROBE_TIMEOUT', 10))  # секунды
+HEALTH_FAILURE_THRESHOLD = int(os.getenv('HEALTH_FAILURE_THRESHOLD', 3))  # неудач подряд до провала
+HEALTH_RECOVERY_THRESHOLD = int(os.getenv('HEALTH_RECOVERY_THRESHOLD', 2))  # успехов подряд до восстановления
+HEALTH_MAX_POLLING_LAG = float(os.getenv('HEALTH_MAX_POLLING_LAG', 120))  # секунды без ответа getUpdates
+HEALTH_RESTART_AFTER = float(os.getenv('HEALTH_RESTART_AFTER', 300))  # секунды остановленного polling до перезапуска
+# Адрес, который периодически запрашивается, чтобы хостинг не усыплял сервис (например, Render)
+KEEP_ALIVE_URL = os.getenv('KEEP_ALIVE_URL')
+KEEP_ALIVE_INTERVAL = float(os.getenv('KEEP_ALIVE_INTERVAL', 300))  # секунды
+
+# Интервал записи буфера пользователей и заявок в bot.db (секунды)
+RECORDER_FLUSH_INTERVAL = float(os.getenv('RECORDER_FLUSH_INTERVAL', 2))
+
+# Справочник кодов клиентов и маршрутов (CSV); без файла проверка отключена
+DIRECTORY_PATH = os.getenv('DIRECTORY_PATH')
+DIRECTORY_TTL = float(os.getenv('DIRECTORY_TTL', 300))  # секунды между проверками файла
+DIRECTORY_CODE_COLUMN = os.getenv('DIRECTORY_CODE_COLUMN', 'client_code')
+DIRECTORY_ROUTE_COLUMN = os.getenv('DIRECTORY_ROUTE_COLUMN', 'route')
+
+# Каталог артикулов (CSV) для подсказок при вводе; без файла проверка отключена
+CATALOG_PATH = os.getenv('CATALOG_PATH')
+CATALOG_TTL = float(os.getenv('CATALOG_TTL', 300))  # секунды между проверками файла
+CATALOG_ARTICLE_COLUMN = os.getenv('CATALOG_ARTICLE_COLUMN', 'article')
+CATALOG_SUGGESTIONS = int(os.getenv('CATALOG_SUGGESTIONS', 8))  # кнопок с подсказками
+BULK_ARTICLES_MAX_LINES = int(os.getenv('BULK_ARTICLES_MAX_LINES', 200))  # строк в списке товаров одним сообщением
+
+# Поиск повторных заявок по клиенту, маршруту, документу и товарам
+DEDUP_WINDOW = float(os.getenv('DEDUP_WINDOW', 86400))  # окно поиска дублей в секундах
+DEDUP_ACTION = _reloadable['DEDUP_ACTION']  # 'comment' или 'warn'
+
+# Часовой пояс дат в истории обращений (например, Europe/Moscow); по умолчанию - пояс сервера
+TIMEZONE = os.getenv('TIMEZONE')
+
+# Логирование
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_DIR = os.getenv('LOG_DIR', os.path.join(tempfile.gettempdir(), 'app_logs'))
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # 'json' или 'text'
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))  # размер файла до ротации
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', 7))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 50))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0.01))  # доля заявок, для которых пишется содержимое запросов
+
+# Запись трафика для воспроизведения (replay.py); без пути запись выключена
+CAPTURE_PATH = os.getenv('CAPTURE_PATH')
+# Соль для замены id пользователей; задайте постоянную, чтобы id совпадали между перезапусками
+CAPTURE_SALT = os.getenv('CAPTURE_SALT') or secrets.token_hex(16)
 
 # Названия задач
 TASK_TITLES = {
@@ -22,54 +167,154 @@ TASK_TITLES = {
     'info': 'Информация от водителя'
 }
 
+# Шаги диалогов в порядке прохождения: имя шага -> номер состояния ConversationHandler.
+# Номера сохраняются в bot.db, поэтому общие шаги разных диалогов имеют один номер
+
 # Состояния для обработки отказов
 REFUSAL_STATES = {
     'CLIENT_CODE': 1,
     'ROUTE': 2,
-    'ARTICLE': 3,
+    'ARTICLES': 3,
     'QUANTITY': 4,
-    'DOCUMENT': 5,
+    'DOCUMENT_NUMBER': 5,
     'COMMENT': 6
 }
 
 # Состояния для обработки претензий
 CLAIM_STATES = {
+    'CLAIM_TYPE': 7,
     'CLIENT_CODE': 1,
     'ROUTE': 2,
-    'CLAIM_TYPE': 3,
-    'ARTICLE': 4,
-    'QUANTITY': 5,
-    'DOCUMENT': 6,
-    'COMMENT': 7
+    'ARTICLES': 3,
+    'QUANTITY': 4,
+    'DOCUMENT_NUMBER': 5,
+    'COMMENT': 6
 }
 
 # Состояния для обработки информации
 INFO_STATES = {
-    'CLIENT_CODE': 1,
-    'ROUTE': 2,
-    'COMMENT': 3
+    'INFO_CLIENT_CODE': 8,
+    'INFO_ROUTE': 9,
+    'INFO_COMMENT': 10
 }
 
-# Типы претензий
-CLAIM_TYPES = ['Недовоз', 'Повреждение', 'Несоответствие']
+# Типы претензий (кнопки выбора типа), через запятую
+CLAIM_TYPES = _reloadable['CLAIM_TYPES']
 
 class Config:
     BOT_TOKEN = BOT_TOKEN
     BITRIX_WEBHOOK = BITRIX_WEBHOOK
     RESPONSIBLE_ID = RESPONSIBLE_ID
+    BOT_MODE = BOT_MODE
+    WEBHOOK_URL = WEBHOOK_URL
+    WEBHOOK_PATH = WEBHOOK_PATH
+    WEBHOOK_SECRET = WEBHOOK_SECRET
     PROJECT_IDS = PROJECT_IDS
+    TASK_DEADLINE_DAYS = TASK_DEADLINE_DAYS
+    CONFIG_PATH = CONFIG_PATH
+    ADMIN_TOKEN = ADMIN_TOKEN
     TASK_TITLES = TASK_TITLES
+    BITRIX_BATCH_WINDOW = BITRIX_BATCH_WINDOW
+    BITRIX_RATE_LIMIT = BITRIX_RATE_LIMIT
+    BITRIX_RATE_BURST = BITRIX_RATE_BURST
+    BITRIX_RETRY_ATTEMPTS = BITRIX_RETRY_ATTEMPTS
+    BITRIX_RETRY_BASE_DELAY = BITRIX_RETRY_BASE_DELAY
+    BITRIX_RETRY_MAX_DELAY = BITRIX_RETRY_MAX_DELAY
+    BITRIX_BREAKER_FAILURE_THRESHOLD = BITRIX_BREAKER_FAILURE_THRESHOLD
+    BITRIX_BREAKER_RESET_TIMEOUT = BITRIX_BREAKER_RESET_TIMEOUT
+    OUTBOX_MAX_ATTEMPTS = OUTBOX_MAX_ATTEMPTS
+    OUTBOX_RETRY_DELAY = OUTBOX_RETRY_DELAY
+    OUTBOX_MAX_RETRY_DELAY = OUTBOX_MAX_RETRY_DELAY
+    OUTBOX_POLL_INTERVAL = OUTBOX_POLL_INTERVAL
+    MAX_CONCURRENT_UPDATES = MAX_CONCURRENT_UPDATES
+    PERSISTENCE_UPDATE_INTERVAL = PERSISTENCE_UPDATE_INTERVAL
+    WORKERS = WORKERS
+    WORKER_ACK_INTERVAL = WORKER_ACK_INTERVAL
+    WORKER_STOP_TIMEOUT = WORKER_STOP_TIMEOUT
+    HEALTH_CHECK_INTERVAL = HEALTH_CHECK_INTERVAL
+    HEALTH_PROBE_TIMEOUT = HEALTH_PROBE_TIMEOUT
+    HEALTH_FAILURE_THRESHOLD = HEALTH_FAILURE_THRESHOLD
+    HEALTH_RECOVERY_THRESHOLD = HEALTH_RECOVERY_THRESHOLD
+    HEALTH_MAX_POLLING_LAG = HEALTH_MAX_POLLING_LAG
+    HEALTH_RESTART_AFTER = HEALTH_RESTART_AFTER
+    KEEP_ALIVE_URL = KEEP_ALIVE_URL
+    KEEP_ALIVE_INTERVAL = KEEP_ALIVE_INTERVAL
+    RECORDER_FLUSH_INTERVAL = RECORDER_FLUSH_INTERVAL
+    DIRECTORY_PATH = DIRECTORY_PATH
+    DIRECTORY_TTL = DIRECTORY_TTL
+    DIRECTORY_CODE_COLUMN = DIRECTORY_CODE_COLUMN
+    DIRECTORY_ROUTE_COLUMN = DIRECTORY_ROUTE_COLUMN
+    CATALOG_PATH = CATALOG_PATH
+    CATALOG_TTL = CATALOG_TTL
+    CATALOG_ARTICLE_COLUMN = CATALOG_ARTICLE_COLUMN
+    CATALOG_SUGGESTIONS = CATALOG_SUGGESTIONS
+    BULK_ARTICLES_MAX_LINES = BULK_ARTICLES_MAX_LINES
+    DEDUP_WINDOW = DEDUP_WINDOW
+    DEDUP_ACTION = DEDUP_ACTION
+    TIMEZONE = TIMEZONE
+    LOG_LEVEL = LOG_LEVEL
+    LOG_DIR = LOG_DIR
+    LOG_FORMAT = LOG_FORMAT
+    LOG_MAX_BYTES = LOG_MAX_BYTES
+    LOG_RETENTION_DAYS = LOG_RETENTION_DAYS
+    LOG_BACKUP_COUNT = LOG_BACKUP_COUNT
+    LOG_PAYLOAD_SAMPLE_RATE = LOG_PAYLOAD_SAMPLE_RATE
+    CAPTURE_PATH = CAPTURE_PATH
+    CAPTURE_SALT = CAPTURE_SALT
+
+    REFUSAL_STATES = REFUSAL_STATES
+    CLAIM_STATES = CLAIM_STATES
+    INFO_STATES = INFO_STATES
+    CLAIM_TYPES = CLAIM_TYPES
+
+    STATES = {'START': 0, **REFUSAL_STATES, **CLAIM_STATES, **INFO_STATES}
+
+
+def validate_reloadable(values):
+    """Список ошибок в новых значениях; пустой, если их можно применять"""
+    errors = []
+    if not str(values['RESPONSIBLE_ID'] or '').isdigit():
+        errors.append("RESPONSIBLE_ID должен быть числом")
+    for task_type, project_id in values['PROJECT_IDS'].items():
+        if not str(project_id or '').isdigit():
+            errors.append(f"ID проекта для {task_type} должен быть числом")
+    for task_type, days in values['TASK_DEADLINE_DAYS'].items():
+        if days is None or not 0 < days <= 365:
+            errors.append(f"Срок для {task_type} должен быть от 0 до 365 дней")
+    claim_types = values['CLAIM_TYPES']
+    if not claim_types:
+        errors.append("CLAIM_TYPES не может быть пустым")
+    if len(set(claim_types)) != len(claim_types):
+        errors.append("CLAIM_TYPES содержит повторы")
+    if '❌ Отмена' in claim_types or any(len(claim_type) > 64 for claim_type in claim_types):
+        errors.append("CLAIM_TYPES: недопустимое название кнопки")
+    if values['DEDUP_ACTION'] not in ('comment', 'warn'):
+        errors.append("DEDUP_ACTION должен быть 'comment' или 'warn'")
+    return errors
+
+
+def load_reloadable_config():
+    """Читает CONFIG_PATH и окружение и проверяет значения; ValueError, если их нельзя применить"""
+    try:
+        values = read_reloadable(read_config_source())
+    except (OSError, ValueError) as e:
+        raise ValueError(str(e)) from e
+    errors = validate_reloadable(values)
+    if errors:
+        raise ValueError('; '.join(errors))
+    return values
+
+
+def check_config():
+    """Проверка при запуске; ValueError с тем же текстом, что и при перечитывании"""
+    errors = validate_reloadable(_reloadable)
+    if errors:
+        raise ValueError('; '.join(errors))
+
 
-    STATES = {
-        'START': 0,
-        'CLIENT_CODE': 1,
-        'ROUTE': 2,
-        'ARTICLES': 3,
-        'QUANTITY': 4,
-        'DOCUMENT_NUMBER': 5,
-        'COMMENT': 6,
-        'CLAIM_TYPE': 7,
-        'INFO_CLIENT_CODE': 8,
-        'INFO_ROUTE': 9,
-        'INFO_COMMENT': 10
-    }
\ No newline at end of file
+def apply_config(values):
+    """Подменяет параметры Config разом, без await; возвращает имена изменившихся"""
+    changed = [name for name, value in values.items() if getattr(Config, name) != value]
+    for name in changed:
+        setattr(Config, name, values[name])
+    return changed
@@ -1,19 +1,71 @@
+import asyncio
+import json
+import queue
 import sqlite3
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Миграции схемы; номер последней применённой хранится в PRAGMA user_version
+MIGRATIONS = [
+    # 1: полная заявка и ID задачи Bitrix24 в tasks, индексы для истории обращений
+    [
+        'ALTER TABLE tasks ADD COLUMN ticket_id INTEGER',
+        'ALTER TABLE tasks ADD COLUMN bitrix_task_id TEXT',
+        'ALTER TABLE tasks ADD COLUMN title TEXT',
+        'ALTER TABLE tasks ADD COLUMN claim_type TEXT',
+        'ALTER TABLE tasks ADD COLUMN articles TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_tasks_user_created ON tasks (user_id, created_at, task_id)',
+        'CREATE INDEX IF NOT EXISTS idx_tasks_ticket ON tasks (ticket_id)',
+        'CREATE INDEX IF NOT EXISTS idx_tasks_bitrix ON tasks (bitrix_task_id)',
+    ],
+    # 2: отказы, претензии и информация ведутся одним ConversationHandler
+    [
+        "UPDATE OR REPLACE conversations SET name = 'driver_conversation' "
+        "WHERE name IN ('refusal_conversation', 'claim_conversation', 'info_conversation')",
+    ],
+    # 3: контрольная точка update_id больше не хранится
+    [
+        'DROP TABLE IF EXISTS bot_state',
+    ],
+]
+
 class Database:
-    def __init__(self, db_file="bot.db"):
+    """Доступ к bot.db: WAL, один поток-писатель с групповыми коммитами
+
+    Все операции записи выполняются в отдельном потоке: накопившиеся к моменту
+    коммита операции записываются одной транзакцией (каждая в своей точке
+    сохранения, так что ошибка одной не откатывает остальные). Чтение идёт
+    через собственные соединения потоков из пула asyncio и не ждёт писателя.
+    Публичные методы - корутины и не блокируют event loop.
+    """
+
+    def __init__(self, db_file="bot.db", max_batch_size=500):
         self.db_file = db_file
+        self.max_batch_size = max_batch_size
         self.connection = None
         self.cursor = None
+        self._write_queue = queue.Queue()
+        self._writer = None
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
         self.connect()
         self.create_tables()
+        self._start_writer()
+
+    def _open_connection(self):
+        connection = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('PRAGMA busy_timeout=5000')
+        return connection
 
     def connect(self):
         try:
-            self.connection = sqlite3.connect(self.db_file)
+            self.connection = self._open_connection()
             self.cursor = self.connection.cursor()
             logger.info("Connected to database")
         except sqlite3.Error as e:
@@ -21,6 +73,7 @@ class Database:
 
     def create_tables(self):
         try:
+            self.cursor.execute('BEGIN')
             # Создаем таблицу для хранения данных пользователей
             self.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -47,46 +100,550 @@ class Database:
                 )
             ''')
             
-            self.connection.commit()
+            # Очередь заявок на создание задач в Bitrix24 (outbox)
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    ticket_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    chat_id INTEGER,
+                    task_type TEXT,
+                    payload TEXT,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    bitrix_task_id TEXT,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            self.cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_outbox_status_next
+                ON outbox (status, next_attempt_at)
+            ''')
+            # Ключ идемпотентности: одно обновление Telegram - одна заявка
+            self._add_column_if_missing('outbox', 'source_update_id', 'INTEGER')
+            self.cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_source_update
+                ON outbox (source_update_id)
+            ''')
+
+            # Обработанные обновления Telegram
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS processed_updates (
+                    update_id INTEGER PRIMARY KEY,
+                    processed_at REAL
+                )
+            ''')
+            # Watermark long polling: все обновления до него обработаны и подтверждены Telegram
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS update_watermark (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    update_id INTEGER NOT NULL,
+                    saved_at REAL
+                )
+            ''')
+
+            # Состояния диалогов и данные пользователей (persistence бота)
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    name TEXT,
+                    conversation_key TEXT,
+                    state TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (name, conversation_key)
+                )
+            ''')
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_data (
+                    user_id INTEGER PRIMARY KEY,
+                    data TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Отпечатки недавних заявок для поиска дублей
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS submission_fingerprints (
+                    fingerprint TEXT PRIMARY KEY,
+                    ticket_id INTEGER,
+                    user_id INTEGER,
+                    update_id INTEGER,
+                    created_at REAL
+                )
+            ''')
+            self.cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_fingerprints_created
+                ON submission_fingerprints (created_at)
+            ''')
+
+            self._migrate()
+
+            self.cursor.execute('COMMIT')
             logger.info("Database tables created successfully")
         except sqlite3.Error as e:
+            if self.connection.in_transaction:
+                self.cursor.execute('ROLLBACK')
             logger.error(f"Error creating tables: {e}")
 
-    def add_user(self, user_id, username, first_name, last_name):
+    def _start_writer(self):
+        self._writer = threading.Thread(target=self._writer_loop, name='db-writer', daemon=True)
+        self._writer.start()
+
+    def _writer_loop(self):
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+
+            # Забираем всё, что накопилось, и коммитим одной транзакцией
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._commit_batch(batch)
+            if stop:
+                break
+
+    def _commit_batch(self, batch):
+        results = []
         try:
-            self.cursor.execute('''
+            self.connection.execute('BEGIN IMMEDIATE')
+            for operation, _, _ in batch:
+                self.connection.execute('SAVEPOINT operation')
+                try:
+                    results.append((True, operation(self.connection)))
+                    self.connection.execute('RELEASE operation')
+                except Exception as e:
+                    self.connection.execute('ROLLBACK TO operation')
+                    self.connection.execute('RELEASE operation')
+                    results.append((False, e))
+            self.connection.execute('COMMIT')
+        except sqlite3.Error as e:
+            if self.connection.in_transaction:
+                self.connection.execute('ROLLBACK')
+            results = [(False, e)] * len(batch)
+
+        for (_, loop, future), (ok, value) in zip(batch, results):
+            loop.call_soon_threadsafe(self._resolve, future, ok, value)
+
+    @staticmethod
+    def _resolve(future, ok, value):
+        if future.done():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    async def _write(self, operation):
+        """Выполняет operation(connection) в потоке-писателе в составе группового коммита"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._write_queue.put((operation, loop, future))
+        return await future
+
+    def _reader(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._open_connection()
+            connection.execute('PRAGMA query_only=ON')
+            self._local.connection = connection
+            with self._readers_lock:
+                self._readers.append(connection)
+        return connection
+
+    async def _read(self, operation):
+        """Выполняет operation(connection) на соединении для чтения в пуле потоков"""
+        return await asyncio.to_thread(lambda: operation(self._reader()))
+
+    async def ping(self):
+        """Проверка базы через поток-писатель; в отличие от остальных методов пробрасывает ошибку"""
+        if self._writer is None or not self._writer.is_alive():
+            raise RuntimeError("Database writer thread is not running")
+        await self._write(lambda conn: conn.execute('SELECT 1').fetchone())
+
+    def _migrate(self):
+        version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+            for statement in statements:
+                self.cursor.execute(statement)
+            self.cursor.execute(f'PRAGMA user_version = {number}')
+            logger.info(f"Database migrated to version {number}")
+
+    def _add_column_if_missing(self, table, column, definition):
+        self.cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in self.cursor.fetchall()]:
+            self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    async def add_user(self, user_id, username, first_name, last_name):
+        try:
+            await self._write(lambda conn: conn.execute('''
                 INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
                 VALUES (?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name))
-            self.connection.commit()
+            ''', (user_id, username, first_name, last_name)))
             logger.info(f"User {user_id} added to database")
         except sqlite3.Error as e:
             logger.error(f"Error adding user: {e}")
 
-    def add_task(self, user_id, task_type, client_code, route, document_number, comment):
+    async def add_task(self, user_id, task_type, client_code, route, document_number, comment,
+                       claim_type=None, articles=None, title=None, ticket_id=None):
+        articles_json = json.dumps(articles, ensure_ascii=False) if articles is not None else None
         try:
-            self.cursor.execute('''
-                INSERT INTO tasks (user_id, task_type, client_code, route, document_number, comment)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, task_type, client_code, route, document_number, comment))
-            self.connection.commit()
+            task_id = await self._write(lambda conn: conn.execute('''
+                INSERT INTO tasks (user_id, task_type, client_code, route, document_number, comment,
+                                   claim_type, articles, title, ticket_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, task_type, client_code, route, document_number, comment,
+                  claim_type, articles_json, title, ticket_id)).lastrowid)
             logger.info(f"Task added to database for user {user_id}")
-            return self.cursor.lastrowid
+            return task_id
         except sqlite3.Error as e:
             logger.error(f"Error adding task: {e}")
             return None
 
-    def get_user_tasks(self, user_id):
+    async def save_activity(self, users, tasks):
+        """Записывает накопленных пользователей и заявки одной транзакцией
+
+        ID задачи Bitrix24 подставляется из outbox, если заявка уже доставлена.
+        """
+        def save(conn):
+            conn.executemany('''
+                INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
+                VALUES (?, ?, ?, ?)
+            ''', users)
+            conn.executemany('''
+                INSERT INTO tasks (user_id, task_type, client_code, route, document_number, comment,
+                                   claim_type, articles, title, ticket_id, created_at, bitrix_task_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                        COALESCE(?, (SELECT bitrix_task_id FROM outbox WHERE ticket_id = ?)))
+            ''', [task + (task[9],) for task in tasks])
+
         try:
-            self.cursor.execute('''
-                SELECT * FROM tasks WHERE user_id = ? ORDER BY created_at DESC
-            ''', (user_id,))
-            return self.cursor.fetchall()
+            await self._write(save)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error saving activity: {e}")
+            return False
+
+    async def set_task_bitrix_id(self, ticket_id, bitrix_task_id):
+        try:
+            await self._write(lambda conn: conn.execute('''
+                UPDATE tasks SET bitrix_task_id = ? WHERE ticket_id = ?
+            ''', (str(bitrix_task_id), ticket_id)))
+        except sqlite3.Error as e:
+            logger.error(f"Error setting Bitrix task ID for ticket {ticket_id}: {e}")
+
+    async def get_user_tasks(self, user_id, limit=10, before=None):
+        """Страница задач пользователя от новых к старым
+
+        before - ключ (created_at, task_id) последней задачи предыдущей
+        страницы; выборка идёт по индексу idx_tasks_user_created без OFFSET.
+        """
+        def select(conn):
+            if before is None:
+                return conn.execute('''
+                    SELECT task_id, ticket_id, bitrix_task_id, task_type, title, claim_type,
+                           client_code, route, document_number, created_at
+                    FROM tasks WHERE user_id = ?
+                    ORDER BY created_at DESC, task_id DESC
+                    LIMIT ?
+                ''', (user_id, limit)).fetchall()
+            return conn.execute('''
+                SELECT task_id, ticket_id, bitrix_task_id, task_type, title, claim_type,
+                       client_code, route, document_number, created_at
+                FROM tasks WHERE user_id = ? AND (created_at, task_id) < (?, ?)
+                ORDER BY created_at DESC, task_id DESC
+                LIMIT ?
+            ''', (user_id, before[0], before[1], limit)).fetchall()
+
+        try:
+            return await self._read(select)
         except sqlite3.Error as e:
             logger.error(f"Error getting user tasks: {e}")
             return []
 
+    @staticmethod
+    def _insert_outbox_item(conn, user_id, chat_id, task_type, payload, source_update_id):
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO outbox (user_id, chat_id, task_type, payload, source_update_id)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, chat_id, task_type, payload, source_update_id))
+        if cursor.rowcount == 0:
+            # Повторная доставка того же обновления - возвращаем существующую заявку
+            ticket_id = conn.execute('''
+                SELECT ticket_id FROM outbox WHERE source_update_id = ?
+            ''', (source_update_id,)).fetchone()[0]
+            return ticket_id, False
+        return cursor.lastrowid, True
+
+    async def add_outbox_item(self, user_id, chat_id, task_type, payload, source_update_id=None):
+        try:
+            ticket_id, created = await self._write(lambda conn: self._insert_outbox_item(
+                conn, user_id, chat_id, task_type, payload, source_update_id
+            ))
+            if created:
+                logger.info(f"Outbox item {ticket_id} added for user {user_id}")
+            else:
+                logger.info(f"Update {source_update_id} already queued as outbox item {ticket_id}")
+            return ticket_id, created
+        except sqlite3.Error as e:
+            logger.error(f"Error adding outbox item: {e}")
+            return None, False
+
+    async def add_unique_outbox_item(self, user_id, chat_id, task_type, payload, fingerprint,
+                                     created_at, prune_before, source_update_id=None):
+        """Ставит заявку в outbox, если с prune_before не было заявки с тем же отпечатком
+
+        Проверка и регистрация отпечатка выполняются в одной транзакции
+        потока-писателя, поэтому два процесса не могут зарегистрировать одну
+        заявку дважды. Возвращает (ticket_id, создан ли, исходная заявка):
+        для дубля ticket_id - None, а исходная заявка - (ticket_id, user_id).
+        """
+        def insert(conn):
+            queued = conn.execute('''
+                SELECT ticket_id FROM outbox WHERE source_update_id = ?
+            ''', (source_update_id,)).fetchone()
+            if queued is not None:
+                return queued[0], False, None
+
+            conn.execute('''
+                DELETE FROM submission_fingerprints WHERE created_at < ?
+            ''', (prune_before,))
+            claimed = conn.execute('''
+                INSERT OR IGNORE INTO submission_fingerprints (fingerprint, user_id, update_id, created_at)
+                VALUES (?, ?, ?, ?)
+            ''', (fingerprint, user_id, source_update_id, created_at)).rowcount
+            if not claimed:
+                original = conn.execute('''
+                    SELECT ticket_id, user_id FROM submission_fingerprints WHERE fingerprint = ?
+                ''', (fingerprint,)).fetchone()
+                return None, False, original
+
+            ticket_id, created = self._insert_outbox_item(
+                conn, user_id, chat_id, task_type, payload, source_update_id
+            )
+            conn.execute('''
+                UPDATE submission_fingerprints SET ticket_id = ? WHERE fingerprint = ?
+            ''', (ticket_id, fingerprint))
+            return ticket_id, created, None
+
+        try:
+            ticket_id, created, original = await self._write(insert)
+            if created:
+                logger.info(f"Outbox item {ticket_id} added for user {user_id}")
+            elif original is not None:
+                logger.info(f"Submission from user {user_id} duplicates outbox item {original[0]}")
+            else:
+                logger.info(f"Update {source_update_id} already queued as outbox item {ticket_id}")
+            return ticket_id, created, original
+        except sqlite3.Error as e:
+            logger.error(f"Error adding outbox item: {e}")
+            return None, False, None
+
+    async def get_due_outbox_items(self, now, limit=50):
+        try:
+            return await self._read(lambda conn: conn.execute('''
+                SELECT ticket_id, user_id, chat_id, task_type, payload, attempts
+                FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY ticket_id
+                LIMIT ?
+            ''', (now, limit)).fetchall())
+        except sqlite3.Error as e:
+            logger.error(f"Error getting outbox items: {e}")
+            return []
+
+    async def count_pending_outbox(self):
+        try:
+            return await self._read(lambda conn: conn.execute('''
+                SELECT COUNT(*) FROM outbox WHERE status = 'pending'
+            ''').fetchone()[0])
+        except sqlite3.Error as e:
+            logger.error(f"Error counting outbox items: {e}")
+            return None
+
+    async def get_next_outbox_attempt(self):
+        try:
+            return await self._read(lambda conn: conn.execute('''
+                SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'
+            ''').fetchone()[0])
+        except sqlite3.Error as e:
+            logger.error(f"Error getting next outbox attempt: {e}")
+            return None
+
+    async def mark_outbox_sent(self, ticket_id, bitrix_task_id):
+        try:
+            await self._write(lambda conn: conn.execute('''
+                UPDATE outbox
+                SET status = 'sent', bitrix_task_id = ?, attempts = attempts + 1,
+                    last_error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE ticket_id = ?
+            ''', (str(bitrix_task_id), ticket_id)))
+        except sqlite3.Error as e:
+            logger.error(f"Error marking outbox item {ticket_id} as sent: {e}")
+
+    async def schedule_outbox_retry(self, ticket_id, error, next_attempt_at):
+        try:
+            await self._write(lambda conn: conn.execute('''
+                UPDATE outbox
+                SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE ticket_id = ?
+            ''', (error, next_attempt_at, ticket_id)))
+        except sqlite3.Error as e:
+            logger.error(f"Error scheduling retry for outbox item {ticket_id}: {e}")
+
+    async def postpone_outbox_item(self, ticket_id, next_attempt_at):
+        """Откладывает заявку без учёта попытки (ждёт другую заявку)"""
+        try:
+            await self._write(lambda conn: conn.execute('''
+                UPDATE outbox SET next_attempt_at = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE ticket_id = ?
+            ''', (next_attempt_at, ticket_id)))
+        except sqlite3.Error as e:
+            logger.error(f"Error postponing outbox item {ticket_id}: {e}")
+
+    async def get_outbox_item(self, ticket_id):
+        try:
+            return await self._read(lambda conn: conn.execute('''
+                SELECT status, bitrix_task_id FROM outbox WHERE ticket_id = ?
+            ''', (ticket_id,)).fetchone())
+        except sqlite3.Error as e:
+            logger.error(f"Error getting outbox item {ticket_id}: {e}")
+            return None
+
+    async def mark_outbox_failed(self, ticket_id, error):
+        def update(conn):
+            conn.execute('''
+                UPDATE outbox
+                SET status = 'failed', attempts = attempts + 1, last_error = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE ticket_id = ?
+            ''', (error, ticket_id))
+            # Заявку, по которой задача не создана, можно отправить заново
+            conn.execute('''
+                DELETE FROM submission_fingerprints WHERE ticket_id = ?
+            ''', (ticket_id,))
+
+        try:
+            await self._write(update)
+        except sqlite3.Error as e:
+            logger.error(f"Error marking outbox item {ticket_id} as failed: {e}")
+
+    async def load_user_data(self):
+        try:
+            return await self._read(lambda conn: conn.execute(
+                'SELECT user_id, data FROM user_data'
+            ).fetchall())
+        except sqlite3.Error as e:
+            logger.error(f"Error loading user data: {e}")
+            return []
+
+    async def load_conversations(self, name):
+        try:
+            return await self._read(lambda conn: conn.execute('''
+                SELECT conversation_key, state FROM conversations WHERE name = ?
+            ''', (name,)).fetchall())
+        except sqlite3.Error as e:
+            logger.error(f"Error loading conversations {name}: {e}")
+            return []
+
+    async def count_conversations(self):
+        """Число незавершённых диалогов по именам ConversationHandler; None при ошибке"""
+        try:
+            return await self._read(lambda conn: dict(conn.execute('''
+                SELECT name, COUNT(*) FROM conversations GROUP BY name
+            ''').fetchall()))
+        except sqlite3.Error as e:
+            logger.error(f"Error counting conversations: {e}")
+            return None
+
+    async def save_persistence(self, user_data, dropped_user_ids, conversations, ended_conversations):
+        """Сохраняет накопленные изменения persistence одной транзакцией"""
+        def save(conn):
+            conn.executemany('''
+                INSERT OR REPLACE INTO user_data (user_id, data, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+            ''', user_data)
+            conn.executemany('''
+                DELETE FROM user_data WHERE user_id = ?
+            ''', [(user_id,) for user_id in dropped_user_ids])
+            conn.executemany('''
+                INSERT OR REPLACE INTO conversations (name, conversation_key, state, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ''', conversations)
+            conn.executemany('''
+                DELETE FROM conversations WHERE name = ? AND conversation_key = ?
+            ''', ended_conversations)
+
+        try:
+            await self._write(save)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error saving persistence: {e}")
+            return False
+
+    async def load_processed_updates(self, since):
+        try:
+            return await self._read(lambda conn: [row[0] for row in conn.execute('''
+                SELECT update_id FROM processed_updates WHERE processed_at >= ?
+            ''', (since,))])
+        except sqlite3.Error as e:
+            logger.error(f"Error loading processed updates: {e}")
+            return []
+
+    async def load_update_watermark(self, since):
+        """Watermark long polling, записанный не раньше since; None, если его нет"""
+        try:
+            row = await self._read(lambda conn: conn.execute('''
+                SELECT update_id FROM update_watermark WHERE saved_at >= ?
+            ''', (since,)).fetchone())
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Error loading update watermark: {e}")
+            return None
+
+    async def save_processed_updates(self, rows, prune_before, watermark=None):
+        """Сохраняет обработанные обновления и watermark, удаляет устаревшие одной транзакцией"""
+        def save(conn):
+            conn.executemany('''
+                INSERT OR IGNORE INTO processed_updates (update_id, processed_at)
+                VALUES (?, ?)
+            ''', rows)
+            conn.execute('''
+                DELETE FROM processed_updates WHERE processed_at < ?
+            ''', (prune_before,))
+            if watermark is not None:
+                conn.execute('''
+                    INSERT OR REPLACE INTO update_watermark (id, update_id, saved_at)
+                    VALUES (1, ?, ?)
+                ''', (watermark, time.time()))
+
+        try:
+            await self._write(save)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error saving processed updates: {e}")
+            return False
+
     def close(self):
+        """Дожидается записи очереди писателя и закрывает соединения"""
+        if self._writer is not None and self._writer.is_alive():
+            self._write_queue.put(None)
+            self._writer.join()
+        with self._readers_lock:
+            for connection in self._readers:
+                connection.close()
+            self._readers = []
         if self.connection:
             self.connection.close()
-            logger.info("Database connection closed")
\ No newline at end of file
+            logger.info("Database connection closed")
@@ -0,0 +1,29 @@
+import hashlib
+import json
+from collections import Counter
+from catalog import normalize_article
+from directory import normalize_route
+
+
+def submission_fingerprint(task_type, data):
+    """Отпечаток заявки по клиенту, маршруту, документу и товарам
+
+    Комментарий водителя в отпечаток не входит. Для информационных
+    сообщений без документа и товаров отпечаток не строится.
+    """
+    if task_type == 'info':
+        return None
+
+    articles = Counter()
+    for item in data.get('articles', []):
+        articles[normalize_article(item['article'])] += int(item['quantity'])
+
+    key = json.dumps([
+        task_type,
+        data.get('claim_type', ''),
+        data['client_code'].strip(),
+        normalize_route(data['route']),
+        normalize_article(data.get('document_number', '')),
+        sorted(articles.items())
+    ], ensure_ascii=False)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
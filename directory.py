@@ -0,0 +1,159 @@
+import asyncio
+import csv
+import difflib
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Словарь ограниченного размера с вытеснением давно не использованных ключей"""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+def normalize_route(route):
+    return ' '.join(route.upper().split())
+
+
+class Directory:
+    """Справочник допустимых кодов клиентов и маршрутов
+
+    Загружается из CSV (выгрузка из базы или экспорт CRM Bitrix24) и держится
+    в памяти. Раз в ttl секунд файл проверяется и перечитывается, если
+    изменился. Подсказки для опечаток кэшируются в LRU-кэше. Пока справочник
+    не загружен, проверка пропускает любые значения.
+    """
+
+    def __init__(self, path=None, ttl=300, cache_size=1024,
+                 code_column='client_code', route_column='route'):
+        self.path = path
+        self.ttl = ttl
+        self.code_column = code_column
+        self.route_column = route_column
+        self.client_codes = frozenset()
+        self.routes = {}
+        self._loaded_mtime = None
+        self._checked_at = 0.0
+        self._reloading = False
+        self._suggestions = LRUCache(cache_size)
+
+    @property
+    def loaded(self):
+        return self._loaded_mtime is not None
+
+    def _read_file(self):
+        for encoding in ('utf-8-sig', 'cp1251'):
+            try:
+                with open(self.path, newline='', encoding=encoding) as f:
+                    sample = f.read(4096)
+                    f.seek(0)
+                    try:
+                        dialect = csv.Sniffer().sniff(sample, delimiters=';,\t')
+                    except csv.Error:
+                        dialect = csv.excel
+                    rows = list(csv.DictReader(f, dialect=dialect))
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            raise ValueError(f"Не удалось определить кодировку файла {self.path}")
+
+        client_codes = set()
+        routes = {}
+        for row in rows:
+            code = (row.get(self.code_column) or '').strip()
+            route = (row.get(self.route_column) or '').strip()
+            if code:
+                client_codes.add(code)
+            if route:
+                routes.setdefault(normalize_route(route), route)
+        return frozenset(client_codes), routes
+
+    async def refresh(self):
+        """Перечитывает файл справочника, если истёк ttl и файл изменился"""
+        now = time.monotonic()
+        if not self.path or self._reloading or now - self._checked_at < self.ttl:
+            return
+        self._checked_at = now
+
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            logger.error(f"Файл справочника недоступен: {e}")
+            return
+        if mtime == self._loaded_mtime:
+            return
+
+        self._reloading = True
+        try:
+            client_codes, routes = await asyncio.to_thread(self._read_file)
+            # Подменяем данные целиком, чтобы проверки не видели частичную загрузку
+            self.client_codes, self.routes = client_codes, routes
+            self._loaded_mtime = mtime
+            self._suggestions.clear()
+            logger.info(f"Справочник загружен: клиентов {len(client_codes)}, маршрутов {len(routes)}")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки справочника {self.path}: {e}", exc_info=True)
+        finally:
+            self._reloading = False
+
+    def is_valid_client_code(self, code):
+        return not self.client_codes or code in self.client_codes
+
+    def find_route(self, route):
+        """Маршрут в написании справочника или None, если такого нет"""
+        if not self.routes:
+            return route
+        return self.routes.get(normalize_route(route))
+
+    def suggest_client_code(self, code):
+        """Ближайший существующий код: отличие в одной цифре, лишняя/пропущенная или переставленная"""
+        cached = self._suggestions.get(('code', code), False)
+        if cached is not False:
+            return cached
+
+        digits = '0123456789'
+        candidates = []
+        for i in range(len(code) + 1):
+            if i < len(code):
+                candidates.append(code[:i] + code[i + 1:])
+                candidates.extend(code[:i] + d + code[i + 1:] for d in digits if d != code[i])
+            if i < len(code) - 1:
+                candidates.append(code[:i] + code[i + 1] + code[i] + code[i + 2:])
+            candidates.extend(code[:i] + d + code[i:] for d in digits)
+
+        suggestion = next((c for c in candidates if c in self.client_codes), None)
+        self._suggestions.put(('code', code), suggestion)
+        return suggestion
+
+    def suggest_route(self, route):
+        key = normalize_route(route)
+        cached = self._suggestions.get(('route', key), False)
+        if cached is not False:
+            return cached
+
+        matches = difflib.get_close_matches(key, self.routes.keys(), n=1, cutoff=0.6)
+        suggestion = self.routes[matches[0]] if matches else None
+        self._suggestions.put(('route', key), suggestion)
+        return suggestion
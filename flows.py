@@ -0,0 +1,59 @@
+from telegram import MessageEntity, Update
+from telegram.ext import BaseHandler, ConversationHandler
+
+
+class TextDispatchHandler(BaseHandler):
+    """Выбор обработчика текстового сообщения по точному тексту кнопки
+
+    Вместо цепочки фильтров - один поиск в словаре buttons; остальной текст
+    получает default, если он задан. Команды и не текстовые обновления
+    не обрабатываются.
+    """
+
+    def __init__(self, buttons, default=None):
+        super().__init__(default)
+        self.buttons = buttons
+        self.default = default
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or update.message is None:
+            return None
+        message = update.message
+        if message.text is None:
+            return None
+        entities = message.entities
+        if entities and entities[0].type == MessageEntity.BOT_COMMAND and entities[0].offset == 0:
+            return None
+        return self.buttons.get(message.text, self.default)
+
+    async def handle_update(self, update, application, check_result, context):
+        return await check_result(update, context)
+
+
+def compile_flows(name, flows, steps, common_buttons=None, fallbacks=()):
+    """Собирает таблицу диалогов в один сохраняемый ConversationHandler
+
+    flows - {кнопка входа: (обработчик входа, {шаг: номер состояния})},
+    steps - {шаг: ({текст кнопки: обработчик}, обработчик прочего текста)}.
+    common_buttons действуют в каждом шаге. Одинаковые шаги разных
+    диалогов должны иметь один номер состояния, разные шаги - разные.
+    """
+    common_buttons = common_buttons or {}
+    states = {}
+    state_steps = {}
+    for entry_text, (entry_handler, flow_states) in flows.items():
+        for step, state in flow_states.items():
+            if state_steps.setdefault(state, step) != step:
+                raise ValueError(f"Состояние {state} занято шагами {state_steps[state]} и {step}")
+            if state not in states:
+                buttons, default = steps[step]
+                states[state] = [TextDispatchHandler({**common_buttons, **buttons}, default)]
+
+    entry_point = TextDispatchHandler({text: handler for text, (handler, _) in flows.items()})
+    return ConversationHandler(
+        entry_points=[entry_point],
+        states=states,
+        fallbacks=list(fallbacks),
+        name=name,
+        persistent=True
+    )
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import time
+import httpx
+from telegram.request import HTTPXRequest
+from metrics import HEALTH_PROBE
+
+logger = logging.getLogger(__name__)
+
+
+class PollingRequest(HTTPXRequest):
+    """HTTPXRequest для getUpdates, запоминающий время последнего ответа Telegram"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_response = time.monotonic()
+
+    async def do_request(self, *args, **kwargs):
+        result = await super().do_request(*args, **kwargs)
+        self.last_response = time.monotonic()
+        return result
+
+    @property
+    def lag(self):
+        """Секунды с последнего ответа на getUpdates"""
+        return time.monotonic() - self.last_response
+
+
+class Probe:
+    """Периодическая проверка зависимости с порогами и гистерезисом
+
+    Проверка считается проваленной после failure_threshold неудач подряд
+    и восстановленной после recovery_threshold успехов подряд, поэтому
+    единичный сбой сети не меняет состояние. critical - от проверки
+    зависит готовность (/readyz). restart_after - через сколько секунд
+    непрерывного провала нужен перезапуск бота (None - никогда).
+    """
+
+    def __init__(self, name, check, interval=30, timeout=10, failure_threshold=3,
+                 recovery_threshold=2, critical=True, restart_after=None):
+        self.name = name
+        self.check = check
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.recovery_threshold = recovery_threshold
+        self.critical = critical
+        self.restart_after = restart_after
+        self.healthy = True
+        self.failures = 0
+        self.successes = 0
+        self.last_error = None
+        self.last_checked = None
+        self.last_duration = None
+        self.unhealthy_since = None
+
+    async def run(self):
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self.check(), self.timeout)
+        except Exception as e:
+            self.failures += 1
+            self.successes = 0
+            self.last_error = str(e) or type(e).__name__
+            if self.healthy and self.failures >= self.failure_threshold:
+                self.healthy = False
+                self.unhealthy_since = time.monotonic()
+                logger.error(f"Проверка {self.name} не проходит {self.failures} раз подряд: {self.last_error}")
+            elif self.healthy:
+                logger.warning(f"Проверка {self.name} не прошла ({self.failures}/{self.failure_threshold}): {self.last_error}")
+        else:
+            self.successes += 1
+            self.failures = 0
+            if not self.healthy and self.successes >= self.recovery_threshold:
+                self.healthy = True
+                self.unhealthy_since = None
+                self.last_error = None
+                logger.info(f"Проверка {self.name} восстановлена")
+        finally:
+            self.last_checked = time.monotonic()
+            self.last_duration = self.last_checked - start
+            HEALTH_PROBE.labels(self.name).set(1 if self.healthy else 0)
+
+    def needs_restart(self):
+        if self.restart_after is None or self.unhealthy_since is None:
+            return False
+        return time.monotonic() - self.unhealthy_since >= self.restart_after
+
+    def status(self):
+        return {
+            'healthy': self.healthy,
+            'critical': self.critical,
+            'consecutive_failures': self.failures,
+            'last_error': self.last_error,
+            'last_checked_ago': round(time.monotonic() - self.last_checked, 1) if self.last_checked else None,
+            'last_duration': round(self.last_duration, 3) if self.last_duration is not None else None,
+        }
+
+
+class HealthMonitor:
+    """Проверки состояния бота и его зависимостей
+
+    Каждая проверка работает в своей задаче с собственным интервалом.
+    HTTP-проверки используют один общий клиент с пулом соединений.
+    ready - функция, возвращающая True, пока бот принимает обновления;
+    details - корутина с дополнительными полями отчёта (отставание
+    polling, очередь outbox); on_restart(reason) вызывается, когда
+    проверка с restart_after не проходит дольше этого срока.
+    """
+
+    def __init__(self, ready=None, details=None, on_restart=None):
+        self.probes = []
+        self.ready = ready
+        self.details = details
+        self.on_restart = on_restart
+        self._client = None
+        self._tasks = []
+
+    def add_probe(self, probe):
+        self.probes.append(probe)
+        return probe
+
+    def get_client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(10, connect=5),
+                limits=httpx.Limits(max_connections=5, max_keepalive_connections=2, keepalive_expiry=60)
+            )
+        return self._client
+
+    def url_check(self, url):
+        """Проверка, что адрес отвечает без ошибки сервера"""
+        async def check():
+            response = await self.get_client().get(url)
+            if response.status_code >= 500:
+                raise RuntimeError(f"{url}: статус {response.status_code}")
+        return check
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run(probe)) for probe in self.probes]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    async def _run(self, probe):
+        while True:
+            try:
+                await probe.run()
+                if probe.needs_restart() and self.on_restart is not None:
+                    logger.error(f"Проверка {probe.name} не проходит {probe.restart_after} с, перезапускаем бота")
+                    # Следующий перезапуск - не раньше, чем через restart_after
+                    probe.unhealthy_since = time.monotonic()
+                    self.on_restart(probe.name)
+            except Exception as e:
+                logger.error(f"Ошибка проверки {probe.name}: {e}", exc_info=True)
+            await asyncio.sleep(probe.interval)
+
+    def _stalled(self, probe):
+        # Задача проверки, давно не завершавшая прогон, - признак зависшего event loop или проверки
+        if probe.last_checked is None:
+            return False
+        return time.monotonic() - probe.last_checked > 3 * probe.interval + probe.timeout
+
+    async def _report(self, ok):
+        report = {
+            'status': 'ok' if ok else 'fail',
+            'probes': {probe.name: probe.status() for probe in self.probes},
+        }
+        if self.details is not None:
+            try:
+                report.update(await self.details())
+            except Exception as e:
+                logger.error(f"Ошибка при сборе отчёта о состоянии: {e}", exc_info=True)
+        return report
+
+    async def liveness(self):
+        """(жив ли процесс, отчёт): проверки выполняются и не зависли"""
+        ok = not any(task.done() for task in self._tasks) and not any(self._stalled(probe) for probe in self.probes)
+        return ok, await self._report(ok)
+
+    async def readiness(self):
+        """(готов ли бот принимать обновления, отчёт): бот запущен и критичные проверки проходят"""
+        ok = (self.ready is None or self.ready()) and all(
+            probe.healthy for probe in self.probes if probe.critical
+        )
+        return ok, await self._report(ok)
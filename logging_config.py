@@ -0,0 +1,217 @@
+import contextvars
+import copy
+import functools
+import glob
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from logging.handlers import BaseRotatingHandler, QueueHandler, QueueListener
+
+# extra для подробных записей с содержимым запросов: они пишутся выборочно
+PAYLOAD = {'payload': True}
+
+# Случайное число заявки: все её записи PAYLOAD попадают в выборку или отбрасываются вместе
+_payload_draw = contextvars.ContextVar('payload_draw', default=None)
+
+# Персональные данные и секреты, которые не должны попадать в логи
+REDACTIONS = [
+    (re.compile(r'\b\d{6,}:[A-Za-z0-9_-]{30,}\b'), '[TOKEN]'),
+    (re.compile(r'(/rest/\d+/)[A-Za-z0-9]+'), r'\1[SECRET]'),
+    (re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+'), '[EMAIL]'),
+    (re.compile(r'(?<!\d)(?:\+7|8)[\s(-]*\d{3}[\s)-]*\d{3}[\s-]*\d{2}[\s-]*\d{2}(?!\d)'), '[PHONE]'),
+    (re.compile(r'''\b(first_name|last_name|full_name|username|phone_number)(['"]?\s*[:=]\s*)(['"])(.*?)\3'''),
+     r'\1\2\3***\3'),
+]
+
+
+def redact(text):
+    for pattern, replacement in REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class RedactingFilter(logging.Filter):
+    """Вырезает персональные данные и секреты из сообщения и трассировки"""
+
+    def filter(self, record):
+        record.msg = redact(str(record.msg))
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        return True
+
+
+def sample_payloads(func):
+    """Декоратор корутины, отправляющей одну заявку: выборка PAYLOAD решается один раз на вызов"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _payload_draw.set(random.random())
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            _payload_draw.reset(token)
+
+    return wrapper
+
+
+class PayloadSampler(logging.Filter):
+    """Пропускает записи PAYLOAD только для доли rate заявок (см. sample_payloads)
+
+    Записи вне sample_payloads отбираются по одной.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'payload', False):
+            draw = _payload_draw.get()
+            return (random.random() if draw is None else draw) < self.rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler, который при переполненной очереди отбрасывает записи
+
+    Сообщение и трассировка форматируются в потоке вызова, запись на диск
+    и в stdout выполняет QueueListener в своём потоке.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SizeAndTimeRotatingFileHandler(BaseRotatingHandler):
+    """Файл лога, который ротируется в полночь и при превышении max_bytes
+
+    Ротированные файлы получают суффикс с временем ротации. Файлы старше
+    retention_days удаляются, всего хранится не более backup_count файлов.
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, retention_days=7, backup_count=50):
+        super().__init__(filename, 'a', encoding='utf-8', delay=False)
+        self.max_bytes = max_bytes
+        self.retention_days = retention_days
+        self.backup_count = backup_count
+        self.rollover_at = self._next_midnight()
+
+    @staticmethod
+    def _next_midnight():
+        tomorrow = datetime.now() + timedelta(days=1)
+        return tomorrow.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+    def shouldRollover(self, record):
+        if time.time() >= self.rollover_at:
+            return True
+        if self.stream is None:
+            return False
+        return self.max_bytes > 0 and self.stream.tell() + len(self.format(record)) + 1 >= self.max_bytes
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        suffix = datetime.now().strftime('%Y%m%d-%H%M%S')
+        target = f"{self.baseFilename}.{suffix}"
+        counter = 1
+        while os.path.exists(target):
+            target = f"{self.baseFilename}.{suffix}.{counter}"
+            counter += 1
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            os.replace(self.baseFilename, target)
+
+        self._remove_old_files()
+        self.rollover_at = self._next_midnight()
+        self.stream = self._open()
+
+    def _remove_old_files(self):
+        files = sorted(glob.glob(f"{glob.escape(self.baseFilename)}.*"), key=os.path.getmtime)
+        expire_before = time.time() - self.retention_days * 86400
+        excess = len(files) - self.backup_count
+        for index, path in enumerate(files):
+            if index < excess or os.path.getmtime(path) < expire_before:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def setup_logging(log_dir, level='INFO', log_format='json', max_bytes=10 * 1024 * 1024,
+                  retention_days=7, backup_count=50, payload_sample_rate=0.01, queue_size=10000,
+                  filename='app.log', stream=None):
+    """Настраивает корневой логгер и запускает поток записи логов
+
+    Возвращает QueueListener, который нужно остановить при завершении,
+    чтобы дописать оставшиеся в очереди записи. Процессы-обработчики
+    передают свой filename и stream=sys.stderr: их stdout занят обменом
+    с процессом-приёмником.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+
+    if log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    redacting_filter = RedactingFilter()
+    handlers = [
+        logging.StreamHandler(stream or sys.stdout),
+        SizeAndTimeRotatingFileHandler(
+            os.path.join(log_dir, filename),
+            max_bytes=max_bytes,
+            retention_days=retention_days,
+            backup_count=backup_count
+        )
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.addFilter(redacting_filter)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    queue_handler.addFilter(PayloadSampler(payload_sample_rate))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    # httpx пишет строку на каждый запрос, это дублирует наши логи
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
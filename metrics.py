@@ -0,0 +1,92 @@
+import functools
+import logging
+import time
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Асинхронные сборщики: обновляют перед выдачей значения, для которых нужен запрос к базе
+_collectors = []
+
+
+def add_collector(collector):
+    _collectors.append(collector)
+
+
+async def render_metrics():
+    """Метрики REGISTRY в текстовом формате Prometheus"""
+    for collector in _collectors:
+        try:
+            await collector()
+        except Exception as e:
+            logger.error(f"Ошибка сборщика метрик: {e}", exc_info=True)
+    return generate_latest(REGISTRY)
+
+
+HANDLER_LATENCY = Histogram(
+    'bot_handler_duration_seconds', 'Время работы обработчика диалога', ['handler'],
+    buckets=DEFAULT_BUCKETS
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors', 'Исключения в обработчиках диалогов', ['handler']
+)
+BITRIX_LATENCY = Histogram(
+    'bitrix_request_duration_seconds', 'Время HTTP-запроса к Bitrix24', ['method'],
+    buckets=DEFAULT_BUCKETS
+)
+BITRIX_REQUESTS = Counter(
+    'bitrix_requests', 'HTTP-запросы к Bitrix24 по статусу ответа', ['method', 'status']
+)
+UPDATE_LAG = Histogram(
+    'telegram_update_lag_seconds', 'Задержка от отправки сообщения до начала обработки',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600)
+)
+UPDATE_QUEUE_SIZE = Gauge(
+    'bot_update_queue_size', 'Обновления в очереди приложения'
+)
+UPDATES_IN_PROGRESS = Gauge(
+    'bot_chats_in_progress', 'Чаты с обновлениями в обработке или в очереди'
+)
+OUTBOX_PENDING = Gauge(
+    'bot_outbox_pending', 'Заявки outbox, ожидающие доставки в Bitrix24'
+)
+WORKER_PENDING = Gauge(
+    'bot_worker_pending_updates', 'Обновления, не подтверждённые процессом-обработчиком', ['shard']
+)
+ACTIVE_CONVERSATIONS = Gauge(
+    'bot_active_conversations', 'Незавершённые диалоги', ['conversation']
+)
+HEALTH_PROBE = Gauge(
+    'bot_health_probe_up', 'Состояние проверки зависимости с учётом гистерезиса (1 - в порядке)', ['probe']
+)
+BOT_RESTARTS = Counter(
+    'bot_restarts', 'Перезапуски экземпляра бота', ['reason']
+)
+
+
+def track_handler(func):
+    """Замеряет время работы обработчика в HANDLER_LATENCY"""
+    child = HANDLER_LATENCY.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(update, context, *args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.labels(func.__name__).inc()
+            raise
+        finally:
+            child.observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+async def observe_update_lag(update, context):
+    """Обработчик, замеряющий задержку входящих сообщений"""
+    message = update.message
+    if message is not None and message.date is not None:
+        UPDATE_LAG.observe(max(0.0, time.time() - message.date.timestamp()))
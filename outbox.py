@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import time
+from config import Config
+from bitrix_api import BitrixAPI
+
+logger = logging.getLogger(__name__)
+
+# Заявка-комментарий к задаче другой заявки (повторное сообщение о том же)
+COMMENT_TASK_TYPE = 'comment'
+
+
+class OutboxWorker:
+    """Фоновая доставка заявок из outbox в Bitrix24"""
+
+    def __init__(self, db):
+        self.db = db
+        self.bot = None
+        self._task = None
+        self._wakeup = None
+        # Вызывается вместо пробуждения, если доставка идёт в другом процессе
+        self.on_enqueue = None
+
+    async def enqueue(self, user_id, chat_id, task_type, data, source_update_id=None):
+        """Сохраняет заявку в outbox и возвращает (номер локального тикета, создан ли он)
+
+        Повторная постановка с тем же source_update_id возвращает уже
+        существующий тикет, поэтому повтор обновления не создаёт вторую задачу.
+        """
+        ticket_id, created = await self.db.add_outbox_item(
+            user_id, chat_id, task_type, json.dumps(data, ensure_ascii=False), source_update_id
+        )
+        if created:
+            self.wakeup()
+        return ticket_id, created
+
+    async def enqueue_unique(self, user_id, chat_id, task_type, data, fingerprint, source_update_id=None):
+        """Как enqueue, но не ставит заявку, если за DEDUP_WINDOW уже есть заявка с тем же отпечатком
+
+        Возвращает (номер тикета, создан ли он, (номер тикета, user_id) исходной
+        заявки или None).
+        """
+        now = time.time()
+        ticket_id, created, original = await self.db.add_unique_outbox_item(
+            user_id, chat_id, task_type, json.dumps(data, ensure_ascii=False), fingerprint,
+            now, now - Config.DEDUP_WINDOW, source_update_id
+        )
+        if created:
+            self.wakeup()
+        return ticket_id, created, original
+
+    def wakeup(self):
+        """Запускает проход доставки, не дожидаясь OUTBOX_POLL_INTERVAL"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+        elif self.on_enqueue is not None:
+            self.on_enqueue()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info("Обработчик outbox запущен")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info("Обработчик outbox остановлен")
+
+    def _retry_delay(self, attempts):
+        return min(Config.OUTBOX_MAX_RETRY_DELAY, Config.OUTBOX_RETRY_DELAY * (2 ** (attempts - 1)))
+
+    async def _wait(self):
+        timeout = Config.OUTBOX_POLL_INTERVAL
+        next_attempt = await self.db.get_next_outbox_attempt()
+        if next_attempt is not None:
+            timeout = max(0.0, min(timeout, next_attempt - time.time()))
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self):
+        while True:
+            try:
+                # Пока бот не запущен, уведомлять водителей некому
+                if self.bot is not None:
+                    # Заявки отправляются одновременно, чтобы BitrixAPI объединил их в batch
+                    items = await self.db.get_due_outbox_items(time.time())
+                    if items:
+                        await asyncio.gather(*(self._deliver(*item) for item in items))
+                await self._wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике outbox: {e}", exc_info=True)
+                await asyncio.sleep(Config.OUTBOX_POLL_INTERVAL)
+
+    async def _deliver_comment(self, ticket_id, data, attempts):
+        """Добавляет комментарий к задаче исходной заявки, когда она создана
+
+        Как и для задач, перед повтором проверяется, не добавила ли
+        комментарий прошлая попытка, не дождавшаяся ответа.
+        """
+        target = await self.db.get_outbox_item(data['ticket_id'])
+        if target is None or target[0] == 'failed':
+            return {'error': f"Задача по заявке #{data['ticket_id']} не создана"}
+        if target[1] is None:
+            return None
+
+        if attempts:
+            found = await BitrixAPI.find_comment(target[1], ticket_id)
+            if not found.get('success'):
+                return found
+            if found['comment_id'] is not None:
+                logger.info(f"Заявка #{ticket_id}: комментарий уже добавлен прошлой попыткой")
+                found['task_id'] = target[1]
+                return found
+
+        result = await BitrixAPI.add_comment(target[1], data['text'], ticket_id=ticket_id)
+        if result.get('success'):
+            result['task_id'] = target[1]
+        return result
+
+    async def _deliver_task(self, ticket_id, task_type, data, attempts):
+        """Создаёт задачу по заявке
+
+        Прошлая попытка могла создать задачу, но не дождаться ответа
+        (таймаут, 5xx), поэтому перед повтором задача ищется по тегу заявки.
+        """
+        if attempts:
+            found = await BitrixAPI.find_task(ticket_id)
+            if not found.get('success'):
+                return found
+            if found['task_id'] is not None:
+                logger.info(f"Заявка #{ticket_id}: задача {found['task_id']} уже создана прошлой попыткой")
+                return found
+        return await BitrixAPI.create_task(task_type, data, ticket_id=ticket_id)
+
+    async def _attempt(self, ticket_id, task_type, payload, attempts):
+        data = json.loads(payload)
+        if task_type == COMMENT_TASK_TYPE:
+            return await self._deliver_comment(ticket_id, data, attempts)
+        return await self._deliver_task(ticket_id, task_type, data, attempts)
+
+    async def _deliver(self, ticket_id, user_id, chat_id, task_type, payload, attempts):
+        try:
+            result = await self._attempt(ticket_id, task_type, payload, attempts)
+        except Exception as e:
+            # Непредвиденная ошибка одной заявки расходует её попытку, а не останавливает проход
+            logger.error(f"Заявка #{ticket_id}: ошибка доставки: {e}", exc_info=True)
+            result = {'error': 'Internal error', 'retryable': True}
+        if result is None:
+            # Исходная заявка ещё в очереди - ждём её без расхода попыток
+            await self.db.postpone_outbox_item(ticket_id, time.time() + Config.OUTBOX_POLL_INTERVAL)
+            return
+
+        if result.get('success'):
+            await self.db.mark_outbox_sent(ticket_id, result['task_id'])
+            await self.db.set_task_bitrix_id(ticket_id, result['task_id'])
+            logger.info(f"Заявка #{ticket_id} доставлена в Bitrix24, задача {result['task_id']}")
+            if task_type == COMMENT_TASK_TYPE:
+                text = f"✅ Заявка #{ticket_id} добавлена комментарием к задаче {result['task_id']}"
+            else:
+                text = f"✅ Задача по заявке #{ticket_id} создана! ID: {result['task_id']}"
+            await self._notify(chat_id, text)
+            return
+
+        error = result.get('error', 'Неизвестная ошибка')
+        attempts += 1
+        if result.get('retryable') and attempts < Config.OUTBOX_MAX_ATTEMPTS:
+            delay = self._retry_delay(attempts)
+            await self.db.schedule_outbox_retry(ticket_id, error, time.time() + delay)
+            logger.warning(
+                f"Заявка #{ticket_id}: попытка {attempts} не удалась ({error}), "
+                f"повтор через {delay:.0f} секунд"
+            )
+            return
+
+        await self.db.mark_outbox_failed(ticket_id, error)
+        logger.error(f"Заявка #{ticket_id} не доставлена после {attempts} попыток: {error}")
+        await self._notify(
+            chat_id,
+            f"❌ Не удалось создать задачу по заявке #{ticket_id}: {error}\n"
+            f"Пожалуйста, сообщите номер заявки диспетчеру."
+        )
+
+    async def _notify(self, chat_id, text):
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
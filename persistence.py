@@ -0,0 +1,146 @@
+import asyncio
+import json
+import logging
+from copy import deepcopy
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class SqlitePersistence(BasePersistence):
+    """Хранение состояний диалогов и user_data в bot.db
+
+    Изменения копятся в памяти и записываются пакетом: все вызовы update_*
+    одного прохода Application.update_persistence попадают в одну транзакцию.
+    """
+
+    def __init__(self, db, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db = db
+        self._user_data = None
+        self._conversations = {}
+        self._dirty_users = {}
+        self._dropped_users = set()
+        self._dirty_conversations = {}
+        self._flush_scheduled = False
+
+    async def get_user_data(self):
+        if self._user_data is None:
+            self._user_data = {
+                user_id: json.loads(data) for user_id, data in await self.db.load_user_data()
+            }
+            logger.info(f"Восстановлены данные {len(self._user_data)} пользователей")
+        return deepcopy(self._user_data)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        if name not in self._conversations:
+            self._conversations[name] = {
+                tuple(json.loads(key)): json.loads(state)
+                for key, state in await self.db.load_conversations(name)
+            }
+            logger.info(f"Восстановлено {len(self._conversations[name])} диалогов {name}")
+        return dict(self._conversations[name])
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self._conversations.setdefault(name, {})
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._dirty_conversations[(name, key)] = new_state
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id, data):
+        if self._user_data is None:
+            self._user_data = {}
+        self._user_data[user_id] = data
+        self._dirty_users[user_id] = data
+        self._dropped_users.discard(user_id)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        if self._user_data is not None:
+            self._user_data.pop(user_id, None)
+        self._dirty_users.pop(user_id, None)
+        self._dropped_users.add(user_id)
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _schedule_flush(self):
+        # Откладываем запись до конца текущего прохода update_persistence
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        """Записывает накопленные изменения; False, если запись не удалась"""
+        self._flush_scheduled = False
+        if not (self._dirty_users or self._dropped_users or self._dirty_conversations):
+            return True
+
+        dirty_users, self._dirty_users = self._dirty_users, {}
+        dropped_users, self._dropped_users = self._dropped_users, set()
+        dirty_conversations, self._dirty_conversations = self._dirty_conversations, {}
+
+        user_data = [
+            (user_id, json.dumps(data, ensure_ascii=False))
+            for user_id, data in dirty_users.items()
+        ]
+        dropped_user_ids = list(dropped_users)
+        conversations = []
+        ended_conversations = []
+        for (name, key), state in dirty_conversations.items():
+            if state is None:
+                ended_conversations.append((name, json.dumps(list(key))))
+            else:
+                conversations.append((name, json.dumps(list(key)), json.dumps(state)))
+
+        if await self.db.save_persistence(user_data, dropped_user_ids, conversations, ended_conversations):
+            logger.debug(
+                f"Persistence сохранена: пользователей {len(user_data) + len(dropped_user_ids)}, "
+                f"диалогов {len(conversations) + len(ended_conversations)}"
+            )
+            return True
+
+        # Запись не удалась - возвращаем изменения, если их не перекрыли более новые
+        for user_id, data in dirty_users.items():
+            if user_id not in self._dropped_users:
+                self._dirty_users.setdefault(user_id, data)
+        for user_id in dropped_users:
+            if user_id not in self._dirty_users:
+                self._dropped_users.add(user_id)
+        for key, state in dirty_conversations.items():
+            self._dirty_conversations.setdefault(key, state)
+        return False
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityRecorder:
+    """Запись пользователей и заявок в bot.db через буфер в памяти
+
+    Обработчики только добавляют строки в буфер; в базу они попадают
+    одной транзакцией каждые flush_interval секунд, при заполнении буфера
+    и при остановке бота.
+    """
+
+    def __init__(self, db, flush_interval=2, max_buffer=500):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._known_users = set()
+        self._users = []
+        self._tasks = []
+        self._task = None
+        self._flush_requested = None
+
+    def record_user(self, user):
+        if user is None or user.id in self._known_users:
+            return
+        self._known_users.add(user.id)
+        self._users.append((user.id, user.username, user.first_name, user.last_name))
+        self._check_size()
+
+    def record_task(self, user_id, task_type, data, ticket_id=None, bitrix_task_id=None):
+        articles = data.get('articles')
+        self._tasks.append((
+            user_id,
+            task_type,
+            data.get('client_code'),
+            data.get('route'),
+            data.get('document_number'),
+            data.get('comment'),
+            data.get('claim_type') or None,
+            json.dumps(articles, ensure_ascii=False) if articles is not None else None,
+            data.get('title'),
+            ticket_id,
+            # Время фиксируем сейчас, а не при записи буфера (UTC, как CURRENT_TIMESTAMP)
+            datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            str(bitrix_task_id) if bitrix_task_id is not None else None
+        ))
+        self._check_size()
+
+    async def record_first_contact(self, update, context):
+        """Обработчик для всех обновлений: запоминает новых пользователей"""
+        self.record_user(update.effective_user)
+
+    def _check_size(self):
+        if len(self._users) + len(self._tasks) >= self.max_buffer and self._flush_requested is not None:
+            self._flush_requested.set()
+
+    async def flush(self):
+        if not (self._users or self._tasks):
+            return
+        users, self._users = self._users, []
+        tasks, self._tasks = self._tasks, []
+        if await self.db.save_activity(users, tasks):
+            logger.debug(f"Записано пользователей: {len(users)}, заявок: {len(tasks)}")
+            return
+        # Не удалось записать - вернём строки в буфер до следующей попытки
+        self._users = users + self._users
+        self._tasks = tasks + self._tasks
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._flush_requested = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при записи буфера активности: {e}", exc_info=True)
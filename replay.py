@@ -0,0 +1,148 @@
+"""Воспроизведение записанного трафика (CAPTURE_PATH) на локальном стенде
+
+Обновления из файла подаются в приложение из bot.build_application() с
+исходными интервалами, ускоренно (--speed 10) или без пауз (--speed 0).
+Bitrix24 заменяется поддельным сервером, задержки и доля ошибок которого
+по умолчанию берутся из той же записи. Отчёт в JSON удобно сравнивать
+между сборками.
+
+Пример:
+    python replay.py capture.jsonl.gz --speed 10 --json > build-a.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from telegram import Update
+from telegram.ext import TypeHandler
+from benchmark import BenchBot, FakeBitrix, configure_stand_in, max_rss_mb, percentile
+from capture import read_capture
+
+logger = logging.getLogger('replay')
+
+
+async def replay(args):
+    records = read_capture(args.capture)
+    updates = [record for record in records if record['type'] == 'update']
+    bitrix = [record for record in records if record['type'] == 'bitrix']
+    if not updates:
+        raise SystemExit(f"В файле {args.capture} нет обновлений")
+
+    latencies = [record['duration'] for record in bitrix if record['status'] != 'error']
+    error_rate = args.bitrix_error_rate
+    if error_rate is None:
+        failed = sum(1 for record in bitrix if record['status'] == 'error' or int(record['status']) >= 500)
+        error_rate = failed / len(bitrix) if bitrix else 0.0
+
+    rng = random.Random(args.seed)
+    fake_bitrix = FakeBitrix(
+        args.bitrix_latency or 0.0, 0.0, error_rate, rng,
+        latencies=None if args.bitrix_latency is not None else latencies
+    )
+    configure_stand_in(await fake_bitrix.start(), args.retry_delay)
+
+    # bot.py создаёт bot.db в текущем каталоге при импорте
+    import bot
+
+    fed = {}
+    done = {}
+
+    async def mark_done(update, context):
+        done[update.update_id] = time.perf_counter()
+
+    await bot.start_services()
+    application = bot.build_application(BenchBot('123456:benchmark'))
+    application.add_handler(TypeHandler(Update, mark_done), group=100)
+    await application.initialize()
+    await application.start()
+    bot.outbox_worker.bot = application.bot
+
+    first_at = updates[0]['t']
+    started = time.perf_counter()
+    for record in updates:
+        if args.speed > 0:
+            delay = (record['t'] - first_at) / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(record['update'], application.bot)
+        fed[update.update_id] = time.perf_counter()
+        await application.update_queue.put(update)
+    feed_time = time.perf_counter() - started
+
+    # Ждём обработки обновлений и доставки заявок
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline and len(done) < len(fed):
+        await asyncio.sleep(0.05)
+    while time.perf_counter() < deadline and await bot.db.count_pending_outbox():
+        await asyncio.sleep(0.05)
+    total_time = time.perf_counter() - started
+    pending = await bot.db.count_pending_outbox()
+
+    bot.outbox_worker.bot = None
+    await application.stop()
+    await application.shutdown()
+    await bot.stop_services()
+    await fake_bitrix.stop()
+
+    latency = [done[update_id] - fed_at for update_id, fed_at in fed.items() if update_id in done]
+    return {
+        'capture': os.path.basename(args.capture),
+        'speed': args.speed,
+        'updates': len(fed),
+        'updates_processed': len(latency),
+        'feed_seconds': round(feed_time, 3),
+        'total_seconds': round(total_time, 3),
+        'updates_per_second': round(len(latency) / total_time, 1) if total_time else 0.0,
+        'update_latency_ms': {f"p{p}": round(percentile(latency, p) * 1000, 2) for p in (50, 95, 99)},
+        'bitrix_error_rate': round(error_rate, 4),
+        'bitrix_requests': fake_bitrix.requests,
+        'bitrix_commands': fake_bitrix.commands,
+        'outbox_pending': pending,
+        'max_rss_mb': max_rss_mb()
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика бота")
+    parser.add_argument('capture', help="файл, записанный при заданном CAPTURE_PATH")
+    parser.add_argument('--speed', type=float, default=1.0, help="ускорение относительно записи, 0 - без пауз")
+    parser.add_argument('--bitrix-latency', type=float, default=None, help="постоянная задержка Bitrix24 вместо записанной, с")
+    parser.add_argument('--bitrix-error-rate', type=float, default=None, help="доля ошибок Bitrix24 вместо записанной")
+    parser.add_argument('--retry-delay', type=float, default=0.5, help="базовая задержка повтора outbox, с")
+    parser.add_argument('--timeout', type=float, default=120, help="ожидание обработки после подачи, с")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="вывести отчёт в JSON")
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args.capture = os.path.abspath(args.capture)
+
+    os.chdir(tempfile.mkdtemp(prefix='motexbot-replay-'))
+    report = asyncio.run(replay(args))
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"Обновлений: {report['updates']}, обработано: {report['updates_processed']}")
+        print(f"Подача: {report['feed_seconds']} с, всего: {report['total_seconds']} с, {report['updates_per_second']} обновл./с")
+        latency = report['update_latency_ms']
+        print(f"Обработка обновления, мс: p50 {latency['p50']}, p95 {latency['p95']}, p99 {latency['p99']}")
+        print(
+            f"Bitrix24: запросов {report['bitrix_requests']}, команд {report['bitrix_commands']}, "
+            f"доля ошибок {report['bitrix_error_rate']}; в outbox осталось {report['outbox_pending']}"
+        )
+        print(f"Память: пик RSS {report['max_rss_mb']} МБ")
+    return 1 if report['updates_processed'] < report['updates'] or report['outbox_pending'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
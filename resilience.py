@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонён: автомат размыкателя открыт"""
+
+
+class RetryableError(Exception):
+    """Ответ сервиса, после которого запрос имеет смысл повторить"""
+
+
+class ThrottledError(RetryableError):
+    """Сервис ограничил частоту запросов; не считается его недоступностью"""
+
+
+class RetryPolicy:
+    """Повторы с экспоненциальной задержкой и полным джиттером
+
+    retry_on - ошибки, после которых вызов можно безопасно повторить.
+    failure_on - ошибки, которые автомат размыкателя считает недоступностью
+    сервиса; по умолчанию совпадают с retry_on. Запрос, который мог
+    выполниться на сервере (таймаут ответа, 5xx), стоит считать отказом,
+    но не повторять, если он не идемпотентен.
+    """
+
+    def __init__(self, attempts=3, base_delay=0.5, max_delay=10.0, retry_on=(RetryableError,), failure_on=None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.failure_on = retry_on if failure_on is None else failure_on
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def call(self, func, *args, breaker=None, **kwargs):
+        """Вызывает корутину func, повторяя её при ошибках из retry_on"""
+        for attempt in range(self.attempts):
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                # Прерванный вызов ничего не говорит о сервисе, но не должен держать пробный слот
+                if breaker is not None:
+                    breaker.release()
+                raise
+            except Exception as e:
+                if breaker is not None:
+                    # Ограничение частоты означает, что сервис отвечает;
+                    # ошибки вне failure_on не говорят о его недоступности
+                    if isinstance(e, self.failure_on) and not isinstance(e, ThrottledError):
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if not isinstance(e, self.retry_on) or attempt + 1 >= self.attempts:
+                    raise
+                delay = self.delay(attempt)
+                logger.warning(f"Попытка {attempt + 1} не удалась ({e!r}), повтор через {delay:.2f} секунд")
+                await asyncio.sleep(delay)
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+
+
+class CircuitBreaker:
+    """Автомат размыкателя: closed -> open -> half-open -> closed"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def before_call(self):
+        """Пропускает вызов или сразу отклоняет его, пока автомат открыт"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"{self.name}: circuit is open")
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+            logger.info(f"{self.name}: автомат полуоткрыт, пробный запрос")
+
+        if self.state == self.HALF_OPEN:
+            # В полуоткрытом состоянии пропускаем только один пробный запрос
+            if self._trial_in_flight:
+                raise CircuitOpenError(f"{self.name}: circuit is half-open")
+            self._trial_in_flight = True
+
+    def release(self):
+        """Вызов прерван без результата: следующий вызов снова может стать пробным"""
+        self._trial_in_flight = False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"{self.name}: автомат замкнут")
+        self.state = self.CLOSED
+        self._failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.error(
+                    f"{self.name}: автомат открыт после {self._failures} ошибок, "
+                    f"запросы отклоняются {self.reset_timeout:.0f} секунд"
+                )
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов по алгоритму token bucket
+
+    Ожидающие вызовы обслуживаются строго в порядке очереди. После сигнала
+    о превышении лимита скорость снижается вдвое и постепенно
+    восстанавливается до исходной.
+    """
+
+    def __init__(self, rate=2.0, burst=10, min_rate=0.2, recovery_interval=10.0):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery_interval = recovery_interval
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._throttled_at = None
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._throttled_at is not None and self.rate < self.base_rate:
+            # Каждые recovery_interval секунд без ограничений ускоряемся на 25%
+            if now - self._throttled_at >= self.recovery_interval:
+                self.rate = min(self.base_rate, self.rate * 1.25)
+                self._throttled_at = now if self.rate < self.base_rate else None
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def throttled(self):
+        """Сервис ответил превышением лимита: сбрасываем запас и замедляемся"""
+        self._refill()
+        self._tokens = 0.0
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._throttled_at = time.monotonic()
+        logger.warning(f"Превышен лимит запросов, скорость снижена до {self.rate:.2f} запросов/с")
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов со строгим порядком внутри чата
+
+    Обновления одного чата обрабатываются по одному в порядке поступления,
+    поэтому ConversationHandler видит сообщения водителя последовательно.
+    Одновременно обрабатывается не более max_concurrent_updates обновлений;
+    ожидающие своей очереди в чате обновления слот не занимают.
+    on_processed(update) вызывается после обработки каждого обновления.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates=1024, on_processed=None):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        # Семафор базового класса ограничивает число принятых в работу обновлений,
+        # а число одновременно обрабатываемых ограничивает self._slots
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.max_active_updates = max_concurrent_updates
+        self.on_processed = on_processed
+        self._slots = None
+        self._chat_locks = {}
+
+    @staticmethod
+    def _chat_key(update):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            return user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        await self._process(update, coroutine)
+        # Прерванное обновление (остановка приложения) обработанным не считается
+        if self.on_processed is not None:
+            self.on_processed(update)
+
+    async def _process(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        # Блокировка чата живёт, пока у него есть обновления в работе или в очереди
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    @property
+    def chats_in_progress(self):
+        return len(self._chat_locks)
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.max_active_updates)
+        self._chat_locks = {}
+
+    async def shutdown(self):
+        if self._chat_locks:
+            logger.warning(f"Остановка обработчика при {len(self._chat_locks)} чатах с обновлениями в работе")
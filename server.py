@@ -0,0 +1,91 @@
+import logging
+import secrets
+from aiohttp import web
+from telegram import Update
+from config import Config
+from prometheus_client import CONTENT_TYPE_LATEST
+from metrics import render_metrics
+
+logger = logging.getLogger(__name__)
+
+
+def create_web_app(get_application, health=None, reload_config=None):
+    """HTTP-интерфейс бота, работающий в том же event loop, что и Application
+
+    get_application возвращает текущий экземпляр telegram.ext.Application
+    или None, пока бот перезапускается. health - HealthMonitor для
+    /healthz и /readyz, reload_config - корутина перечитывания конфигурации.
+    """
+
+    async def home(request):
+        return web.Response(text="Bot is running!")
+
+    async def healthz(request):
+        """Живость процесса: проверки выполняются и не зависли"""
+        ok, report = await health.liveness()
+        return web.json_response(report, status=200 if ok else 503)
+
+    async def readyz(request):
+        """Готовность: бот запущен, Telegram и база данных доступны"""
+        ok, report = await health.readiness()
+        return web.json_response(report, status=200 if ok else 503)
+
+    async def metrics(request):
+        """Метрики в текстовом формате Prometheus"""
+        return web.Response(body=await render_metrics(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+    async def admin_reload_config(request):
+        """Перечитывание конфигурации; доступно только с ADMIN_TOKEN"""
+        if not Config.ADMIN_TOKEN:
+            return web.Response(status=404, text="Not Found")
+        token = request.headers.get('Authorization', '')
+        if not secrets.compare_digest(token, f"Bearer {Config.ADMIN_TOKEN}"):
+            logger.warning("Запрос перечитывания конфигурации с неверным токеном")
+            return web.Response(status=403, text="Forbidden")
+        try:
+            changed = await reload_config()
+        except ValueError as e:
+            logger.error(f"Новая конфигурация отклонена: {e}")
+            return web.json_response({'error': str(e)}, status=400)
+        return web.json_response({'changed': changed})
+
+    async def telegram_webhook(request):
+        """Приём обновлений Telegram в режиме вебхука"""
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, Config.WEBHOOK_SECRET):
+            logger.warning("Запрос к вебхуку с неверным секретным токеном")
+            return web.Response(status=403, text="Forbidden")
+
+        application = get_application()
+        if application is None:
+            return web.Response(status=503, text="Service Unavailable")
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="Bad Request")
+
+        # Кладём обновление в очередь приложения и сразу отвечаем Telegram
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+        return web.Response()
+
+    web_app = web.Application()
+    web_app.router.add_get('/', home)
+    web_app.router.add_get('/metrics', metrics)
+    if health is not None:
+        web_app.router.add_get('/healthz', healthz)
+        web_app.router.add_get('/readyz', readyz)
+    if reload_config is not None:
+        web_app.router.add_post('/admin/reload-config', admin_reload_config)
+    web_app.router.add_post(Config.WEBHOOK_PATH, telegram_webhook)
+    return web_app
+
+
+async def start_web_server(web_app, port):
+    """Запускает HTTP-сервер на текущем event loop и возвращает его runner"""
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', port)
+    await site.start()
+    logger.info(f"HTTP-сервер запущен на порту {port}")
+    return runner
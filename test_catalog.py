@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+from catalog import ArticleCatalog, parse_article_list
+
+
+@pytest.mark.parametrize('text', [
+    'ART123',
+    'ART123 5',
+    'BOX5',
+    'SHELF XL',
+    'Болт М8 х',
+    'ART;',
+    '5 шт',
+])
+def test_single_article_is_not_a_list(text):
+    assert parse_article_list(text) is None
+
+
+@pytest.mark.parametrize('text, article, quantity', [
+    ('ART123 x5', 'ART123', 5),
+    ('ART123 X 5', 'ART123', 5),
+    ('ART123 х5', 'ART123', 5),
+    ('ART123 ×5', 'ART123', 5),
+    ('ART123;5', 'ART123', 5),
+    ('ART123 ; 5', 'ART123', 5),
+    ('A1\t7', 'A1', 7),
+    ('AB*12', 'AB', 12),
+    ('ART 12 x 3 шт', 'ART 12', 3),
+    ('ART7 x 2 pcs.', 'ART7', 2),
+])
+def test_single_line_with_separator(text, article, quantity):
+    assert parse_article_list(text) == ([(1, article, quantity)], [])
+
+
+def test_zero_quantity_on_single_line_is_an_error():
+    items, errors = parse_article_list('ART1 x0')
+    assert items == []
+    assert errors[0][0] == 1
+
+
+def test_multiline_list_reports_each_bad_line():
+    text = 'ART1 x5\nART2;3\nART3 10 шт\nART4\nART5 x0\nART6 xx\n\nART7 х 2'
+    items, errors = parse_article_list(text)
+    assert items == [(1, 'ART1', 5), (2, 'ART2', 3), (3, 'ART3', 10), (8, 'ART7', 2)]
+    assert [(number, line) for number, line, _ in errors] == [(4, 'ART4'), (5, 'ART5 x0'), (6, 'ART6 xx')]
+
+
+def test_multiline_allows_space_separator():
+    assert parse_article_list('AB 12\nCD 3') == ([(1, 'AB', 12), (2, 'CD', 3)], [])
+
+
+def test_unit_is_stripped_only_after_quantity():
+    assert parse_article_list('CUPS 2\nBOXPCS') == ([(1, 'CUPS', 2)], [(2, 'BOXPCS', 'не указано количество')])
+
+
+def test_too_many_lines():
+    items, errors = parse_article_list('\n'.join(f'ART{i} x1' for i in range(5)), max_lines=4)
+    assert items == []
+    assert len(errors) == 1
+
+
+def test_catalog_contains(tmp_path):
+    path = tmp_path / 'catalog.csv'
+    path.write_text('article\nSHELF XL\nAB*12\n', encoding='utf-8')
+    catalog = ArticleCatalog(str(path), ttl=0)
+    assert not catalog.contains('SHELF XL')
+
+    asyncio.run(catalog.refresh())
+    assert catalog.contains('shelf  xl')
+    assert catalog.contains('AB*12')
+    assert not catalog.contains('AB')
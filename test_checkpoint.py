@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop
+from checkpoint import UpdateCheckpoint
+from database import Database
+
+
+class FakeTelegram:
+    """getUpdates: обновления ниже offset подтверждаются и больше не отдаются"""
+
+    def __init__(self, *update_ids):
+        self.update_ids = list(update_ids)
+        self.offsets = []
+
+    async def get_updates(self, offset=None, **kwargs):
+        self.offsets.append(offset)
+        if offset:
+            self.update_ids = [update_id for update_id in self.update_ids if update_id >= offset]
+        return [Update(update_id) for update_id in self.update_ids]
+
+
+def ids(updates):
+    return [update.update_id for update in updates]
+
+
+def test_offset_stops_at_unsaved_updates(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        telegram = FakeTelegram(10, 11, 12)
+
+        async def scenario():
+            checkpoint = UpdateCheckpoint(db, poll_backoff=0)
+            assert ids(await checkpoint.poll(telegram.get_updates, 0)) == [10, 11, 12]
+            checkpoint.mark_processed(10)
+            checkpoint.mark_processed(12)
+            assert checkpoint.watermark == 10
+            # Обработанные, но не записанные обновления Telegram ещё не подтверждены
+            assert await checkpoint.poll(telegram.get_updates, 13) == []
+            assert telegram.offsets[-1] == 10
+            await checkpoint.flush()
+            assert await checkpoint.poll(telegram.get_updates, 13) == []
+            assert telegram.offsets[-1] == 11
+            assert telegram.update_ids == [11, 12]
+
+            # Процесс упал, не обработав 11: Telegram доставляет 11 и 12 заново
+            restarted = UpdateCheckpoint(db, poll_backoff=0)
+            redelivered = await restarted.poll(telegram.get_updates, 0)
+            assert ids(redelivered) == [11, 12]
+            assert telegram.offsets[-1] == 11
+            assert not await restarted.is_processed(11)
+            with pytest.raises(ApplicationHandlerStop):
+                await restarted.skip_processed(redelivered[1], None)
+
+        asyncio.run(scenario())
+    finally:
+        db.close()
+
+
+def test_flush_waits_for_saved_state(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        saved = [False]
+
+        async def save_state():
+            return saved[0]
+
+        async def scenario():
+            checkpoint = UpdateCheckpoint(db, before_flush=save_state, poll_backoff=0)
+            await checkpoint.poll(FakeTelegram(7).get_updates, 0)
+            checkpoint.mark_processed(7)
+            await checkpoint.flush()
+            assert await db.load_processed_updates(0) == []
+            saved[0] = True
+            await checkpoint.flush()
+            return await db.load_processed_updates(0), await db.load_update_watermark(0)
+
+        assert asyncio.run(scenario()) == ([7], 7)
+    finally:
+        db.close()
+
+
+def test_release_advances_watermark_in_order(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        checkpoint = UpdateCheckpoint(db, poll_backoff=0)
+        asyncio.run(checkpoint.poll(FakeTelegram(1, 2, 3).get_updates, 0))
+        assert checkpoint.watermark == 0
+        # Подтверждения процессов-обработчиков приходят в любом порядке
+        checkpoint.release(3)
+        checkpoint.release(2)
+        assert checkpoint.watermark == 0
+        checkpoint.release(1)
+        assert checkpoint.watermark == 3
+    finally:
+        db.close()
@@ -0,0 +1,34 @@
+import pytest
+import config
+from config import read_reloadable, validate_reloadable
+
+VALID = {
+    'RESPONSIBLE_ID': '1',
+    'REFUSAL_PROJECT_ID': '10',
+    'CLAIM_PROJECT_ID': '11',
+    'INFO_PROJECT_ID': '12',
+}
+
+
+def test_valid_config():
+    assert validate_reloadable(read_reloadable(VALID)) == []
+
+
+@pytest.mark.parametrize('name, value', [
+    ('RESPONSIBLE_ID', 'ivanov'),
+    ('CLAIM_PROJECT_ID', ''),
+    ('REFUSAL_DEADLINE_DAYS', 'три'),
+    ('INFO_DEADLINE_DAYS', '0'),
+    ('CLAIM_TYPES', ' , '),
+    ('DEDUP_ACTION', 'drop'),
+])
+def test_invalid_value_is_reported(name, value):
+    assert len(validate_reloadable(read_reloadable({**VALID, name: value}))) == 1
+
+
+def test_check_config_reports_every_error(monkeypatch):
+    monkeypatch.setattr(config, '_reloadable', read_reloadable({'REFUSAL_DEADLINE_DAYS': 'x'}))
+    with pytest.raises(ValueError) as error:
+        config.check_config()
+    assert 'RESPONSIBLE_ID' in str(error.value)
+    assert 'Срок для refusal' in str(error.value)
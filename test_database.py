@@ -0,0 +1,143 @@
+import asyncio
+import sqlite3
+import time
+from database import MIGRATIONS, Database
+
+
+def test_migrates_baseline_schema(tmp_path):
+    path = str(tmp_path / 'bot.db')
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE tasks (
+            task_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            task_type TEXT,
+            client_code TEXT,
+            route TEXT,
+            document_number TEXT,
+            comment TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        );
+        INSERT INTO users (user_id, username) VALUES (5, 'driver');
+        INSERT INTO tasks (user_id, task_type, client_code, route, document_number, comment)
+        VALUES (5, 'refusal', 'C1', 'R1', 'D1', 'old');
+    ''')
+    connection.close()
+
+    db = Database(path)
+    try:
+        assert db.cursor.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        columns = [row[1] for row in db.cursor.execute('PRAGMA table_info(tasks)')]
+        for column in ('ticket_id', 'bitrix_task_id', 'title', 'claim_type', 'articles'):
+            assert column in columns
+        assert db.cursor.execute('SELECT user_id, comment FROM tasks').fetchall() == [(5, 'old')]
+        assert len(asyncio.run(db.get_user_tasks(5))) == 1
+    finally:
+        db.close()
+
+    # Повторное открытие не применяет миграции заново
+    db = Database(path)
+    try:
+        assert db.cursor.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    finally:
+        db.close()
+
+
+def test_migration_merges_conversation_names(tmp_path):
+    path = str(tmp_path / 'bot.db')
+    Database(path).close()
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        PRAGMA user_version = 1;
+        INSERT INTO conversations (name, conversation_key, state) VALUES ('claim_conversation', '[1, 1]', '"5"');
+        INSERT INTO conversations (name, conversation_key, state) VALUES ('info_conversation', '[2, 2]', '"8"');
+    ''')
+    connection.close()
+
+    db = Database(path)
+    try:
+        assert sorted(asyncio.run(db.load_conversations('driver_conversation'))) == [('[1, 1]', '"5"'), ('[2, 2]', '"8"')]
+        assert asyncio.run(db.load_conversations('claim_conversation')) == []
+    finally:
+        db.close()
+
+
+def test_redelivered_update_returns_the_queued_ticket(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        async def scenario():
+            first = await db.add_outbox_item(5, 5, 'refusal', '{}', source_update_id=100)
+            again = await db.add_outbox_item(5, 5, 'refusal', '{}', source_update_id=100)
+            other = await db.add_outbox_item(5, 5, 'refusal', '{}', source_update_id=101)
+            return first, again, other
+
+        first, again, other = asyncio.run(scenario())
+        assert first[1] and not again[1] and other[1]
+        assert again[0] == first[0] != other[0]
+        assert asyncio.run(db.count_pending_outbox()) == 2
+    finally:
+        db.close()
+
+
+def test_unique_outbox_item(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        async def scenario():
+            now = time.time()
+            queued = await db.add_unique_outbox_item(5, 5, 'claim', '{}', 'fp', now, now - 60, source_update_id=1)
+            redelivered = await db.add_unique_outbox_item(5, 5, 'claim', '{}', 'fp', now, now - 60, source_update_id=1)
+            duplicate = await db.add_unique_outbox_item(6, 6, 'claim', '{}', 'fp', now, now - 60, source_update_id=2)
+            await db.mark_outbox_failed(queued[0], 'error')
+            resubmitted = await db.add_unique_outbox_item(6, 6, 'claim', '{}', 'fp', now, now - 60, source_update_id=3)
+            expired = await db.add_unique_outbox_item(7, 7, 'claim', '{}', 'fp', now + 120, now + 60, source_update_id=4)
+            return queued, redelivered, duplicate, resubmitted, expired
+
+        queued, redelivered, duplicate, resubmitted, expired = asyncio.run(scenario())
+        assert queued[1] and queued[2] is None
+        assert redelivered == (queued[0], False, None)
+        assert duplicate == (None, False, (queued[0], 5))
+        assert resubmitted[1] and resubmitted[0] != queued[0]
+        assert expired[1]
+    finally:
+        db.close()
+
+
+def test_concurrent_claims_create_one_ticket(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        async def scenario():
+            now = time.time()
+            return await asyncio.gather(*(
+                db.add_unique_outbox_item(user_id, user_id, 'claim', '{}', 'fp', now, now - 60, source_update_id=user_id)
+                for user_id in range(4)
+            ))
+
+        results = asyncio.run(scenario())
+        assert sum(created for _, created, _ in results) == 1
+    finally:
+        db.close()
+
+
+def test_processed_updates_and_watermark(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        async def scenario():
+            now = time.time()
+            await db.save_processed_updates([(1, now - 100), (2, now)], now - 200, watermark=2)
+            await db.save_processed_updates([(3, now)], now - 50)
+            return await db.load_processed_updates(now - 200), await db.load_update_watermark(now - 10)
+
+        processed, watermark = asyncio.run(scenario())
+        assert sorted(processed) == [2, 3]
+        assert watermark == 2
+        assert asyncio.run(db.load_update_watermark(time.time() + 10)) is None
+    finally:
+        db.close()
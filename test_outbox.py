@@ -0,0 +1,79 @@
+import asyncio
+import json
+import time
+from bitrix_api import BitrixAPI
+from config import Config
+from database import Database
+from outbox import OutboxWorker
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+def deliver_due(worker):
+    async def scenario():
+        for item in await worker.db.get_due_outbox_items(time.time() + 3600):
+            await worker._deliver(*item)
+
+    asyncio.run(scenario())
+
+
+def test_retry_finds_task_created_by_lost_attempt(tmp_path, monkeypatch):
+    calls = []
+
+    async def create_task(task_type, data, ticket_id=None):
+        calls.append(('create', ticket_id))
+        # Задача создана, но ответ потерян
+        return {'error': 'Bitrix24 server error 502', 'retryable': True}
+
+    async def find_task(ticket_id):
+        calls.append(('find', ticket_id))
+        return {'success': True, 'task_id': '42'}
+
+    monkeypatch.setattr(BitrixAPI, 'create_task', create_task)
+    monkeypatch.setattr(BitrixAPI, 'find_task', find_task)
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        worker = OutboxWorker(db)
+        worker.bot = FakeBot()
+        ticket_id, _ = asyncio.run(db.add_outbox_item(5, 50, 'refusal', json.dumps({'client_code': 'C1'})))
+
+        deliver_due(worker)
+        assert asyncio.run(db.get_outbox_item(ticket_id)) == ('pending', None)
+
+        deliver_due(worker)
+        assert calls == [('create', ticket_id), ('find', ticket_id)]
+        assert asyncio.run(db.get_outbox_item(ticket_id)) == ('sent', '42')
+        assert worker.bot.messages == [(50, f"✅ Задача по заявке #{ticket_id} создана! ID: 42")]
+    finally:
+        db.close()
+
+
+def test_unexpected_error_uses_a_retry(tmp_path, monkeypatch):
+    async def find_task(ticket_id):
+        raise ValueError('not json')
+
+    async def create_task(task_type, data, ticket_id=None):
+        return {'error': 'timeout', 'retryable': True}
+
+    monkeypatch.setattr(BitrixAPI, 'create_task', create_task)
+    monkeypatch.setattr(BitrixAPI, 'find_task', find_task)
+    monkeypatch.setattr(Config, 'OUTBOX_MAX_ATTEMPTS', 3)
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        worker = OutboxWorker(db)
+        worker.bot = FakeBot()
+        ticket_id, _ = asyncio.run(db.add_outbox_item(5, 50, 'refusal', '{}'))
+
+        for _ in range(3):
+            deliver_due(worker)
+        assert asyncio.run(db.get_outbox_item(ticket_id))[0] == 'failed'
+        assert len(worker.bot.messages) == 1
+        assert worker.bot.messages[0][1].startswith(f"❌ Не удалось создать задачу по заявке #{ticket_id}")
+    finally:
+        db.close()
@@ -0,0 +1,54 @@
+import asyncio
+from database import Database
+from persistence import SqlitePersistence
+
+
+def test_conversations_and_user_data_survive_restart(tmp_path):
+    path = str(tmp_path / 'bot.db')
+    db = Database(path)
+    try:
+        async def scenario():
+            persistence = SqlitePersistence(db)
+            await persistence.get_conversations('driver_conversation')
+            await persistence.update_conversation('driver_conversation', (1, 1), 'CLIENT_CODE')
+            await persistence.update_conversation('driver_conversation', (2, 2), 'ROUTE')
+            await persistence.update_user_data(1, {'client_code': 'C1'})
+            assert await persistence.flush()
+            await persistence.update_conversation('driver_conversation', (2, 2), None)
+            assert await persistence.flush()
+
+        asyncio.run(scenario())
+    finally:
+        db.close()
+
+    db = Database(path)
+    try:
+        async def restored():
+            persistence = SqlitePersistence(db)
+            return await persistence.get_conversations('driver_conversation'), await persistence.get_user_data()
+
+        conversations, user_data = asyncio.run(restored())
+        assert conversations == {(1, 1): 'CLIENT_CODE'}
+        assert user_data == {1: {'client_code': 'C1'}}
+    finally:
+        db.close()
+
+
+def test_failed_write_keeps_changes(tmp_path):
+    db = Database(str(tmp_path / 'bot.db'))
+    try:
+        async def failing_save(*args):
+            return False
+
+        async def scenario():
+            persistence = SqlitePersistence(db)
+            await persistence.update_conversation('driver_conversation', (1, 1), 'ROUTE')
+            db.save_persistence, save = failing_save, db.save_persistence
+            assert not await persistence.flush()
+            db.save_persistence = save
+            assert await persistence.flush()
+            return await db.load_conversations('driver_conversation')
+
+        assert asyncio.run(scenario()) == [('[1, 1]', '"ROUTE"')]
+    finally:
+        db.close()
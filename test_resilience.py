@@ -0,0 +1,91 @@
+import asyncio
+import pytest
+from resilience import CircuitBreaker, CircuitOpenError, RetryableError, RetryPolicy, ThrottledError
+
+
+def test_cancelled_half_open_trial_frees_the_slot():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    policy = RetryPolicy(attempts=1)
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(60)
+
+        trial = asyncio.create_task(policy.call(hang, breaker=breaker))
+        await started.wait()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+        async def ok():
+            return 'ok'
+
+        return await policy.call(ok, breaker=breaker)
+
+    assert asyncio.run(scenario()) == 'ok'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_opens_half_opens_and_closes(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('resilience.time.monotonic', lambda: now[0])
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # Пробный запрос не удался - автомат снова открыт на reset_timeout
+    now[0] += 30
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    now[0] += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    now[0] += 1
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+    breaker.before_call()
+
+
+def test_retry_policy_counts_only_failures():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    policy = RetryPolicy(attempts=3, base_delay=0, retry_on=(RetryableError,))
+
+    async def unavailable():
+        raise RetryableError('down')
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(policy.call(unavailable, breaker=breaker))
+    assert breaker.state == CircuitBreaker.OPEN
+
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+
+    async def throttled():
+        raise ThrottledError('limit')
+
+    with pytest.raises(ThrottledError):
+        asyncio.run(RetryPolicy(attempts=1, retry_on=(ThrottledError,)).call(throttled, breaker=breaker))
+    assert breaker.state == CircuitBreaker.CLOSED
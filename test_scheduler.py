@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+from scheduler import PerChatUpdateProcessor
+
+
+def update(update_id, chat_id):
+    return SimpleNamespace(update_id=update_id, effective_chat=SimpleNamespace(id=chat_id), effective_user=None)
+
+
+def test_chat_order_is_kept_and_chats_run_concurrently():
+    log = []
+    processed = []
+
+    async def handle(item, delay):
+        log.append(('start', item.update_id))
+        await asyncio.sleep(delay)
+        log.append(('end', item.update_id))
+
+    async def scenario():
+        processor = PerChatUpdateProcessor(4, on_processed=lambda item: processed.append(item.update_id))
+        await processor.initialize()
+        # Первое сообщение чата 1 обрабатывается дольше второго, но второе ждёт его
+        items = [(update(1, 1), 0.05), (update(2, 1), 0), (update(3, 2), 0)]
+        await asyncio.gather(*(processor.process_update(item, handle(item, delay)) for item, delay in items))
+        await processor.shutdown()
+
+    asyncio.run(scenario())
+    assert log.index(('end', 1)) < log.index(('start', 2))
+    assert log.index(('end', 3)) < log.index(('end', 1))
+    assert processed.index(1) < processed.index(2)
+    assert sorted(processed) == [1, 2, 3]
+
+
+def test_concurrency_limit():
+    active = [0, 0]
+
+    async def handle():
+        active[0] += 1
+        active[1] = max(active[1], active[0])
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+
+    async def scenario():
+        processor = PerChatUpdateProcessor(2)
+        await processor.initialize()
+        await asyncio.gather(*(processor.process_update(update(i, i), handle()) for i in range(6)))
+        assert processor.chats_in_progress == 0
+
+    asyncio.run(scenario())
+    assert active[1] == 2
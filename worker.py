@@ -0,0 +1,64 @@
+"""Процесс-обработчик одного шарда; запускается процессом-приёмником при WORKERS > 0
+
+    python worker.py <номер шарда>
+"""
+import asyncio
+import logging
+import signal
+import sys
+from config import Config, check_config
+from logging_config import setup_logging
+
+shard = int(sys.argv[1])
+
+# stdout занят подтверждениями для приёмника, логи идут в stderr и в свой файл
+log_listener = setup_logging(
+    Config.LOG_DIR,
+    level=Config.LOG_LEVEL,
+    log_format=Config.LOG_FORMAT,
+    max_bytes=Config.LOG_MAX_BYTES,
+    retention_days=Config.LOG_RETENTION_DAYS,
+    backup_count=Config.LOG_BACKUP_COUNT,
+    payload_sample_rate=Config.LOG_PAYLOAD_SAMPLE_RATE,
+    filename=f'worker{shard}.log',
+    stream=sys.stderr
+)
+
+# Входящий трафик записывает приёмник
+Config.CAPTURE_PATH = None
+
+from bot import run_worker
+
+logger = logging.getLogger(__name__)
+
+# Используем uvloop, если он установлен
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+if __name__ == '__main__':
+    # Остановкой управляет приёмник: он закрывает stdin, и обработчик дообрабатывает очередь
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_IGN)
+    # SIGHUP - перечитать конфигурацию; обработчик ставит run_worker
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    try:
+        check_config()
+    except ValueError as e:
+        logger.error(f"Обработчик {shard}: конфигурация не прошла проверку: {e}")
+        log_listener.stop()
+        sys.exit(1)
+
+    try:
+        asyncio.run(run_worker(shard))
+    except Exception as e:
+        logger.error(f"Критическая ошибка обработчика {shard}: {e}", exc_info=True)
+        sys.exit(1)
+    finally:
+        log_listener.stop()